@@ -2,6 +2,8 @@ import importlib.metadata
 
 from fixieai.agents import AgentQuery
 from fixieai.agents import AgentResponse
+from fixieai.agents import AsyncOAuthHandler
+from fixieai.agents import AsyncUserStorage
 from fixieai.agents import CodeShotAgent
 from fixieai.agents import DocumentCorpus
 from fixieai.agents import DocumentLoader
@@ -10,11 +12,13 @@ from fixieai.agents import Message
 from fixieai.agents import OAuthHandler
 from fixieai.agents import OAuthParams
 from fixieai.agents import UserStorage
+from fixieai.client import AsyncFixieClient
 from fixieai.client import FixieClient
 from fixieai.client import get_agents
 from fixieai.client import get_client
 from fixieai.client import get_embeds
 from fixieai.client import query
+from fixieai.client import query_many
 
 __all__ = [
     "AgentQuery",
@@ -26,12 +30,16 @@ __all__ = [
     "DocumentLoader",
     "OAuthParams",
     "OAuthHandler",
+    "AsyncOAuthHandler",
     "UserStorage",
+    "AsyncUserStorage",
     "FixieClient",
+    "AsyncFixieClient",
     "get_agents",
     "get_client",
     "get_embeds",
     "query",
+    "query_many",
 ]
 
 __version__ = importlib.metadata.version(__name__)
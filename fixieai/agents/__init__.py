@@ -5,13 +5,17 @@ from fixieai.agents.api import Message
 from fixieai.agents.code_shot import CodeShotAgent
 from fixieai.agents.corpora import DocumentCorpus
 from fixieai.agents.corpora import DocumentLoader
+from fixieai.agents.oauth import AsyncOAuthHandler
 from fixieai.agents.oauth import OAuthHandler
 from fixieai.agents.oauth import OAuthParams
+from fixieai.agents.user_storage import AsyncUserStorage
 from fixieai.agents.user_storage import UserStorage
 
 __all__ = [
     "AgentQuery",
     "AgentResponse",
+    "AsyncOAuthHandler",
+    "AsyncUserStorage",
     "CodeShotAgent",
     "DocumentCorpus",
     "DocumentLoader",
@@ -0,0 +1,195 @@
+"""A minimal CBOR (RFC 8949) encoder and decoder for UserStorage values.
+
+Only the types a UserStorage can hold are supported: None, bools, ints, floats, str,
+bytes, lists and dicts with str keys. Unlike JSON, bytes are stored as-is rather than
+base64-encoded.
+"""
+
+import struct
+from typing import Any, List, Tuple
+
+# CBOR major types.
+_UNSIGNED_INT = 0
+_NEGATIVE_INT = 1
+_BYTES = 2
+_TEXT = 3
+_ARRAY = 4
+_MAP = 5
+_TAG = 6
+_SIMPLE = 7
+
+# Tags for integers that don't fit in 64 bits.
+_POSITIVE_BIGNUM_TAG = 2
+_NEGATIVE_BIGNUM_TAG = 3
+
+_FALSE = b"\xf4"
+_TRUE = b"\xf5"
+_NULL = b"\xf6"
+_FLOAT64 = b"\xfb"
+
+# Maximum number of nested lists and dicts in a value. Deeper values are rejected with
+# a ValueError rather than running into the recursion limit.
+MAX_DEPTH = 500
+
+
+def dumps(value: Any) -> bytes:
+    """Encodes `value` to CBOR."""
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def loads(data: bytes) -> Any:
+    """Decodes a CBOR document, as produced by `dumps`."""
+    try:
+        value, end = _decode(data, 0)
+    except (IndexError, struct.error) as e:
+        raise ValueError("Truncated CBOR data") from e
+    if end != len(data):
+        raise ValueError(f"Unexpected trailing data at offset {end}")
+    return value
+
+
+def _encode_head(major_type: int, argument: int, out: bytearray):
+    if argument < 24:
+        out.append(major_type << 5 | argument)
+    elif argument < 1 << 8:
+        out.append(major_type << 5 | 24)
+        out.append(argument)
+    elif argument < 1 << 16:
+        out.append(major_type << 5 | 25)
+        out += struct.pack(">H", argument)
+    elif argument < 1 << 32:
+        out.append(major_type << 5 | 26)
+        out += struct.pack(">I", argument)
+    else:
+        out.append(major_type << 5 | 27)
+        out += struct.pack(">Q", argument)
+
+
+def _encode(value: Any, out: bytearray, depth: int = 0):
+    if value is None:
+        out += _NULL
+    elif value is True:
+        out += _TRUE
+    elif value is False:
+        out += _FALSE
+    elif isinstance(value, int):
+        _encode_int(value, out)
+    elif isinstance(value, float):
+        out += _FLOAT64
+        out += struct.pack(">d", value)
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        _encode_head(_TEXT, len(encoded), out)
+        out += encoded
+    elif isinstance(value, (bytes, bytearray)):
+        _encode_head(_BYTES, len(value), out)
+        out += value
+    elif isinstance(value, list):
+        _check_depth(depth)
+        _encode_head(_ARRAY, len(value), out)
+        for item in value:
+            _encode(item, out, depth + 1)
+    elif isinstance(value, dict):
+        _check_depth(depth)
+        _encode_head(_MAP, len(value), out)
+        for key, item in value.items():
+            if not isinstance(key, str):
+                raise TypeError(f"Keys must be str, got {type(key)!r}")
+            _encode(key, out)
+            _encode(item, out, depth + 1)
+    else:
+        raise TypeError(f"Cannot encode value of type {type(value)!r}")
+
+
+def _encode_int(value: int, out: bytearray):
+    major_type, argument = (
+        (_UNSIGNED_INT, value) if value >= 0 else (_NEGATIVE_INT, -1 - value)
+    )
+    if argument < 1 << 64:
+        _encode_head(major_type, argument, out)
+        return
+    tag = _POSITIVE_BIGNUM_TAG if major_type == _UNSIGNED_INT else _NEGATIVE_BIGNUM_TAG
+    _encode_head(_TAG, tag, out)
+    _encode(argument.to_bytes((argument.bit_length() + 7) // 8, "big"), out)
+
+
+def _check_depth(depth: int):
+    if depth >= MAX_DEPTH:
+        raise ValueError(f"Values can't be nested more than {MAX_DEPTH} levels deep")
+
+
+def _decode_head(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """Returns the major type, argument and offset past the head at `offset`."""
+    initial_byte = data[offset]
+    major_type, info = initial_byte >> 5, initial_byte & 0x1F
+    offset += 1
+    if info < 24:
+        return major_type, info, offset
+    elif info == 24:
+        return major_type, data[offset], offset + 1
+    elif info == 25:
+        return major_type, struct.unpack_from(">H", data, offset)[0], offset + 2
+    elif info == 26:
+        return major_type, struct.unpack_from(">I", data, offset)[0], offset + 4
+    elif info == 27:
+        return major_type, struct.unpack_from(">Q", data, offset)[0], offset + 8
+    raise ValueError(f"Unsupported CBOR head {initial_byte:#x} at offset {offset - 1}")
+
+
+def _decode(data: bytes, offset: int, depth: int = 0) -> Tuple[Any, int]:
+    """Returns the value at `offset`, and the offset past it."""
+    initial_byte = data[offset]
+    if initial_byte >> 5 == _SIMPLE:
+        return _decode_simple(data, offset)
+
+    major_type, argument, offset = _decode_head(data, offset)
+    if major_type == _UNSIGNED_INT:
+        return argument, offset
+    elif major_type == _NEGATIVE_INT:
+        return -1 - argument, offset
+    elif major_type in (_BYTES, _TEXT):
+        end = offset + argument
+        if end > len(data):
+            raise ValueError("Truncated CBOR data")
+        chunk = data[offset:end]
+        return (chunk.decode("utf-8") if major_type == _TEXT else chunk), end
+    elif major_type == _ARRAY:
+        _check_depth(depth)
+        items: List[Any] = []
+        for _ in range(argument):
+            item, offset = _decode(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    elif major_type == _MAP:
+        _check_depth(depth)
+        mapping = {}
+        for _ in range(argument):
+            key, offset = _decode(data, offset, depth + 1)
+            mapping[key], offset = _decode(data, offset, depth + 1)
+        return mapping, offset
+    elif argument in (_POSITIVE_BIGNUM_TAG, _NEGATIVE_BIGNUM_TAG):
+        magnitude, offset = _decode(data, offset)
+        if not isinstance(magnitude, bytes):
+            raise ValueError("Expected bytes for a bignum")
+        value = int.from_bytes(magnitude, "big")
+        return (value if argument == _POSITIVE_BIGNUM_TAG else -1 - value), offset
+    raise ValueError(f"Unsupported CBOR tag {argument}")
+
+
+def _decode_simple(data: bytes, offset: int) -> Tuple[Any, int]:
+    initial_byte = data[offset : offset + 1]
+    if initial_byte == _NULL:
+        return None, offset + 1
+    elif initial_byte == _TRUE:
+        return True, offset + 1
+    elif initial_byte == _FALSE:
+        return False, offset + 1
+    elif initial_byte == _FLOAT64:
+        return struct.unpack_from(">d", data, offset + 1)[0], offset + 9
+    elif initial_byte == b"\xfa":
+        return struct.unpack_from(">f", data, offset + 1)[0], offset + 5
+    elif initial_byte == b"\xf9":
+        return struct.unpack_from(">e", data, offset + 1)[0], offset + 3
+    raise ValueError(f"Unsupported CBOR simple value {data[offset]:#x}")
@@ -0,0 +1,68 @@
+import pytest
+
+from fixieai.agents import cbor
+
+
+@pytest.mark.parametrize(
+    "value, encoded_hex",
+    [
+        # Examples from RFC 8949, appendix A.
+        (0, "00"),
+        (23, "17"),
+        (24, "1818"),
+        (1000, "1903e8"),
+        (1000000000000, "1b000000e8d4a51000"),
+        (18446744073709551616, "c249010000000000000000"),
+        (-1, "20"),
+        (-1000, "3903e7"),
+        (-18446744073709551617, "c349010000000000000000"),
+        (1.1, "fb3ff199999999999a"),
+        (False, "f4"),
+        (True, "f5"),
+        (None, "f6"),
+        (b"\x01\x02\x03\x04", "4401020304"),
+        ("ü", "62c3bc"),
+        ([1, [2, 3], [4, 5]], "8301820203820405"),
+        ({"a": 1, "b": [2, 3]}, "a26161016162820203"),
+    ],
+)
+def test_rfc_examples(value, encoded_hex):
+    assert cbor.dumps(value).hex() == encoded_hex
+    assert cbor.loads(bytes.fromhex(encoded_hex)) == value
+
+
+def test_round_trip():
+    value = {
+        "text": "x" * 70000,
+        "bytes": bytes(range(256)) * 300,
+        "list": [None, True, 2**40, -(2**70), 0.5, {"nested": [b""]}],
+    }
+    assert cbor.loads(cbor.dumps(value)) == value
+
+
+def test_decodes_smaller_floats():
+    assert cbor.loads(bytes.fromhex("f93c00")) == 1.0
+    assert cbor.loads(bytes.fromhex("fa47c35000")) == 100000.0
+
+
+@pytest.mark.parametrize("value", [object(), {1: "non-str key"}, (1, 2)])
+def test_dumps_rejects_unsupported_values(value):
+    with pytest.raises(TypeError):
+        cbor.dumps(value)
+
+
+@pytest.mark.parametrize("encoded_hex", ["", "44010203", "8201", "0000", "ff"])
+def test_loads_rejects_malformed_data(encoded_hex):
+    with pytest.raises(ValueError):
+        cbor.loads(bytes.fromhex(encoded_hex))
+
+
+def test_rejects_deep_values():
+    value: list = []
+    for _ in range(1500):
+        value = [value]
+    with pytest.raises(ValueError, match="nested"):
+        cbor.dumps(value)
+    with pytest.raises(ValueError, match="nested"):
+        cbor.loads(b"\x81" * 1500 + b"\x80")
+    assert cbor.loads(b"\x81" * (cbor.MAX_DEPTH - 1) + b"\x80")
@@ -4,6 +4,7 @@ import dataclasses
 import functools
 import inspect
 import json
+import os
 import re
 import threading
 import time
@@ -14,11 +15,13 @@ import jwt
 import requests
 import uvicorn
 import yaml
+from fastapi import concurrency
 from pydantic import dataclasses as pydantic_dataclasses
 
 from fixieai import constants
 from fixieai.agents import api
 from fixieai.agents import corpora
+from fixieai.agents import few_shot_files
 from fixieai.agents import oauth
 from fixieai.agents import user_storage
 from fixieai.agents import utils
@@ -28,6 +31,8 @@ ACCEPTED_FUNC_NAMES = re.compile(r"^\w+$")
 
 # The JWT claim containing the agent ID
 _AGENT_ID_JWT_CLAIM = "aid"
+# The JWT claim containing the ID of the user the query is made for
+_USER_ID_JWT_CLAIM = "sub"
 
 
 @pydantic_dataclasses.dataclass
@@ -68,6 +73,16 @@ class CodeShotAgent:
     You can have FEW_SHOTS as a single string of all your few-shots separated by 2 new
     lines, or as an explicit list of one few-shot per index.
 
+    Large few-shot sets can instead be streamed from a JSONL or YAML data file with
+    `few_shots_path` (see `few_shot_files.iter_few_shots` for the format), or from any
+    iterator of few-shots. Few-shots from these sources are normalized one at a time as
+    they are read, and validated when the agent is served. A relative
+    `few_shots_path` is resolved against the directory of the module creating the
+    agent. With `lazy_few_shots=True`, a `few_shots_path` is only read once the
+    few-shots are first needed, e.g., upon the first handshake:
+
+        agent = CodeShotAgent(BASE_PROMPT, few_shots_path="few_shots.jsonl")
+
     Your few-shots may reach out to other Agents in the fixie ecosystem by
     "Ask Agent[agent_id]: <query to pass>", or reach out to some python functions
     by "Ask Func[func_name]: <query to pass>".
@@ -97,16 +112,34 @@ class CodeShotAgent:
     def __init__(
         self,
         base_prompt: str,
-        few_shots: Union[str, List[str]],
+        few_shots: Union[str, Iterable[str], None] = None,
         corpora: Optional[List[corpora.DocumentCorpus]] = None,
         conversational: bool = False,
         oauth_params: Optional[oauth.OAuthParams] = None,
+        *,
+        few_shots_path: Optional[str] = None,
+        lazy_few_shots: bool = False,
     ):
+        if (few_shots is None) == (few_shots_path is None):
+            raise ValueError("Exactly one of few_shots or few_shots_path must be set.")
+        if lazy_few_shots and few_shots_path is None:
+            raise ValueError("lazy_few_shots is only supported with few_shots_path.")
+
+        self._few_shots: Optional[List[str]] = None
+        self._few_shots_lock = threading.Lock()
+        if few_shots_path is not None and not os.path.isabs(few_shots_path):
+            few_shots_path = _resolve_from_caller(few_shots_path)
+        self.few_shots_path = few_shots_path
         if isinstance(few_shots, str):
-            few_shots = _split_few_shots(few_shots)
+            self._few_shots = _split_few_shots(few_shots)
+        elif isinstance(few_shots, list):
+            self._few_shots = few_shots
+        elif few_shots is not None:
+            self._few_shots = _load_few_shots(few_shots)
+        elif not lazy_few_shots:
+            self._few_shots = self._load_few_shots_from_path()
 
         self.base_prompt = base_prompt
-        self.few_shots = few_shots
         self.corpora = corpora
         self.conversational = conversational
         self.oauth_params = oauth_params
@@ -117,6 +150,23 @@ class CodeShotAgent:
             # Register default Funcs.
             self.register_func(_oauth)
 
+    @property
+    def few_shots(self) -> List[str]:
+        """The agent's few-shots, read from `few_shots_path` on first access if lazy."""
+        if self._few_shots is None:
+            with self._few_shots_lock:
+                if self._few_shots is None:
+                    self._few_shots = self._load_few_shots_from_path()
+        return self._few_shots
+
+    @few_shots.setter
+    def few_shots(self, few_shots: List[str]):
+        self._few_shots = few_shots
+
+    def _load_few_shots_from_path(self) -> List[str]:
+        assert self.few_shots_path is not None
+        return _load_few_shots(few_shot_files.iter_few_shots(self.few_shots_path))
+
     def serve(
         self, agent_id: Optional[str] = None, host: str = "0.0.0.0", port: int = 8181
     ):
@@ -139,6 +189,9 @@ class CodeShotAgent:
         Args:
             agent_id: The qualified agent id (`username/handle`)
         """
+        if self._few_shots is not None:
+            # Fail on bad prompts now, rather than upon the first handshake.
+            self._metadata()
         fast_api = fastapi.FastAPI()
         fast_api.include_router(self.api_router())
         agent_id = agent_id
@@ -146,6 +199,8 @@ class CodeShotAgent:
             fast_api.add_event_handler(
                 "startup", functools.partial(_ping_fixie_async, agent_id)
             )
+        fast_api.add_event_handler("shutdown", user_storage.close_async_session)
+        fast_api.add_event_handler("shutdown", oauth.close_async_sessions)
         return fast_api
 
     def api_router(self) -> fastapi.APIRouter:
@@ -191,15 +246,18 @@ class CodeShotAgent:
         self._funcs[name] = func
         return func
 
-    def _handshake(self) -> fastapi.Response:
-        """Returns the agent's metadata in YAML format."""
-        metadata = AgentMetadata(
+    def _metadata(self) -> AgentMetadata:
+        """Returns the agent's validated metadata."""
+        return AgentMetadata(
             self.base_prompt, self.few_shots, self.corpora, self.conversational
         )
-        yaml_content = yaml.dump(dataclasses.asdict(metadata))
+
+    def _handshake(self) -> fastapi.Response:
+        """Returns the agent's metadata in YAML format."""
+        yaml_content = yaml.dump(dataclasses.asdict(self._metadata()))
         return fastapi.Response(yaml_content, media_type="application/yaml")
 
-    def _serve_func(
+    async def _serve_func(
         self,
         func_name: str,
         query: api.AgentQuery,
@@ -210,8 +268,8 @@ class CodeShotAgent:
         """Verifies the request is a valid request from Fixie, and dispatches it to
         the appropriate function.
         """
-        token_claims = _VerifiedTokenClaims.from_token(
-            credentials.credentials, self._jwks_client
+        token_claims = await concurrency.run_in_threadpool(
+            _VerifiedTokenClaims.from_token, credentials.credentials, self._jwks_client
         )
         if token_claims is None:
             raise fastapi.HTTPException(status_code=403, detail="Invalid token")
@@ -229,10 +287,15 @@ class CodeShotAgent:
             raise fastapi.HTTPException(
                 status_code=404, detail=f"Func[{func_name}] doesn't exist"
             )
+        is_async = inspect.iscoroutinefunction(pyfunc)
         kwargs = self._get_func_kwargs(
-            query, token_claims, inspect.signature(pyfunc).parameters.keys()
+            query, token_claims, inspect.signature(pyfunc).parameters.keys(), is_async
         )
-        output = pyfunc(**kwargs)
+        if is_async:
+            # Async Funcs run on the event loop, so they must not block it.
+            output = await pyfunc(**kwargs)
+        else:
+            output = await concurrency.run_in_threadpool(_call_func, pyfunc, kwargs)
         try:
             return _wrap_with_agent_response(output)
         except TypeError:
@@ -245,19 +308,38 @@ class CodeShotAgent:
         query: api.AgentQuery,
         token_claims: _VerifiedTokenClaims,
         arg_names: Iterable[str],
+        is_async: bool = False,
     ) -> Dict[str, Any]:
         kwargs: Dict[str, Any] = {}
         for arg_name in arg_names:
             if arg_name == "query":
                 kwargs[arg_name] = query.message
+            elif arg_name == "user_storage" and is_async:
+                kwargs[arg_name] = user_storage.AsyncUserStorage(
+                    query, token_claims.agent_id
+                )
             elif arg_name == "user_storage":
                 kwargs[arg_name] = user_storage.UserStorage(
-                    query, token_claims.agent_id
+                    query,
+                    token_claims.agent_id,
+                    cache=True,
+                    user_id=token_claims.user_id,
+                )
+            elif arg_name == "oauth_handler" and is_async:
+                assert self.oauth_params, "oauth_params is not set"
+                kwargs[arg_name] = oauth.AsyncOAuthHandler(
+                    self.oauth_params,
+                    query,
+                    token_claims.agent_id,
+                    user_id=token_claims.user_id,
                 )
             elif arg_name == "oauth_handler":
                 assert self.oauth_params, "oauth_params is not set"
                 kwargs[arg_name] = oauth.OAuthHandler(
-                    self.oauth_params, query, token_claims.agent_id
+                    self.oauth_params,
+                    query,
+                    token_claims.agent_id,
+                    user_id=token_claims.user_id,
                 )
             else:
                 raise ValueError(f"Found unknown argument {arg_name!r}.")
@@ -269,6 +351,8 @@ class _VerifiedTokenClaims:
     """Verified claims from an agent token."""
 
     agent_id: str
+    # Tokens are per-query, but the user they're for is the same across queries.
+    user_id: Optional[str] = None
 
     @staticmethod
     def from_token(
@@ -291,7 +375,11 @@ class _VerifiedTokenClaims:
             # Agent id claim is required
             return None
 
-        return _VerifiedTokenClaims(agent_id=claims[_AGENT_ID_JWT_CLAIM])
+        user_id = claims.get(_USER_ID_JWT_CLAIM)
+        return _VerifiedTokenClaims(
+            agent_id=claims[_AGENT_ID_JWT_CLAIM],
+            user_id=user_id if isinstance(user_id, str) else None,
+        )
 
 
 def _oauth(query: api.Message, oauth_handler: oauth.OAuthHandler) -> str:
@@ -303,6 +391,15 @@ def _oauth(query: api.Message, oauth_handler: oauth.OAuthHandler) -> str:
     return "Authorization successful!"
 
 
+def _call_func(pyfunc: Callable, kwargs: Dict[str, Any]) -> Any:
+    """Calls a sync Func, then sends the writes buffered by its UserStorage."""
+    try:
+        return pyfunc(**kwargs)
+    finally:
+        if isinstance(kwargs.get("user_storage"), user_storage.UserStorage):
+            kwargs["user_storage"].flush()
+
+
 def _wrap_with_agent_response(
     value: Union[str, api.Message, api.AgentResponse]
 ) -> api.AgentResponse:
@@ -328,6 +425,32 @@ def _split_few_shots(few_shots: str) -> List[str]:
     return few_shot_splits
 
 
+def _load_few_shots(few_shots: Iterable[str]) -> List[str]:
+    """Normalizes few-shots one at a time as they are read.
+
+    Few-shots aren't validated here, so that `fixie agent validate` can import an agent
+    with bad few-shots and report all of them. They're validated when served.
+    """
+    return [utils._strip_all_lines(few_shot) for few_shot in few_shots]
+
+
+def _resolve_from_caller(path: str) -> str:
+    """Resolves a relative `path` against the directory of the module that's creating
+    a CodeShotAgent, falling back to the current directory."""
+    frame = inspect.currentframe()
+    # Skip this function's and CodeShotAgent.__init__'s frames, and those of any
+    # subclass constructors.
+    while frame is not None and (
+        frame.f_code in (_resolve_from_caller.__code__, CodeShotAgent.__init__.__code__)
+        or isinstance(frame.f_locals.get("self"), CodeShotAgent)
+    ):
+        frame = frame.f_back
+    module_file = frame.f_globals.get("__file__") if frame is not None else None
+    if not module_file:
+        return os.path.abspath(path)
+    return os.path.join(os.path.dirname(os.path.abspath(module_file)), path)
+
+
 def _ping_fixie_async(agent_id: str):
     """Asynchronously pings Fixie to refresh the given agent_id."""
     thread = threading.Thread(target=_ping_fixie_sync, args=(agent_id,))
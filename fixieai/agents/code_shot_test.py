@@ -1,13 +1,22 @@
 import dataclasses
+import json
+import os
+import re
+from typing import Any, Dict
 
 import fastapi
+import jwt
 import pytest
 import yaml
+from cryptography.hazmat.primitives.asymmetric import ed25519
 from fastapi import testclient
 
 import fixieai
 from fixieai import agents
+from fixieai import constants
 from fixieai.agents import code_shot
+from fixieai.agents import user_storage
+from fixieai.agents import user_storage_cache
 
 agent_id = "dummy"
 BASE_PROMPT = "I am a simple dummy agent."
@@ -29,6 +38,10 @@ CORPORA = [
 ]
 
 
+# The token verifier, which is mocked for all tests.
+_verify_token = code_shot._VerifiedTokenClaims.from_token
+
+
 @pytest.fixture(autouse=True)
 def mock_token_verifier(mocker):
     return mocker.patch.object(
@@ -272,3 +285,174 @@ def test_invalid_token(dummy_agent, mock_token_verifier):
         "/simple1", json={"message": {"text": "Howdy"}}, headers=headers
     )
     assert response.status_code == 403
+
+
+def test_few_shots_from_iterator():
+    few_shots = iter([" Q: Sample query\n  A: Simple final response "])
+    agent = agents.CodeShotAgent(BASE_PROMPT, few_shots)
+    assert agent.few_shots == ["Q: Sample query\nA: Simple final response"]
+
+    # Bad few-shots are only reported once the agent is served.
+    agent = agents.CodeShotAgent(BASE_PROMPT, iter(["A: Missing query"]))
+    with pytest.raises(ValueError):
+        agent.app()
+
+
+def test_lazy_few_shots_from_path(tmp_path):
+    path = tmp_path / "few_shots.jsonl"
+    path.write_text(
+        "\n".join(json.dumps(few_shot) for few_shot in FEW_SHOTS.split("\n\n"))
+    )
+    agent = agents.CodeShotAgent(
+        BASE_PROMPT, few_shots_path=str(path), lazy_few_shots=True
+    )
+    assert agent._few_shots is None
+
+    client = testclient.TestClient(agent.app())
+    response = client.get("/")
+    assert response.status_code == 200
+    yaml_content = yaml.load(response.content, Loader=yaml.Loader)
+    assert yaml_content["few_shots"] == code_shot._split_few_shots(FEW_SHOTS.strip())
+    assert agent.few_shots == yaml_content["few_shots"]
+
+
+def test_relative_few_shots_path_resolves_against_module(tmp_path, monkeypatch):
+    (tmp_path / "few_shots.jsonl").write_text(json.dumps(FEW_SHOTS.split("\n\n")[0]))
+    monkeypatch.chdir(os.path.dirname(__file__))
+    module_globals: Dict[str, Any] = {
+        "__file__": str(tmp_path / "main.py"),
+        "agents": agents,
+    }
+    exec(
+        "agent = agents.CodeShotAgent('A prompt.', few_shots_path='few_shots.jsonl')",
+        module_globals,
+    )
+    agent = module_globals["agent"]
+    assert agent.few_shots_path == str(tmp_path / "few_shots.jsonl")
+    assert len(agent.few_shots) == 1
+
+
+def test_few_shots_sources_are_exclusive(tmp_path):
+    with pytest.raises(ValueError):
+        agents.CodeShotAgent(BASE_PROMPT)
+    with pytest.raises(ValueError):
+        agents.CodeShotAgent(
+            BASE_PROMPT, FEW_SHOTS, few_shots_path=str(tmp_path / "x.jsonl")
+        )
+
+
+def test_user_storage_writes_flushed_after_func(dummy_agent, requests_mock):
+    storage_url = re.compile("^" + re.escape(constants.FIXIE_USER_STORAGE_URL) + "/")
+    requests_mock.get(storage_url, status_code=404)
+    requests_mock.post(storage_url, json={"msg": "success"})
+
+    @dummy_agent.register_func
+    def counter(query, user_storage):
+        user_storage["count"] = user_storage.get("count", 0) + 1
+        user_storage["last_query"] = query.text
+        assert requests_mock.call_count == 1
+        return "Counted"
+
+    fast_api = fastapi.FastAPI()
+    fast_api.include_router(dummy_agent.api_router())
+    client = testclient.TestClient(fast_api)
+    response = client.post(
+        "/counter",
+        json={"message": {"text": "Howdy"}},
+        headers={"Authorization": "Bearer fixie-test-token"},
+    )
+    assert response.status_code == 200
+    assert [r.method for r in requests_mock.request_history] == ["GET", "POST", "POST"]
+
+
+def test_verified_token_claims(mocker):
+    private_key = ed25519.Ed25519PrivateKey.generate()
+    jwks_client = mocker.Mock()
+    jwks_client.get_signing_key_from_jwt.return_value.key = private_key.public_key()
+    claims = {"aud": constants.FIXIE_AGENT_API_AUDIENCES[0], "aid": "fake agent id"}
+
+    token = jwt.encode({**claims, "sub": "fake user"}, private_key, "EdDSA")
+    assert _verify_token(token, jwks_client) == code_shot._VerifiedTokenClaims(
+        agent_id="fake agent id", user_id="fake user"
+    )
+    token = jwt.encode(claims, private_key, "EdDSA")
+    assert _verify_token(token, jwks_client) == code_shot._VerifiedTokenClaims(
+        agent_id="fake agent id"
+    )
+
+
+def test_func_user_storage_shares_the_cache_by_user(
+    dummy_agent, mock_token_verifier, monkeypatch
+):
+    monkeypatch.setattr(user_storage, "DEFAULT_SHARED_CACHE", True)
+    mock_token_verifier.return_value = code_shot._VerifiedTokenClaims(
+        agent_id="fake agent id", user_id="fake user"
+    )
+
+    @dummy_agent.register_func
+    def cached(query, user_storage):
+        assert isinstance(user_storage._backend, user_storage_cache.CachingBackend)
+        assert user_storage._backend.user_id == "fake user"
+        return "Cached"
+
+    fast_api = fastapi.FastAPI()
+    fast_api.include_router(dummy_agent.api_router())
+    client = testclient.TestClient(fast_api)
+    response = client.post(
+        "/cached",
+        json={"message": {"text": "Howdy"}},
+        headers={"Authorization": "Bearer fixie-test-token"},
+    )
+    assert response.status_code == 200
+
+
+def test_async_func_gets_async_user_storage(dummy_agent, mocker):
+    mocker.patch.object(
+        agents.AsyncUserStorage, "get", mocker.AsyncMock(return_value="stored")
+    )
+
+    @dummy_agent.register_func
+    async def reader(query, user_storage: agents.AsyncUserStorage) -> str:
+        assert isinstance(user_storage, agents.AsyncUserStorage)
+        return str(await user_storage.get(query.text))
+
+    fast_api = fastapi.FastAPI()
+    fast_api.include_router(dummy_agent.api_router())
+    client = testclient.TestClient(fast_api)
+    response = client.post(
+        "/reader",
+        json={"message": {"text": "key"}},
+        headers={"Authorization": "Bearer fixie-test-token"},
+    )
+    assert response.status_code == 200
+    assert response.json()["message"]["text"] == "stored"
+
+
+def test_async_func_gets_async_oauth_handler(dummy_agent, mocker):
+    mocker.patch.object(
+        agents.AsyncOAuthHandler, "user_token", mocker.AsyncMock(return_value="token")
+    )
+
+    @dummy_agent.register_func
+    async def authorized(query, oauth_handler: agents.AsyncOAuthHandler) -> str:
+        assert isinstance(oauth_handler, agents.AsyncOAuthHandler)
+        return str(await oauth_handler.user_token())
+
+    fast_api = fastapi.FastAPI()
+    fast_api.include_router(dummy_agent.api_router())
+    client = testclient.TestClient(fast_api)
+    response = client.post(
+        "/authorized",
+        json={"message": {"text": "key"}},
+        headers={"Authorization": "Bearer fixie-test-token"},
+    )
+    assert response.status_code == 200
+    assert response.json()["message"]["text"] == "token"
+
+
+def test_async_func_rejects_sync_user_storage_annotation(dummy_agent):
+    with pytest.raises(TypeError):
+
+        @dummy_agent.register_func
+        async def reader(query, user_storage: agents.UserStorage) -> str:
+            return ""
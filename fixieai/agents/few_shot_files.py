@@ -0,0 +1,75 @@
+"""Reads few-shots from JSONL or YAML data files, one few-shot at a time."""
+
+import json
+import os
+from typing import Any, Iterator
+
+import yaml
+
+JSONL_EXTENSIONS = (".jsonl", ".ndjson")
+YAML_EXTENSIONS = (".yaml", ".yml")
+
+# The key holding the few-shot text, when few-shots are given as objects.
+FEW_SHOT_KEY = "few_shot"
+
+
+def iter_few_shots(path: str) -> Iterator[str]:
+    """Streams few-shots from a JSONL or YAML file.
+
+    In a JSONL file, every non-empty line is a JSON string or a {"few_shot": str}
+    object. A YAML file holds one or more documents, each of which is a few-shot, a
+    list of few-shots, or a {"few_shot": str} object. Files are read incrementally, so
+    only the few-shots that have been yielded so far are kept in memory.
+
+    Args:
+        path: Path to the file. Its format is picked by extension.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension in JSONL_EXTENSIONS:
+        return _iter_jsonl_few_shots(path)
+    elif extension in YAML_EXTENSIONS:
+        return _iter_yaml_few_shots(path)
+    else:
+        raise ValueError(
+            f"Unsupported few-shots file {path!r}. Expected one of "
+            f"{JSONL_EXTENSIONS + YAML_EXTENSIONS}."
+        )
+
+
+def _iter_jsonl_few_shots(path: str) -> Iterator[str]:
+    with open(path, "r") as fp:
+        for line_number, line in enumerate(fp, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{path}:{line_number}: invalid JSON: {e}") from e
+            yield _few_shot_text(entry, f"{path}:{line_number}")
+
+
+def _iter_yaml_few_shots(path: str) -> Iterator[str]:
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    with open(path, "r") as fp:
+        for document_number, document in enumerate(
+            yaml.load_all(fp, Loader=loader), start=1
+        ):
+            location = f"{path}, document {document_number}"
+            if document is None:
+                continue
+            elif isinstance(document, list):
+                for entry in document:
+                    yield _few_shot_text(entry, location)
+            else:
+                yield _few_shot_text(document, location)
+
+
+def _few_shot_text(entry: Any, location: str) -> str:
+    if isinstance(entry, dict):
+        entry = entry.get(FEW_SHOT_KEY)
+    if not isinstance(entry, str):
+        raise ValueError(
+            f"{location}: expected a few-shot string or a {{{FEW_SHOT_KEY!r}: str}} "
+            f"object, got {entry!r}."
+        )
+    return entry
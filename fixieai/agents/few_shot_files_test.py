@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from fixieai.agents import few_shot_files
+
+FEW_SHOTS = [
+    "Q: Sample query 1\nAsk Func[simple]: Simple argument\n"
+    "Func[simple] says: Simple response\nA: Simple final response",
+    "Q: Sample query 2\nA: Simple final response",
+]
+
+
+def test_iter_few_shots_jsonl(tmp_path):
+    path = tmp_path / "few_shots.jsonl"
+    path.write_text(
+        json.dumps(FEW_SHOTS[0]) + "\n\n" + json.dumps({"few_shot": FEW_SHOTS[1]})
+    )
+    assert list(few_shot_files.iter_few_shots(str(path))) == FEW_SHOTS
+
+
+def test_iter_few_shots_yaml(tmp_path):
+    path = tmp_path / "few_shots.yaml"
+    path.write_text(
+        "---\n"
+        + json.dumps(FEW_SHOTS[0])
+        + "\n---\n"
+        + json.dumps([{"few_shot": FEW_SHOTS[1]}])
+    )
+    assert list(few_shot_files.iter_few_shots(str(path))) == FEW_SHOTS
+
+
+def test_iter_few_shots_bad_entry(tmp_path):
+    path = tmp_path / "few_shots.jsonl"
+    path.write_text(json.dumps(FEW_SHOTS[0]) + "\n" + json.dumps({"text": "Q: Hi"}))
+    with pytest.raises(ValueError, match="few_shots.jsonl:2"):
+        list(few_shot_files.iter_few_shots(str(path)))
+
+
+def test_iter_few_shots_unknown_extension(tmp_path):
+    with pytest.raises(ValueError):
+        few_shot_files.iter_few_shots(str(tmp_path / "few_shots.txt"))
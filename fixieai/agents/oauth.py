@@ -1,18 +1,49 @@
+import asyncio
+import collections
+import concurrent.futures
 import dataclasses
 import datetime
+import hashlib
 import json
 import logging
 import secrets
-from typing import Dict, List, Optional
+import threading
+import time
+import weakref
+from typing import Awaitable, Callable, Dict, List, MutableMapping, Optional, Tuple
 from urllib import parse
 
+import aiohttp
 import dataclasses_json
 import requests
+from urllib3.util import retry
 
 from fixieai import constants
 from fixieai.agents import api
 from fixieai.agents import user_storage
 
+# Tokens expiring within this long are refreshed in the background, ahead of time.
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+# Seconds after which cached credentials are read from UserStorage again, to see
+# changes made by other processes.
+TOKEN_CACHE_TTL = 300.0
+# Maximum number of credentials cached, beyond which the least recently used go.
+TOKEN_CACHE_MAX_ENTRIES = 10000
+# Number of threads refreshing tokens in the background.
+_MAX_BACKGROUND_REFRESHES = 4
+# Seconds to wait for the token endpoint to answer.
+TOKEN_REQUEST_TIMEOUT = 10.0
+# Number of times a token request is retried if the endpoint can't be reached, or is
+# briefly unavailable.
+TOKEN_REQUEST_RETRIES = 2
+# Seconds to wait before the first retry, doubled before each of the next ones.
+_RETRY_BACKOFF = 0.5
+# Statuses with which token endpoints, or gateways in front of them, turn requests
+# away. Gateways may have forwarded the request before failing.
+_RETRYABLE_STATUSES = (429, 502, 503, 504)
+# Statuses with which token endpoints turn requests away without processing them.
+_UNPROCESSED_STATUSES = (429, 503)
+
 
 @dataclasses.dataclass
 class OAuthParams:
@@ -54,6 +85,12 @@ class OAuthHandler:
     """
     OAuthHandler that wraps around a (OAuthParams, query) to authenticate.
 
+    Credentials are cached in-process, per agent and user, so that most calls to
+    `user_token` don't read UserStorage. Tokens close to expiring are refreshed in the
+    background, and concurrent refreshes of the same credentials are collapsed. Users
+    are told apart by `user_id`, verified from the query's access token, as it is for
+    Funcs; without it, credentials are only cached for queries with the same token.
+
     This client object provides 3 main method:
         * credentials: Returns current user's OAuth access token, or None if they are
             not authenticated.
@@ -72,51 +109,153 @@ class OAuthHandler:
         oauth_params: OAuthParams,
         query: api.AgentQuery,
         agent_id: str,
+        user_id: Optional[str] = None,
     ):
-        self._storage = user_storage.UserStorage(query, agent_id)
+        self._query = query
         self._oauth_params = oauth_params
         self._agent_id = agent_id
+        self._user_id = user_id
+        self._user_storage: Optional[user_storage.UserStorage] = None
+
+    @property
+    def _storage(self) -> user_storage.UserStorage:
+        # Made on first use, as most Func calls don't need it.
+        if self._user_storage is None:
+            self._user_storage = user_storage.UserStorage(
+                self._query, self._agent_id, user_id=self._user_id
+            )
+        return self._user_storage
 
     def get_authorization_url(self) -> str:
         """Returns a URL to launch the authorization flow."""
-        auth_state = f"{self._agent_id}:{secrets.token_urlsafe()}"
-        data = {
-            "response_type": "code",
-            "access_type": "offline",
-            "client_id": self._oauth_params.client_id,
-            "scope": " ".join(self._oauth_params.scopes),
-            "state": auth_state,
-            "redirect_uri": constants.FIXIE_OAUTH_REDIRECT_URL,
-        }
-        url = self._oauth_params.auth_uri + "?" + parse.urlencode(data)
+        auth_state, url = _make_authorization_url(self._oauth_params, self._agent_id)
         # Store auth_state in UserStorage for validation later.
         self._storage[self.OAUTH_STATE_KEY] = auth_state
         return url
 
     def user_token(self) -> Optional[str]:
         """Returns current user's OAuth credentials, or None if not authorized."""
+        cache_key = self._cache_key()
+        creds = _TOKEN_CACHE.get(cache_key)
+        if creds is None:
+            creds = self._load_credentials()
+            if creds is None:
+                return None
+            _TOKEN_CACHE.put(cache_key, creds)
+
+        if creds.expired:
+            logging.debug(f"Credentials expired at {creds.expiry}")
+            if not creds.refresh_token:
+                logging.warning("No refresh token available")
+                return None
+            logging.debug("Refreshing credentials...")
+            creds = _TOKEN_CACHE.refresh(cache_key, self._refresh_credentials).result()
+            if creds is None:
+                return None
+        elif creds.refresh_token and creds.expires_within(REFRESH_MARGIN):
+            logging.debug("Refreshing credentials in the background...")
+            _TOKEN_CACHE.refresh(cache_key, self._refresh_credentials)
+        return creds.access_token
+
+    def authorize(self, state: str, code: str):
+        """Authorize the received access `code` against the client secret.
+
+        If successful, the credentials will be saved in user storage.
+        """
+        _check_state(self._storage[self.OAUTH_STATE_KEY], state)
+        response = _send_authorize_request(
+            self._oauth_params.token_uri,
+            _authorization_code_data(self._oauth_params, code),
+        )
+        self._save_credentials(_OAuthCredentials.from_response(response))
+
+    def _save_credentials(self, credentials: "_OAuthCredentials"):
+        self._storage[self.OAUTH_TOKEN_KEY] = credentials.to_json()
+        _TOKEN_CACHE.put(self._cache_key(), credentials)
+
+    def _load_credentials(self) -> Optional["_OAuthCredentials"]:
+        """Reads the credentials from UserStorage, dropping them if invalid."""
         try:
             creds_json = self._storage[self.OAUTH_TOKEN_KEY]
         except KeyError:
             return None
-
-        if not isinstance(creds_json, str):
-            logging.warning(
-                f"Value at user_storage[{self.OAUTH_TOKEN_KEY!r}] is "
-                f"not an OAuthCredentials json: {creds_json!r}"
-            )
+        creds = _parse_credentials(creds_json)
+        if creds is None:
             del self._storage[self.OAUTH_TOKEN_KEY]
+        return creds
+
+    def _refresh_credentials(self) -> Optional["_OAuthCredentials"]:
+        """Refreshes and saves the credentials, unless they were refreshed elsewhere."""
+        # Start from the stored credentials, as another process may have refreshed
+        # them, possibly rotating the refresh token.
+        creds = self._load_credentials()
+        if creds is None or not creds.expires_within(REFRESH_MARGIN):
+            return creds
+        if not creds.refresh_token:
+            logging.warning("No refresh token available")
             return None
+        creds.refresh(self._oauth_params)
+        self._save_credentials(creds)  # Save refreshed token to UserStorage
+        return creds
 
-        try:
-            creds = _OAuthCredentials.from_json(creds_json)
-        except (TypeError, LookupError, ValueError):
-            logging.warning(
-                f"Value at user_storage[{self.OAUTH_TOKEN_KEY!r}] is "
-                f"not a valid _OAuthCredentials json: {creds_json!r}"
-            )
-            del self._storage[self.OAUTH_TOKEN_KEY]
-            return None
+    def _cache_key(self) -> "_TokenCacheKey":
+        return _make_cache_key(
+            self._oauth_params, self._query, self._agent_id, self._user_id
+        )
+
+
+class AsyncOAuthHandler:
+    """AsyncOAuthHandler is the asyncio counterpart of OAuthHandler, for async Funcs.
+
+    Its methods are coroutines, and requests to the token endpoint don't block the
+    event loop. They share a pool of connections per `token_uri`, time out after
+    `timeout` seconds, and are retried up to `retries` times if the endpoint can't be
+    reached or is briefly unavailable. Credentials are cached along with those of
+    OAuthHandler.
+
+    Usage:
+        @agent.register_func
+        async def func(query: fixieai.Message, oauth_handler: AsyncOAuthHandler) -> str:
+            token = await oauth_handler.user_token()
+            ...
+    """
+
+    OAUTH_STATE_KEY = OAuthHandler.OAUTH_STATE_KEY
+    OAUTH_TOKEN_KEY = OAuthHandler.OAUTH_TOKEN_KEY
+
+    def __init__(
+        self,
+        oauth_params: OAuthParams,
+        query: api.AgentQuery,
+        agent_id: str,
+        timeout: float = TOKEN_REQUEST_TIMEOUT,
+        retries: int = TOKEN_REQUEST_RETRIES,
+        user_id: Optional[str] = None,
+    ):
+        self._query = query
+        self._oauth_params = oauth_params
+        self._agent_id = agent_id
+        self._user_id = user_id
+        self._timeout = timeout
+        self._retries = retries
+        self._storage = user_storage.AsyncUserStorage(query, agent_id)
+
+    async def get_authorization_url(self) -> str:
+        """Returns a URL to launch the authorization flow."""
+        auth_state, url = _make_authorization_url(self._oauth_params, self._agent_id)
+        # Store auth_state in UserStorage for validation later.
+        await self._storage.set(self.OAUTH_STATE_KEY, auth_state)
+        return url
+
+    async def user_token(self) -> Optional[str]:
+        """Returns current user's OAuth credentials, or None if not authorized."""
+        cache_key = self._cache_key()
+        creds = _TOKEN_CACHE.get(cache_key)
+        if creds is None:
+            creds = await self._load_credentials()
+            if creds is None:
+                return None
+            _TOKEN_CACHE.put(cache_key, creds)
 
         if creds.expired:
             logging.debug(f"Credentials expired at {creds.expiry}")
@@ -124,43 +263,278 @@ class OAuthHandler:
                 logging.warning("No refresh token available")
                 return None
             logging.debug("Refreshing credentials...")
-            creds.refresh(self._oauth_params)
-            self._save_credentials(creds)  # Save refreshed token to UserStorage
+            creds = await _TOKEN_CACHE.refresh_async(
+                cache_key, self._refresh_credentials
+            )
+            if creds is None:
+                return None
+        elif creds.refresh_token and creds.expires_within(REFRESH_MARGIN):
+            logging.debug("Refreshing credentials in the background...")
+            _TOKEN_CACHE.refresh_async(cache_key, self._refresh_credentials)
         return creds.access_token
 
-    def authorize(self, state: str, code: str):
+    async def authorize(self, state: str, code: str):
         """Authorize the received access `code` against the client secret.
 
         If successful, the credentials will be saved in user storage.
         """
-        expected_state = self._storage[self.OAUTH_STATE_KEY]
-        if state != expected_state:
-            logging.warning(
-                f"Unknown state token, expected: {expected_state!r} actual: {state!r}"
-            )
-            raise ValueError(f"Unknown state token")
-
-        data = {
-            "grant_type": "authorization_code",
-            "client_id": self._oauth_params.client_id,
-            "client_secret": self._oauth_params.client_secret,
-            "code": code,
-            "redirect_uri": constants.FIXIE_OAUTH_REDIRECT_URL,
-        }
-        response = _send_authorize_request(self._oauth_params.token_uri, data)
-        logging.debug(
-            f"OAuth auth request succeeded, lifetime={response.expires_in} "
-            f"refreshable={response.refresh_token is not None}"
+        _check_state(await self._storage.get(self.OAUTH_STATE_KEY), state)
+        response = await _send_authorize_request_async(
+            self._oauth_params.token_uri,
+            _authorization_code_data(self._oauth_params, code),
+            self._timeout,
+            self._retries,
         )
-        credentials = _OAuthCredentials(
-            response.access_token,
-            _get_expiry(response.expires_in),
-            response.refresh_token,
+        await self._save_credentials(_OAuthCredentials.from_response(response))
+
+    async def _save_credentials(self, credentials: "_OAuthCredentials"):
+        await self._storage.set(self.OAUTH_TOKEN_KEY, credentials.to_json())
+        _TOKEN_CACHE.put(self._cache_key(), credentials)
+
+    async def _load_credentials(self) -> Optional["_OAuthCredentials"]:
+        """Reads the credentials from UserStorage, dropping them if invalid."""
+        creds_json = await self._storage.get(self.OAUTH_TOKEN_KEY)
+        if creds_json is None:
+            return None
+        creds = _parse_credentials(creds_json)
+        if creds is None:
+            await self._storage.delete(self.OAUTH_TOKEN_KEY)
+        return creds
+
+    async def _refresh_credentials(self) -> Optional["_OAuthCredentials"]:
+        """Refreshes and saves the credentials, unless they were refreshed elsewhere."""
+        creds = await self._load_credentials()
+        if creds is None or not creds.expires_within(REFRESH_MARGIN):
+            return creds
+        if not creds.refresh_token:
+            logging.warning("No refresh token available")
+            return None
+        response = await _send_authorize_request_async(
+            self._oauth_params.token_uri,
+            creds.refresh_data(self._oauth_params),
+            self._timeout,
+            self._retries,
         )
-        self._save_credentials(credentials)
+        creds.update(response)
+        await self._save_credentials(creds)
+        return creds
 
-    def _save_credentials(self, credentials: "_OAuthCredentials"):
-        self._storage[self.OAUTH_TOKEN_KEY] = credentials.to_json()
+    def _cache_key(self) -> "_TokenCacheKey":
+        return _make_cache_key(
+            self._oauth_params, self._query, self._agent_id, self._user_id
+        )
+
+
+def _make_authorization_url(
+    oauth_params: OAuthParams, agent_id: str
+) -> Tuple[str, str]:
+    """Returns a new auth state, and the URL to authorize with it."""
+    auth_state = f"{agent_id}:{secrets.token_urlsafe()}"
+    data = {
+        "response_type": "code",
+        "access_type": "offline",
+        "client_id": oauth_params.client_id,
+        "scope": " ".join(oauth_params.scopes),
+        "state": auth_state,
+        "redirect_uri": constants.FIXIE_OAUTH_REDIRECT_URL,
+    }
+    return auth_state, oauth_params.auth_uri + "?" + parse.urlencode(data)
+
+
+def _check_state(expected_state: user_storage.UserStorageType, state: str):
+    if state != expected_state:
+        logging.warning(
+            f"Unknown state token, expected: {expected_state!r} actual: {state!r}"
+        )
+        raise ValueError(f"Unknown state token")
+
+
+def _authorization_code_data(oauth_params: OAuthParams, code: str) -> Dict[str, str]:
+    return {
+        "grant_type": "authorization_code",
+        "client_id": oauth_params.client_id,
+        "client_secret": oauth_params.client_secret,
+        "code": code,
+        "redirect_uri": constants.FIXIE_OAUTH_REDIRECT_URL,
+    }
+
+
+def _parse_credentials(
+    creds_json: user_storage.UserStorageType,
+) -> Optional["_OAuthCredentials"]:
+    """Parses stored credentials, or returns None if they're invalid."""
+    if not isinstance(creds_json, str):
+        logging.warning(
+            f"Value at user_storage[{OAuthHandler.OAUTH_TOKEN_KEY!r}] is "
+            f"not an OAuthCredentials json: {creds_json!r}"
+        )
+        return None
+
+    try:
+        return _OAuthCredentials.from_json(creds_json)
+    except (TypeError, LookupError, ValueError):
+        logging.warning(
+            f"Value at user_storage[{OAuthHandler.OAUTH_TOKEN_KEY!r}] is "
+            f"not a valid _OAuthCredentials json: {creds_json!r}"
+        )
+        return None
+
+
+# (agent id, "user:" and the verified user ID, or "token:" and the SHA-256 of the
+# access token, client id, token uri)
+_TokenCacheKey = Tuple[str, str, str, str]
+# (credentials, time they were read from UserStorage)
+_TokenCacheEntry = Tuple["_OAuthCredentials", float]
+
+
+def _make_cache_key(
+    oauth_params: OAuthParams,
+    query: api.AgentQuery,
+    agent_id: str,
+    user_id: Optional[str],
+) -> _TokenCacheKey:
+    if user_id is not None:
+        user = f"user:{user_id}"
+    else:
+        # Tokens aren't verified here, so without a verified user, credentials are
+        # only shared by queries made with the very same token.
+        token = query.access_token or ""
+        user = f"token:{hashlib.sha256(token.encode('utf-8')).hexdigest()}"
+    return agent_id, user, oauth_params.client_id, oauth_params.token_uri
+
+
+class _TokenCache:
+    """A thread-safe LRU cache of OAuth credentials, which refreshes them in the
+    background, one refresh at a time per credentials."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Least recently used first.
+        self._entries: "collections.OrderedDict[_TokenCacheKey, _TokenCacheEntry]" = (
+            collections.OrderedDict()
+        )
+        self._refreshes: Dict[
+            _TokenCacheKey, "concurrent.futures.Future[Optional[_OAuthCredentials]]"
+        ] = {}
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # Refreshes by async handlers, which run on the event loop they started on.
+        self._async_refreshes: Dict[
+            Tuple[asyncio.AbstractEventLoop, _TokenCacheKey],
+            "asyncio.Task[Optional[_OAuthCredentials]]",
+        ] = {}
+
+    def get(self, key: _TokenCacheKey) -> Optional["_OAuthCredentials"]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if _is_expired(entry):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: _TokenCacheKey, creds: Optional["_OAuthCredentials"]):
+        with self._lock:
+            if creds is None:
+                self._entries.pop(key, None)
+            else:
+                self._entries[key] = (creds, time.monotonic())
+                self._entries.move_to_end(key)
+            # Drop the least recently used entries beyond the limit, and expired ones.
+            while self._entries:
+                full = len(self._entries) > TOKEN_CACHE_MAX_ENTRIES
+                if not full and not _is_expired(next(iter(self._entries.values()))):
+                    break
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def refresh(
+        self,
+        key: _TokenCacheKey,
+        refresh: Callable[[], Optional["_OAuthCredentials"]],
+    ) -> "concurrent.futures.Future[Optional[_OAuthCredentials]]":
+        """Calls `refresh` in the background to update the credentials at `key`,
+        unless they are already being refreshed, and returns the pending result."""
+        with self._lock:
+            future = self._refreshes.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = concurrent.futures.ThreadPoolExecutor(
+                        _MAX_BACKGROUND_REFRESHES, thread_name_prefix="oauth-refresh"
+                    )
+                future = self._refreshes[key] = self._executor.submit(
+                    self._refresh, key, refresh
+                )
+        return future
+
+    def _refresh(
+        self,
+        key: _TokenCacheKey,
+        refresh: Callable[[], Optional["_OAuthCredentials"]],
+    ) -> Optional["_OAuthCredentials"]:
+        try:
+            creds = refresh()
+            self.put(key, creds)
+            return creds
+        except Exception:
+            logging.exception("Failed to refresh OAuth credentials")
+            raise
+        finally:
+            with self._lock:
+                del self._refreshes[key]
+
+    def refresh_async(
+        self,
+        key: _TokenCacheKey,
+        refresh: Callable[[], Awaitable[Optional["_OAuthCredentials"]]],
+    ) -> "asyncio.Task[Optional[_OAuthCredentials]]":
+        """Runs `refresh` in a task on the current event loop to update the credentials
+        at `key`, unless they are already being refreshed on it, and returns the
+        task."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            task = self._async_refreshes.get((loop, key))
+            if task is None:
+                task = self._async_refreshes[(loop, key)] = loop.create_task(
+                    self._refresh_async(loop, key, refresh)
+                )
+                # Failures are logged, whether anyone awaits the refresh or not.
+                task.add_done_callback(
+                    lambda task: task.cancelled() or task.exception()
+                )
+        return task
+
+    async def _refresh_async(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        key: _TokenCacheKey,
+        refresh: Callable[[], Awaitable[Optional["_OAuthCredentials"]]],
+    ) -> Optional["_OAuthCredentials"]:
+        try:
+            creds = await refresh()
+            self.put(key, creds)
+            return creds
+        except Exception:
+            logging.exception("Failed to refresh OAuth credentials")
+            raise
+        finally:
+            with self._lock:
+                del self._async_refreshes[(loop, key)]
+
+
+def _is_expired(entry: _TokenCacheEntry) -> bool:
+    return time.monotonic() - entry[1] > TOKEN_CACHE_TTL
+
+
+# The credentials cache shared by all handlers of the process.
+_TOKEN_CACHE = _TokenCache()
 
 
 def _encode_iso_format(value: Optional[datetime.datetime]) -> Optional[str]:
@@ -193,25 +567,55 @@ class _OAuthCredentials(dataclasses_json.DataClassJsonMixin):
     @property
     def expired(self) -> bool:
         """Whether the credentials have expired."""
-        return self.expiry is not None and datetime.datetime.utcnow() > self.expiry
+        return self.expires_within(datetime.timedelta())
+
+    def expires_within(self, delta: datetime.timedelta) -> bool:
+        """Whether the credentials expire within `delta` from now."""
+        return (
+            self.expiry is not None and datetime.datetime.utcnow() + delta > self.expiry
+        )
+
+    @classmethod
+    def from_response(cls, response: "_OAuthTokenResponse") -> "_OAuthCredentials":
+        """Makes credentials from the response to an authorization code exchange."""
+        logging.debug(
+            f"OAuth auth request succeeded, lifetime={response.expires_in} "
+            f"refreshable={response.refresh_token is not None}"
+        )
+        return cls(
+            response.access_token,
+            _get_expiry(response.expires_in),
+            response.refresh_token,
+        )
 
     def refresh(self, oauth_params: OAuthParams):
         """Refreshes the access token."""
+        response = _send_authorize_request(
+            oauth_params.token_uri, self.refresh_data(oauth_params)
+        )
+        self.update(response)
+
+    def refresh_data(self, oauth_params: OAuthParams) -> Dict[str, str]:
+        """Returns the form to POST to the token endpoint to refresh the token."""
         if not self.refresh_token:
             raise ValueError("Cannot refresh without a refresh token")
-
-        data = {
+        return {
             "grant_type": "refresh_token",
             "client_id": oauth_params.client_id,
             "client_secret": oauth_params.client_secret,
             "refresh_token": self.refresh_token,
         }
-        response = _send_authorize_request(oauth_params.token_uri, data)
+
+    def update(self, response: "_OAuthTokenResponse"):
+        """Updates the credentials from the response to a refresh request."""
         logging.debug(
             f"OAuth refresh request succeeded, lifetime={response.expires_in}"
         )
         self.access_token = response.access_token
         self.expiry = _get_expiry(response.expires_in)
+        # Some endpoints rotate refresh tokens.
+        if response.refresh_token:
+            self.refresh_token = response.refresh_token
 
 
 @dataclasses.dataclass
@@ -227,14 +631,56 @@ class _OAuthTokenResponse(dataclasses_json.DataClassJsonMixin):
 
 def _send_authorize_request(uri: str, data: Dict[str, str]) -> _OAuthTokenResponse:
     """POSTs `data` to `uri` and parses the output as an OAuthTokenResponse."""
-    response = requests.post(uri, data=data)
+    response = _get_token_session(uri, _retryable_statuses(data)).post(
+        uri, data=data, timeout=TOKEN_REQUEST_TIMEOUT
+    )
     response.raise_for_status()
-    content_type = response.headers["Content-Type"].split(";")[0].strip()
+    return _parse_token_response(response.headers["Content-Type"], response.text)
+
+
+async def _send_authorize_request_async(
+    uri: str, data: Dict[str, str], timeout: float, retries: int
+) -> _OAuthTokenResponse:
+    """POSTs `data` to `uri` and parses the output as an OAuthTokenResponse, retrying
+    up to `retries` times on transient errors."""
+    session = _get_async_token_session(uri)
+    retryable_statuses = _retryable_statuses(data)
+    attempt = 0
+    while True:
+        try:
+            async with session.post(
+                uri, data=data, timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status not in retryable_statuses or attempt >= retries:
+                    response.raise_for_status()
+                    return _parse_token_response(
+                        response.headers["Content-Type"], await response.text()
+                    )
+        # Requests that timed out aren't retried, as they may have been processed,
+        # and authorization codes can only be exchanged once.
+        except aiohttp.ClientConnectorError:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(_RETRY_BACKOFF * 2**attempt)
+        attempt += 1
+
+
+def _retryable_statuses(data: Dict[str, str]) -> Tuple[int, ...]:
+    """Returns the statuses with which a token request sending `data` is retried."""
+    if data.get("grant_type") == "authorization_code":
+        # Authorization codes can only be exchanged once, so requests that may have
+        # been forwarded by a gateway aren't retried.
+        return _UNPROCESSED_STATUSES
+    return _RETRYABLE_STATUSES
+
+
+def _parse_token_response(content_type: str, text: str) -> _OAuthTokenResponse:
+    content_type = content_type.split(";")[0].strip()
     if content_type == "application/json":
-        response_dict = response.json()
+        response_dict = json.loads(text)
     elif content_type == "application/x-www-form-urlencoded":
         # urllib parses form data into a list for each key, even if there's only one value.
-        response_dict = {k: v[0] for k, v in parse.parse_qs(response.text).items()}
+        response_dict = {k: v[0] for k, v in parse.parse_qs(text).items()}
     else:
         raise ValueError(f"Unexpected response content type: {content_type}")
     if "error" in response_dict:
@@ -242,6 +688,58 @@ def _send_authorize_request(uri: str, data: Dict[str, str]) -> _OAuthTokenRespon
     return _OAuthTokenResponse.from_dict(response_dict)
 
 
+# Sessions, and their connection pools, by token endpoint and retried statuses.
+_token_sessions: Dict[Tuple[str, Tuple[int, ...]], requests.Session] = {}
+_token_sessions_lock = threading.Lock()
+
+
+def _get_token_session(
+    uri: str, retryable_statuses: Tuple[int, ...]
+) -> requests.Session:
+    with _token_sessions_lock:
+        session = _token_sessions.get((uri, retryable_statuses))
+        if session is None:
+            session = _token_sessions[(uri, retryable_statuses)] = requests.Session()
+            # Only retry requests that weren't processed, see
+            # _send_authorize_request_async.
+            adapter = requests.adapters.HTTPAdapter(
+                max_retries=retry.Retry(
+                    total=TOKEN_REQUEST_RETRIES,
+                    read=0,
+                    status_forcelist=retryable_statuses,
+                    allowed_methods=None,
+                    backoff_factor=_RETRY_BACKOFF,
+                    raise_on_status=False,
+                )
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+    return session
+
+
+# aiohttp sessions by event loop, then by token endpoint.
+_async_token_sessions: MutableMapping[
+    asyncio.AbstractEventLoop, Dict[str, aiohttp.ClientSession]
+] = weakref.WeakKeyDictionary()
+
+
+def _get_async_token_session(uri: str) -> aiohttp.ClientSession:
+    sessions = _async_token_sessions.setdefault(asyncio.get_running_loop(), {})
+    session = sessions.get(uri)
+    if session is None or session.closed:
+        session = sessions[uri] = aiohttp.ClientSession(
+            cookie_jar=aiohttp.DummyCookieJar()
+        )
+    return session
+
+
+async def close_async_sessions():
+    """Closes the connections to token endpoints made on the current loop."""
+    sessions = _async_token_sessions.pop(asyncio.get_running_loop(), {})
+    for session in sessions.values():
+        await session.close()
+
+
 def _get_expiry(expires_in_seconds: Optional[int]) -> Optional[datetime.datetime]:
     """Returns the absolute expiration datetime from a relative expires_in_seconds."""
     if expires_in_seconds is None:
@@ -0,0 +1,321 @@
+import asyncio
+import concurrent.futures
+import datetime
+import http.server
+import json
+import threading
+import time
+from typing import List
+
+import aiohttp
+import jwt
+import pytest
+import requests
+
+from fixieai.agents import api
+from fixieai.agents import oauth
+from fixieai.agents import user_storage
+
+TOKEN_URI = "https://oauth.example.com/token"
+OAUTH_PARAMS = oauth.OAuthParams(
+    client_id="client",
+    client_secret="secret",
+    auth_uri="https://oauth.example.com/auth",
+    token_uri=TOKEN_URI,
+    scopes=["scope"],
+)
+AGENT_ID = "fake-agent-id"
+
+
+@pytest.fixture(autouse=True)
+def local_backend(monkeypatch, tmp_path):
+    monkeypatch.setenv(user_storage.BACKEND_ENV_VAR, f"sqlite:{tmp_path / 'db'}")
+    oauth._TOKEN_CACHE.clear()
+    yield
+    oauth._TOKEN_CACHE.clear()
+
+
+@pytest.fixture
+def token_endpoint(requests_mock):
+    def respond(request, context):
+        time.sleep(0.05)
+        return {
+            "access_token": "refreshed",
+            "scope": "scope",
+            "token_type": "Bearer",
+            "expires_in": 3600,
+        }
+
+    return requests_mock.post(
+        TOKEN_URI, json=respond, headers={"Content-Type": "application/json"}
+    )
+
+
+class _TokenServer:
+    """Serves a token endpoint, answering with `statuses` first, then with 200."""
+
+    def __init__(self):
+        self.statuses: List[int] = []
+        self.latency = 0.0
+        self.forms: List[str] = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                length = int(self.headers["Content-Length"])
+                server.forms.append(self.rfile.read(length).decode())
+                time.sleep(server.latency)
+                status = server.statuses.pop(0) if server.statuses else 200
+                content = json.dumps(
+                    {
+                        "access_token": f"token{len(server.forms)}",
+                        "scope": "scope",
+                        "token_type": "Bearer",
+                        "expires_in": 3600,
+                    }
+                ).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                except ConnectionError:
+                    pass  # The client timed out.
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.params = oauth.OAuthParams(
+            client_id="client",
+            client_secret="secret",
+            auth_uri="https://oauth.example.com/auth",
+            token_uri=f"http://127.0.0.1:{self._server.server_address[1]}/token",
+            scopes=["scope"],
+        )
+        threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@pytest.fixture
+def token_server(monkeypatch):
+    monkeypatch.setattr(oauth, "_RETRY_BACKOFF", 0.0)
+    server = _TokenServer()
+    yield server
+    server.stop()
+
+
+def _async_handler(params: oauth.OAuthParams, **kwargs) -> oauth.AsyncOAuthHandler:
+    query = api.AgentQuery(message=api.Message("query"), access_token="user-token")
+    return oauth.AsyncOAuthHandler(params, query, AGENT_ID, **kwargs)
+
+
+def _handler() -> oauth.OAuthHandler:
+    query = api.AgentQuery(message=api.Message("query"), access_token="user-token")
+    return oauth.OAuthHandler(OAUTH_PARAMS, query, AGENT_ID)
+
+
+def _store_credentials(expires_in: datetime.timedelta):
+    credentials = oauth._OAuthCredentials(
+        "stored", datetime.datetime.utcnow() + expires_in, "refresh-token"
+    )
+    _handler()._save_credentials(credentials)
+    oauth._TOKEN_CACHE.clear()
+
+
+def test_user_token_is_cached(mocker):
+    _store_credentials(datetime.timedelta(hours=1))
+    load = mocker.spy(oauth.OAuthHandler, "_load_credentials")
+    assert _handler().user_token() == "stored"
+    assert _handler().user_token() == "stored"
+    assert load.call_count == 1
+
+
+def test_user_token_without_credentials():
+    assert _handler().user_token() is None
+    _handler()._storage[oauth.OAuthHandler.OAUTH_TOKEN_KEY] = "not json"
+    assert _handler().user_token() is None
+    assert oauth.OAuthHandler.OAUTH_TOKEN_KEY not in _handler()._storage
+
+
+def test_expiring_token_is_refreshed_in_background(token_endpoint):
+    _store_credentials(datetime.timedelta(minutes=1))
+    # The current token is still valid, so it's returned right away.
+    assert _handler().user_token() == "stored"
+    for _ in range(100):
+        if _handler().user_token() == "refreshed":
+            break
+        time.sleep(0.01)
+    assert _handler().user_token() == "refreshed"
+    assert token_endpoint.call_count == 1
+
+    oauth._TOKEN_CACHE.clear()
+    assert _handler().user_token() == "refreshed"
+
+
+def test_concurrent_refreshes_are_collapsed(token_endpoint):
+    _store_credentials(datetime.timedelta(minutes=-1))
+    with concurrent.futures.ThreadPoolExecutor(10) as executor:
+        tokens = list(executor.map(lambda _: _handler().user_token(), range(10)))
+    assert tokens == ["refreshed"] * 10
+    assert token_endpoint.call_count == 1
+
+
+def test_credentials_refreshed_elsewhere_are_reused(token_endpoint):
+    _store_credentials(datetime.timedelta(minutes=-1))
+    assert _handler().user_token() == "refreshed"
+    # Another process refreshed the token, so there's no need to refresh it again.
+    _store_credentials(datetime.timedelta(hours=1))
+    oauth._TOKEN_CACHE.put(
+        _handler()._cache_key(),
+        oauth._OAuthCredentials("expired", datetime.datetime.utcnow(), "refresh-token"),
+    )
+    assert _handler().user_token() == "stored"
+    assert token_endpoint.call_count == 1
+
+
+def test_token_cache_is_keyed_on_the_verified_user(mocker):
+    def handler(access_token, user_id=None):
+        query = api.AgentQuery(message=api.Message("query"), access_token=access_token)
+        return oauth.OAuthHandler(OAUTH_PARAMS, query, AGENT_ID, user_id=user_id)
+
+    # Per-query tokens of the same user.
+    tokens = [jwt.encode({"sub": "user", "n": n}, "a" * 32) for n in (1, 2)]
+    credentials = oauth._OAuthCredentials(
+        "stored", datetime.datetime.utcnow() + datetime.timedelta(hours=1), None
+    )
+    oauth._TOKEN_CACHE.put(handler(tokens[0], "user")._cache_key(), credentials)
+    load = mocker.patch.object(oauth.OAuthHandler, "_load_credentials")
+    assert handler(tokens[1], "user").user_token() == "stored"
+    assert load.call_count == 0
+
+    # Without a verified user, credentials are only shared by the same token.
+    assert handler(tokens[0])._cache_key() == handler(tokens[0])._cache_key()
+    assert handler(tokens[0])._cache_key() != handler(tokens[1])._cache_key()
+    assert handler(tokens[0])._cache_key() != handler(tokens[0], "user")._cache_key()
+    assert tokens[0] not in handler(tokens[0])._cache_key()
+
+
+def test_token_cache_evicts_entries(monkeypatch):
+    monkeypatch.setattr(oauth, "TOKEN_CACHE_MAX_ENTRIES", 2)
+    cache = oauth._TokenCache()
+    creds = oauth._OAuthCredentials("token", None, None)
+    cache.put(("a", "", "", ""), creds)
+    cache.put(("b", "", "", ""), creds)
+    assert cache.get(("a", "", "", "")) is creds
+    cache.put(("c", "", "", ""), creds)
+    # "b" was the least recently used.
+    assert cache.get(("b", "", "", "")) is None
+    assert len(cache) == 2
+
+    monkeypatch.setattr(oauth, "TOKEN_CACHE_TTL", -1)
+    assert cache.get(("a", "", "", "")) is None
+    assert len(cache) == 1
+    cache.put(("d", "", "", ""), None)
+    assert len(cache) == 0
+
+
+def test_async_authorize(token_server):
+    async def run():
+        handler = _async_handler(token_server.params)
+        url = await handler.get_authorization_url()
+        state = await handler._storage.get(oauth.AsyncOAuthHandler.OAUTH_STATE_KEY)
+        assert isinstance(state, str) and "state=" in url
+        with pytest.raises(ValueError):
+            await handler.authorize("wrong state", "code")
+        await handler.authorize(state, "code")
+        oauth._TOKEN_CACHE.clear()
+        assert await _async_handler(token_server.params).user_token() == "token1"
+        await oauth.close_async_sessions()
+
+    asyncio.run(run())
+    assert "grant_type=authorization_code" in token_server.forms[0]
+
+
+def _exchange_code(token_server, status: int, is_async: bool):
+    token_server.statuses = [status]
+    data = oauth._authorization_code_data(token_server.params, "code")
+    uri = token_server.params.token_uri
+    if not is_async:
+        oauth._send_authorize_request(uri, data)
+        return
+
+    async def run():
+        try:
+            await oauth._send_authorize_request_async(uri, data, 1.0, retries=2)
+        finally:
+            await oauth.close_async_sessions()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+@pytest.mark.parametrize("status", [502, 504])
+def test_authorization_code_isnt_retried_after_gateway_errors(
+    token_server, status, is_async
+):
+    # The gateway may have forwarded the request, which used up the code.
+    with pytest.raises((requests.HTTPError, aiohttp.ClientResponseError)):
+        _exchange_code(token_server, status, is_async)
+    assert len(token_server.forms) == 1
+
+
+@pytest.mark.parametrize("is_async", [False, True])
+def test_authorization_code_is_retried_when_unavailable(token_server, is_async):
+    _exchange_code(token_server, 503, is_async)
+    assert len(token_server.forms) == 2
+
+
+def test_async_refresh_retries_transient_errors(token_server):
+    _store_credentials(datetime.timedelta(minutes=-1))
+    token_server.statuses = [503, 502]
+
+    async def run():
+        handlers = [_async_handler(token_server.params) for _ in range(10)]
+        tokens = await asyncio.gather(*(handler.user_token() for handler in handlers))
+        await oauth.close_async_sessions()
+        return tokens
+
+    # The refreshes are collapsed into one, which succeeds on its third attempt.
+    assert asyncio.run(run()) == ["token3"] * 10
+    assert len(token_server.forms) == 3
+    assert "grant_type=refresh_token" in token_server.forms[0]
+
+
+def test_async_refresh_gives_up(token_server):
+    _store_credentials(datetime.timedelta(minutes=-1))
+    token_server.statuses = [503, 503]
+
+    async def run():
+        try:
+            await _async_handler(token_server.params, retries=1).user_token()
+        finally:
+            await oauth.close_async_sessions()
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        asyncio.run(run())
+    assert len(token_server.forms) == 2
+
+
+def test_async_refresh_times_out(token_server):
+    _store_credentials(datetime.timedelta(minutes=-1))
+    token_server.latency = 0.5
+
+    async def run():
+        try:
+            await _async_handler(token_server.params, timeout=0.1).user_token()
+        finally:
+            await oauth.close_async_sessions()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(run())
+    # Requests that timed out aren't retried.
+    assert len(token_server.forms) == 1
@@ -0,0 +1,215 @@
+"""Token-budget analysis and deduplication of an agent's base prompt and few-shots.
+
+Usage:
+    analysis = prompt_analysis.analyze_agent(agent)
+    print(analysis.total_tokens, analysis.exact_duplicates, analysis.covering_subset)
+
+Token counts are estimated with a local tokenizer, which can be swapped for the one of
+your choice, e.g., with tiktoken:
+
+    encoding = tiktoken.get_encoding("cl100k_base")
+    analysis = prompt_analysis.analyze_agent(
+        agent, token_counter=lambda text: len(encoding.encode(text))
+    )
+"""
+
+from __future__ import annotations
+
+import collections
+import dataclasses
+import re
+import zlib
+from typing import TYPE_CHECKING, Callable, Dict, List, Sequence, Set, Tuple
+
+from fixieai.agents import utils
+
+if TYPE_CHECKING:
+    from fixieai.agents import code_shot
+
+# Counts the tokens in a piece of text.
+TokenCounter = Callable[[str], int]
+
+# Regex that extracts the "Ask Func[name]" or "Ask Agent[name]" part of a line.
+_ASK_RE = re.compile(r"^(Ask (?:Func|Agent)\[\w+])")
+# Regex that approximates how BPE tokenizers split text: words and single symbols.
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+# Words longer than this are usually split into several tokens.
+_CHARS_PER_WORD_TOKEN = 6
+
+# MinHash parameters. Signatures are split into _BANDS bands of _ROWS rows each for
+# locality-sensitive hashing of candidate near-duplicate pairs.
+_SHINGLE_SIZE = 3
+_BANDS = 16
+_ROWS = 4
+_MERSENNE_PRIME = (1 << 61) - 1
+_MINHASH_SEEDS = [
+    (
+        zlib.crc32(f"a{i}".encode()) * 2654435761 % _MERSENNE_PRIME | 1,
+        zlib.crc32(f"b{i}".encode()) * 40503 % _MERSENNE_PRIME,
+    )
+    for i in range(_BANDS * _ROWS)
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of tokens in `text` without an external tokenizer."""
+    return sum(
+        1 + (len(word) - 1) // _CHARS_PER_WORD_TOKEN for word in _TOKEN_RE.findall(text)
+    )
+
+
+@dataclasses.dataclass
+class PromptAnalysis:
+    """The result of analyzing an agent's prompts."""
+
+    base_prompt_tokens: int
+    # Token count of each few-shot, by index.
+    few_shot_tokens: List[int]
+    # The "Ask Func[x]" and "Ask Agent[x]" patterns used by each few-shot, by index.
+    few_shot_patterns: List[List[str]]
+    # Groups of indices of few-shots that are identical once stripped.
+    exact_duplicates: List[List[int]]
+    # (index, index, estimated Jaccard similarity) of similar, non-identical few-shots.
+    near_duplicates: List[Tuple[int, int, float]]
+    # Indices of a small set of few-shots that uses every pattern any few-shot uses.
+    covering_subset: List[int]
+
+    @property
+    def total_tokens(self) -> int:
+        """Estimated tokens of the base prompt and all few-shots."""
+        return self.base_prompt_tokens + sum(self.few_shot_tokens)
+
+    @property
+    def covering_subset_tokens(self) -> int:
+        """Estimated tokens of the base prompt and the covering subset of few-shots."""
+        return self.base_prompt_tokens + sum(
+            self.few_shot_tokens[i] for i in self.covering_subset
+        )
+
+
+def analyze_agent(
+    agent: code_shot.CodeShotAgent,
+    token_counter: TokenCounter = estimate_tokens,
+    similarity_threshold: float = 0.8,
+) -> PromptAnalysis:
+    """Analyzes the base prompt and few-shots of `agent`.
+
+    See `analyze_prompts` for the arguments.
+    """
+    return analyze_prompts(
+        agent.base_prompt, agent.few_shots, token_counter, similarity_threshold
+    )
+
+
+def analyze_prompts(
+    base_prompt: str,
+    few_shots: Sequence[str],
+    token_counter: TokenCounter = estimate_tokens,
+    similarity_threshold: float = 0.8,
+) -> PromptAnalysis:
+    """Analyzes a base prompt and its few-shots.
+
+    Args:
+        base_prompt: The agent's base prompt.
+        few_shots: The agent's few-shots.
+        token_counter: Counts the tokens in a piece of text. Defaults to a local
+            estimate.
+        similarity_threshold: Minimum estimated Jaccard similarity of word shingles
+            for two few-shots to be reported as near-duplicates.
+    """
+    few_shots = [utils._strip_all_lines(few_shot) for few_shot in few_shots]
+    few_shot_patterns = [_ask_patterns(few_shot) for few_shot in few_shots]
+    few_shot_tokens = [token_counter(few_shot) for few_shot in few_shots]
+    exact_duplicates = _find_exact_duplicates(few_shots)
+    duplicate_indices = {i for group in exact_duplicates for i in group[1:]}
+    return PromptAnalysis(
+        base_prompt_tokens=token_counter(utils._strip_all_lines(base_prompt)),
+        few_shot_tokens=few_shot_tokens,
+        few_shot_patterns=few_shot_patterns,
+        exact_duplicates=exact_duplicates,
+        near_duplicates=_find_near_duplicates(
+            few_shots, duplicate_indices, similarity_threshold
+        ),
+        covering_subset=_find_covering_subset(few_shot_patterns, few_shot_tokens),
+    )
+
+
+def _ask_patterns(few_shot: str) -> List[str]:
+    patterns = []
+    for line in few_shot.splitlines():
+        match = _ASK_RE.match(line)
+        if match and match.group(1) not in patterns:
+            patterns.append(match.group(1))
+    return patterns
+
+
+def _find_exact_duplicates(few_shots: Sequence[str]) -> List[List[int]]:
+    indices_by_few_shot: Dict[str, List[int]] = collections.defaultdict(list)
+    for i, few_shot in enumerate(few_shots):
+        indices_by_few_shot[few_shot].append(i)
+    return [indices for indices in indices_by_few_shot.values() if len(indices) > 1]
+
+
+def _find_near_duplicates(
+    few_shots: Sequence[str], skip: Set[int], threshold: float
+) -> List[Tuple[int, int, float]]:
+    signatures = {
+        i: _minhash(few_shot)
+        for i, few_shot in enumerate(few_shots)
+        if i not in skip and few_shot
+    }
+
+    # Few-shots that share all rows of any band are candidate pairs.
+    candidates: Set[Tuple[int, int]] = set()
+    for band in range(_BANDS):
+        buckets: Dict[Tuple[int, ...], List[int]] = collections.defaultdict(list)
+        for i, signature in signatures.items():
+            buckets[tuple(signature[band * _ROWS : (band + 1) * _ROWS])].append(i)
+        for bucket in buckets.values():
+            for j, first in enumerate(bucket):
+                for second in bucket[j + 1 :]:
+                    candidates.add((first, second))
+
+    near_duplicates = []
+    for first, second in sorted(candidates):
+        if few_shots[first] == few_shots[second]:
+            continue
+        similarity = sum(
+            a == b for a, b in zip(signatures[first], signatures[second])
+        ) / len(_MINHASH_SEEDS)
+        if similarity >= threshold:
+            near_duplicates.append((first, second, similarity))
+    return near_duplicates
+
+
+def _minhash(text: str) -> List[int]:
+    words = text.lower().split()
+    shingle_hashes = {
+        zlib.crc32(" ".join(words[i : i + _SHINGLE_SIZE]).encode("utf-8"))
+        for i in range(max(1, len(words) - _SHINGLE_SIZE + 1))
+    }
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in shingle_hashes)
+        for a, b in _MINHASH_SEEDS
+    ]
+
+
+def _find_covering_subset(
+    few_shot_patterns: Sequence[Sequence[str]], few_shot_tokens: Sequence[int]
+) -> List[int]:
+    """Greedily picks few-shots until every pattern is used, preferring few-shots that
+    add the most new patterns per token."""
+    uncovered = {pattern for patterns in few_shot_patterns for pattern in patterns}
+    subset: List[int] = []
+    while uncovered:
+        best = max(
+            range(len(few_shot_patterns)),
+            key=lambda i: (
+                len(uncovered.intersection(few_shot_patterns[i]))
+                / max(1, few_shot_tokens[i]),
+                -i,
+            ),
+        )
+        subset.append(best)
+        uncovered.difference_update(few_shot_patterns[best])
+    return sorted(subset)
@@ -0,0 +1,58 @@
+from fixieai.agents import prompt_analysis
+
+BASE_PROMPT = "I am a simple dummy agent."
+FEW_SHOTS = [
+    """Q: What is the weather in Seattle today?
+Ask Func[weather]: Seattle
+Func[weather] says: Rainy, 12C
+A: It's rainy and 12C in Seattle.""",
+    # Identical to the first one, once stripped.
+    """  Q: What is the weather in Seattle today?
+Ask Func[weather]: Seattle
+Func[weather] says: Rainy, 12C
+A: It's rainy and 12C in Seattle.  """,
+    # Nearly identical to the first one.
+    """Q: What is the weather in Seattle today?
+Ask Func[weather]: Seattle
+Func[weather] says: Rainy, 12C
+A: It's rainy and 12C in Seattle!""",
+    """Q: What is 12 + 15 and the weather in Paris?
+Ask Agent[calc]: 12 + 15
+Agent[calc] says: 27
+Ask Func[weather]: Paris
+Func[weather] says: Sunny, 20C
+A: It's 27, and it's sunny in Paris.""",
+    """Q: Who is the president?
+A: It's Joe Biden.""",
+]
+
+
+def test_estimate_tokens():
+    assert prompt_analysis.estimate_tokens("") == 0
+    assert prompt_analysis.estimate_tokens("Q: Hi there!") == 5
+    assert prompt_analysis.estimate_tokens("internationalization") == 4
+
+
+def test_analyze_prompts():
+    analysis = prompt_analysis.analyze_prompts(BASE_PROMPT, FEW_SHOTS)
+    assert analysis.few_shot_patterns == [
+        ["Ask Func[weather]"],
+        ["Ask Func[weather]"],
+        ["Ask Func[weather]"],
+        ["Ask Agent[calc]", "Ask Func[weather]"],
+        [],
+    ]
+    assert analysis.exact_duplicates == [[0, 1]]
+    assert [(a, b) for a, b, _ in analysis.near_duplicates] == [(0, 2)]
+    assert analysis.covering_subset == [3]
+    assert analysis.total_tokens == analysis.base_prompt_tokens + sum(
+        analysis.few_shot_tokens
+    )
+    assert analysis.covering_subset_tokens < analysis.total_tokens
+
+
+def test_analyze_prompts_custom_tokenizer():
+    analysis = prompt_analysis.analyze_prompts(
+        BASE_PROMPT, FEW_SHOTS, token_counter=len
+    )
+    assert analysis.base_prompt_tokens == len(BASE_PROMPT)
@@ -1,14 +1,93 @@
+import abc
+import asyncio
 import base64
+import codecs
+import collections
+import concurrent.futures
+import dataclasses
+import functools
+import http.cookiejar
+import itertools
 import json
-from typing import TYPE_CHECKING, Dict, List, MutableMapping, Union
+import os
+import re
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    ItemsView,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+)
 
+import aiohttp
+import jwt
 import requests
 
 from fixieai import constants
+from fixieai.agents import cbor
 
 if TYPE_CHECKING:
     from fixieai.agents.api import AgentQuery
 
+# Maximum number of concurrent requests made by a single bulk operation.
+MAX_CONCURRENT_REQUESTS = 10
+# Default size of the connection pool shared by all storages in the process. Sync
+# Funcs run in a threadpool of 40 threads, so this lets each of them keep a connection.
+DEFAULT_CONNECTION_POOL_SIZE = int(os.getenv("FIXIE_USER_STORAGE_POOL_SIZE", "40"))
+# Size of the chunks the key listing is streamed in.
+LISTING_CHUNK_SIZE = 64 * 1024
+# Number of values `iter_items()` fetches at once, for keys listed without their value.
+ITEMS_BATCH_SIZE = 100
+
+# Codecs values can be stored with. "json" is readable by any version of the SDK.
+# "cbor" stores bytes as-is rather than base64-encoded, and "cbor+zlib" also compresses
+# values where that makes them smaller.
+CODECS = ("json", "cbor", "cbor+zlib")
+# The codec used unless another one is given, e.g., by storages injected into Funcs.
+DEFAULT_CODEC = os.getenv("FIXIE_USER_STORAGE_CODEC", "json")
+# Prefix of values stored with a binary codec, followed by the codec and ":". JSON text
+# never starts with it, so values can always be decoded whatever codec wrote them.
+_BINARY_TAG = "~"
+# Values smaller than this many bytes aren't worth compressing.
+_MIN_COMPRESSED_SIZE = 256
+
+# Environment variable selecting the backend storages use by default: "http" for the
+# Fixie service, an http(s) URL for a stand-in service, or "sqlite:<path>" for a local
+# SQLite database.
+BACKEND_ENV_VAR = "FIXIE_USER_STORAGE_BACKEND"
+
+# Values larger than this many bytes are split into chunks of at most this size, which
+# are stored under internal keys and written concurrently.
+CHUNK_SIZE = 1024 * 1024
+# Prefix of the internal keys holding the chunks of large values, followed by the key
+# of the value and the index of the chunk. Listings leave them out.
+CHUNK_KEY_PREFIX = "_chunk."
+# Prefix of the manifest stored at the key of a chunked value.
+_CHUNKED_TAG = "~chunked:"
+# Chunks written less than this many seconds ago may belong to a value that's still
+# being stored, so `delete_orphaned_chunks` leaves them alone.
+ORPHANED_CHUNK_MIN_AGE = 3600.0
+# Whether storages use the process-wide cache shared across requests, unless told
+# otherwise (see `user_storage_cache`).
+DEFAULT_SHARED_CACHE = os.getenv("FIXIE_USER_STORAGE_SHARED_CACHE", "") in ("1", "true")
+
 UserStoragePrimitives = Union[bool, int, float, str, bytes, None]
 UserStorageType = Union[
     UserStoragePrimitives,
@@ -17,6 +96,193 @@ UserStorageType = Union[
 ]
 
 
+_T = TypeVar("_T")
+_R = TypeVar("_R")
+# Sentinel for keys without a buffered write or deletion.
+_NOT_PENDING = object()
+
+
+class UserStorageBackend(abc.ABC):
+    """Where UserStorages keep their values.
+
+    Values are partitioned by user, identified by the query's access token, and by
+    agent. Backends get and return values encoded as strings.
+    """
+
+    @abc.abstractmethod
+    def get(self, access_token: str, agent_id: str, key: str) -> Optional[str]:
+        """Returns the value at `key`, or None if it doesn't exist."""
+
+    def contains(self, access_token: str, agent_id: str, key: str) -> bool:
+        """Returns whether `key` exists."""
+        return self.get(access_token, agent_id, key) is not None
+
+    def get_if_changed(
+        self, access_token: str, agent_id: str, key: str, version: Optional[str]
+    ) -> Tuple[bool, Optional[str], Optional[str]]:
+        """Returns (changed, value, version) of `key`.
+
+        If `version` is still the current version of the value, returns False and no
+        value. Backends that don't version values always return the value, and None
+        as the version.
+        """
+        return True, self.get(access_token, agent_id, key), None
+
+    @abc.abstractmethod
+    def set(self, access_token: str, agent_id: str, key: str, data: str):
+        """Stores `data` at `key`."""
+
+    @abc.abstractmethod
+    def delete(self, access_token: str, agent_id: str, key: str) -> bool:
+        """Deletes `key`, and returns whether it existed."""
+
+    @abc.abstractmethod
+    def iter_items(
+        self, access_token: str, agent_id: str
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        """Streams (key, value) of all keys. Values may be None if not listed."""
+
+
+class HttpBackend(UserStorageBackend):
+    """Keeps values in the Fixie user storage service, or a stand-in for it.
+
+    All HttpBackends in the process share one connection pool (see
+    `set_connection_pool_size`), so creating one is cheap and doesn't open a connection.
+    """
+
+    def __init__(self, url: str = constants.FIXIE_USER_STORAGE_URL):
+        self.url = url
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, HttpBackend) and other.url == self.url
+
+    def __hash__(self) -> int:
+        return hash(self.url)
+
+    def get(self, access_token: str, agent_id: str, key: str) -> Optional[str]:
+        return self.get_if_changed(access_token, agent_id, key, None)[1]
+
+    def get_if_changed(
+        self, access_token: str, agent_id: str, key: str, version: Optional[str]
+    ) -> Tuple[bool, Optional[str], Optional[str]]:
+        # Versions are ETags, revalidated with a conditional request.
+        headers = {} if version is None else {"If-None-Match": version}
+        response = self._request(
+            "GET", access_token, f"{agent_id}/{key}", headers=headers
+        )
+        if response.status_code == 304:
+            return False, None, version
+        if response.status_code == 404:
+            return True, None, None
+        response.raise_for_status()
+        data: str = response.json()["data"]
+        return True, data, response.headers.get("ETag")
+
+    def contains(self, access_token: str, agent_id: str, key: str) -> bool:
+        return self._request("HEAD", access_token, f"{agent_id}/{key}").ok
+
+    def set(self, access_token: str, agent_id: str, key: str, data: str):
+        response = self._request(
+            "POST", access_token, f"{agent_id}/{key}", json={"data": data}
+        )
+        response.raise_for_status()
+
+    def delete(self, access_token: str, agent_id: str, key: str) -> bool:
+        response = self._request("DELETE", access_token, f"{agent_id}/{key}")
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        return True
+
+    def iter_items(
+        self, access_token: str, agent_id: str
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        # Stream the listing rather than holding all of it in memory.
+        with self._request("GET", access_token, agent_id, stream=True) as response:
+            response.raise_for_status()
+            parser = _JsonArrayParser()
+            for chunk in response.iter_content(LISTING_CHUNK_SIZE):
+                for entry in parser.feed(chunk):
+                    yield entry["key"], entry.get("value")
+            parser.close()
+
+    def _request(
+        self,
+        method: str,
+        access_token: str,
+        path: str,
+        headers: Optional[Dict[str, str]] = None,
+        **kwargs,
+    ) -> requests.Response:
+        # The token is per-request, so it's sent as a header rather than kept on the
+        # shared session.
+        return _get_session().request(
+            method,
+            f"{self.url}/{path}",
+            headers={"Authorization": f"Bearer {access_token}", **(headers or {})},
+            **kwargs,
+        )
+
+
+def default_backend() -> UserStorageBackend:
+    """Returns the backend selected by the FIXIE_USER_STORAGE_BACKEND environment
+    variable, by default the Fixie user storage service."""
+    spec = os.getenv(BACKEND_ENV_VAR, "http")
+    with _backends_lock:
+        backend = _backends.get(spec)
+        if backend is None:
+            backend = _backends[spec] = _make_backend(spec)
+    return backend
+
+
+def _make_backend(spec: str) -> UserStorageBackend:
+    if spec == "http":
+        return HttpBackend()
+    elif spec.startswith(("http://", "https://")):
+        return HttpBackend(spec)
+    elif spec.startswith("sqlite:"):
+        # Delayed import to avoid circular dependency
+        from fixieai.agents import user_storage_sqlite
+
+        return user_storage_sqlite.SqliteBackend(spec[len("sqlite:") :])
+    raise ValueError(
+        f"Unknown {BACKEND_ENV_VAR} {spec!r}, expected 'http', an http(s) URL, or "
+        "'sqlite:<path>'."
+    )
+
+
+def _resolve_backend(
+    userstorage_url: Optional[str],
+    backend: Optional[UserStorageBackend],
+    shared_cache: Optional[bool] = None,
+    user_id: Optional[str] = None,
+) -> UserStorageBackend:
+    if backend is not None:
+        if userstorage_url is not None:
+            raise ValueError("Only one of userstorage_url or backend may be set.")
+    elif userstorage_url is not None:
+        backend = HttpBackend(userstorage_url)
+    else:
+        backend = default_backend()
+    if shared_cache if shared_cache is not None else DEFAULT_SHARED_CACHE:
+        # Delayed import to avoid circular dependency
+        from fixieai.agents import user_storage_cache
+
+        backend = user_storage_cache.CachingBackend(backend, user_id=user_id)
+    return backend
+
+
+def _user_id(access_token: str) -> str:
+    """Returns what identifies the user of `access_token` across queries: the "sub"
+    claim if it's a JWT that has one, or else the token itself."""
+    try:
+        claims = jwt.decode(access_token, options={"verify_signature": False})
+    except jwt.PyJWTError:
+        return access_token
+    subject = claims.get("sub") if isinstance(claims, dict) else None
+    return subject if isinstance(subject, str) else access_token
+
+
 class UserStorage(MutableMapping[str, UserStorageType]):
     """UserStorage provides a dict-like interface to a user-specific storage.
 
@@ -31,63 +297,883 @@ class UserStorage(MutableMapping[str, UserStorageType]):
     >>> storage["complex-key"] = {"key1": {"key2": [12, False, None, b"binary"]}}
     >>> assert len(storage) == 2
     >>> assert storage["complex-key"]["key1"]["key2"][-1] == b"binary"
+
+    Values are kept in `backend`, or in the Fixie service at `userstorage_url`. By
+    default, that's the backend selected by the FIXIE_USER_STORAGE_BACKEND environment
+    variable (see `default_backend`), e.g., "sqlite:storage.db" to run offline. Creating
+    a storage is cheap and doesn't open a connection.
+
+    With `cache=True`, the storage is meant to live for a single request: values are
+    fetched at most once, known misses are remembered, and writes and deletions are
+    buffered locally until `flush()` is called. Funcs get such a storage injected,
+    which is flushed once the Func returns.
+
+    With `shared_cache=True`, values are also cached across requests by the process,
+    see `user_storage_cache`. They are shared by all of a user's requests if `user_id`,
+    verified from the query's access token, is given, as it is for Funcs.
+
+    Values are encoded with `codec`, one of `CODECS`. Values are decoded according to
+    the codec they were stored with, so the codec can be changed at any time.
+
+    Values larger than `CHUNK_SIZE` are transparently stored in chunks, which are
+    written and read concurrently. Ranges of large bytes values can be read without
+    loading all of them, with `read_bytes` and `iter_bytes`. Chunks are stored under
+    keys derived from the key of their value, so storing a large value replaces the
+    chunks of the one before. Other chunks that are no longer needed are only known
+    to a caching storage that read the value being replaced or deleted, which deletes
+    them. The rest are deleted by `delete_orphaned_chunks`.
+
+    Iterating over the storage streams the key listing rather than downloading it
+    whole. In cache mode, the set of keys is also remembered after the first full
+    listing, so `len(storage)` followed by iteration lists the keys only once.
     """
 
     def __init__(
         self,
         query: "AgentQuery",
         agent_id: str,
-        userstorage_url: str = constants.FIXIE_USER_STORAGE_URL,
+        userstorage_url: Optional[str] = None,
+        cache: bool = False,
+        codec: Optional[str] = None,
+        backend: Optional[UserStorageBackend] = None,
+        shared_cache: Optional[bool] = None,
+        user_id: Optional[str] = None,
     ):
         # TODO(hessam): Remove agent_id from args once access_token includes agent_id
         #  as well.
         self._agent_id = agent_id
-        self._userstorage_url = userstorage_url
-        self._session = requests.Session()
-        self._session.headers.update({"Authorization": f"Bearer {query.access_token}"})
+        self._access_token = query.access_token or ""
+        self._backend = _resolve_backend(
+            userstorage_url, backend, shared_cache, user_id
+        )
+        self._cache_enabled = cache
+        self._codec = _check_codec(codec or DEFAULT_CODEC)
+        # JSON-encoded values by key, or None for keys known not to exist.
+        self._cache: Dict[str, Optional[str]] = {}
+        # Buffered writes by key: JSON-encoded values, or None for deletions.
+        self._pending: Dict[str, Optional[str]] = {}
+        # All existing keys, in cache mode once they have been listed.
+        self._keys: Optional[Dict[str, None]] = None
 
     def __setitem__(self, key: str, value: UserStorageType):
-        url = f"{self._userstorage_url}/{self._agent_id}/{key}"
-        response = self._session.post(url, json={"data": to_json(value)})
-        response.raise_for_status()
+        self.set_many({key: value})
 
     def __getitem__(self, key: str) -> UserStorageType:
-        url = f"{self._userstorage_url}/{self._agent_id}/{key}"
-        try:
-            response = self._session.get(url)
-            response.raise_for_status()
-            return from_json(response.json()["data"])
-        except requests.exceptions.HTTPError as e:
-            raise KeyError(f"Key {key} not found") from e
+        data = self._get_data(key)
+        if data is None:
+            raise KeyError(f"Key {key} not found")
+        return self._decode(data)
 
     def __contains__(self, key: object) -> bool:
-        url = f"{self._userstorage_url}/{self._agent_id}/{key}"
-        try:
-            response = self._session.head(url)
-            response.raise_for_status()
-            return True
-        except requests.exceptions.HTTPError as e:
+        if not isinstance(key, str):
             return False
+        if self._cache_enabled:
+            # Fetch the value rather than just checking for it, as it's usually read
+            # right after.
+            return self._get_data(key) is not None
+        return self._backend.contains(self._access_token, self._agent_id, key)
 
     def __delitem__(self, key: str):
-        url = f"{self._userstorage_url}/{self._agent_id}/{key}"
-        try:
-            response = self._session.delete(url)
+        if self._cache_enabled:
+            if key not in self:
+                raise KeyError(f"Key {key} not found")
+            self._buffer(key, None)
+        elif not self._remove(key):
+            raise KeyError(f"Key {key} not found")
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, UserStorageType]:
+        """Returns the values at `keys`. Keys that don't exist are left out.
+
+        Values are fetched with concurrent requests.
+        """
+        keys = list(dict.fromkeys(keys))
+        if self._cache_enabled:
+            uncached_keys = [key for key in keys if key not in self._cache]
+        else:
+            uncached_keys = keys
+        fetched = dict(zip(uncached_keys, self._map(self._fetch, uncached_keys)))
+        if self._cache_enabled:
+            self._cache.update(fetched)
+            fetched = {key: self._cache[key] for key in keys}
+        return {
+            key: self._decode(data) for key, data in fetched.items() if data is not None
+        }
+
+    def set_many(self, values: Mapping[str, UserStorageType]):
+        """Stores all `values`, with concurrent requests unless writes are buffered."""
+        chunks: List[Tuple[str, str]] = []
+        encoded: List[Tuple[str, str]] = []
+        for key, value in values.items():
+            data, value_chunks = _split_value(key, value, self._codec)
+            chunks.extend(value_chunks)
+            encoded.append((key, data))
+        if self._cache_enabled:
+            for key, data in chunks + encoded:
+                self._buffer(key, data)
+            return
+
+        # Values only reference their chunks once these are all stored.
+        self._map(self._store_item, chunks)
+        self._map(self._store_item, encoded)
+
+    def delete_many(self, keys: Iterable[str]):
+        """Deletes all `keys` that exist, with concurrent requests unless deletions are
+        buffered. Unlike `del`, keys that don't exist are ignored."""
+        keys = list(dict.fromkeys(keys))
+        if self._cache_enabled:
+            for key in keys:
+                self._buffer(key, None)
+        else:
+            self._map(self._remove, keys)
+
+    def iter_keys(self, prefix: str = "") -> Iterator[str]:
+        """Streams the stored keys that start with `prefix`."""
+        for key, _ in self._iter_entries(prefix):
+            yield key
+
+    def items(self) -> ItemsView[str, UserStorageType]:
+        """Returns a view of the stored (key, value) pairs, iterated with `iter_items`."""
+        return _ItemsView(self)
+
+    def iter_items(self, prefix: str = "") -> Iterator[Tuple[str, UserStorageType]]:
+        """Streams the (key, value) pairs of the stored keys that start with `prefix`.
+
+        Values come along with the key listing, so no request is made per key. The
+        values of keys listed without one are fetched in concurrent batches.
+        """
+        batch: List[str] = []
+        for key, data in self._iter_entries(prefix):
+            if data is not None:
+                yield key, self._decode(data)
+                continue
+            batch.append(key)
+            if len(batch) == ITEMS_BATCH_SIZE:
+                yield from self._fetch_items(batch)
+                batch = []
+        yield from self._fetch_items(batch)
+
+    def iter_bytes(
+        self, key: str, start: int = 0, end: Optional[int] = None
+    ) -> Iterator[bytes]:
+        """Streams the bytes value at `key`, or its `[start:end]` slice.
+
+        Only the chunks of a large value that overlap the slice are fetched, a few at a
+        time, so that the value is never held in memory as a whole.
+        """
+        data = self._get_data(key)
+        if data is None:
+            raise KeyError(f"Key {key} not found")
+        manifest = _Manifest.from_data(data)
+        if manifest is None or manifest.kind != "bytes":
+            value = self._decode(data)
+            if not isinstance(value, bytes):
+                raise TypeError(f"Value at {key} is a {type(value)!r}, not bytes")
+            return iter([value[start:end]])
+        return self._iter_byte_range(
+            manifest, *slice(start, end).indices(manifest.size)[:2]
+        )
+
+    def read_bytes(self, key: str, start: int = 0, end: Optional[int] = None) -> bytes:
+        """Returns the `[start:end]` slice of the bytes value at `key`, fetching only
+        the chunks it overlaps."""
+        return b"".join(self.iter_bytes(key, start, end))
+
+    def delete_orphaned_chunks(self) -> int:
+        """Deletes chunks that no stored value references anymore, and returns how many
+        were deleted. Buffered changes are flushed first.
+
+        Chunks of a large value are only referenced once it's fully stored, so chunks
+        written in the last `ORPHANED_CHUNK_MIN_AGE` seconds are kept.
+        """
+        self.flush()
+        chunks: Dict[str, Optional[str]] = {}
+        referenced = set()
+        unlisted = []
+        for key, data in self._backend.iter_items(self._access_token, self._agent_id):
+            if key.startswith(CHUNK_KEY_PREFIX):
+                chunks[key] = data
+            elif data is None:
+                unlisted.append(key)
+            else:
+                referenced.update(_Manifest.chunks_of(data))
+        for data in self._map(self._fetch, unlisted):
+            referenced.update(_Manifest.chunks_of(data))
+
+        # Only unreferenced chunks are fetched, to tell when they were written.
+        candidates = sorted(key for key in chunks if key not in referenced)
+        unfetched = [key for key in candidates if chunks[key] is None]
+        chunks.update(zip(unfetched, self._map(self._fetch, unfetched)))
+        min_created_at = time.time() - ORPHANED_CHUNK_MIN_AGE
+        orphans = []
+        for key in candidates:
+            data = chunks[key]
+            # Chunks deleted since they were listed are gone already.
+            if data is not None and _chunk_created_at(data) < min_created_at:
+                orphans.append(key)
+        self._map(self._remove, orphans)
+        return len(orphans)
+
+    def flush(self):
+        """Sends all buffered writes and deletions to the backend."""
+        pending = list(self._pending.items())
+
+        def send(item: Tuple[str, Optional[str]]):
+            key, data = item
+            if data is not None:
+                self._store(key, data)
+            else:
+                # The key may have only ever existed in the buffer.
+                self._remove(key)
+            if self._pending.get(key, _NOT_PENDING) is data:
+                del self._pending[key]
+
+        # Chunks are stored before the values referencing them, and deleted after.
+        chunk_writes: List[Tuple[str, Optional[str]]] = []
+        chunk_deletions: List[Tuple[str, Optional[str]]] = []
+        others: List[Tuple[str, Optional[str]]] = []
+        for key, data in pending:
+            if not key.startswith(CHUNK_KEY_PREFIX):
+                others.append((key, data))
+            elif data is not None:
+                chunk_writes.append((key, data))
+            else:
+                chunk_deletions.append((key, data))
+        self._map(send, chunk_writes)
+        self._map(send, others)
+        self._map(send, chunk_deletions)
+
+    def _map(self, func: Callable[[_T], _R], items: Sequence[_T]) -> List[_R]:
+        """Calls `func` on all `items` concurrently, and returns the results in order.
+
+        The Fixie service has no bulk endpoints, so bulk operations are pipelined over
+        concurrent requests instead.
+        """
+        if len(items) <= 1:
+            return [func(item) for item in items]
+        max_workers = min(len(items), MAX_CONCURRENT_REQUESTS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            return list(executor.map(func, items))
+
+    def _buffer(self, key: str, data: Optional[str]):
+        """Buffers a write, or a deletion if `data` is None, until the next flush."""
+        if key.startswith(CHUNK_KEY_PREFIX):
+            self._cache[key] = data
+            self._pending[key] = data
+            return
+        if key in self._cache:
+            # The chunks of the value being replaced that the new value doesn't
+            # replace aren't needed anymore.
+            for chunk_key in _replaced_chunks(self._cache[key], data):
+                self._buffer(chunk_key, None)
+        self._cache[key] = data
+        self._pending[key] = data
+        if self._keys is not None:
+            if data is None:
+                self._keys.pop(key, None)
+            else:
+                self._keys[key] = None
+
+    def _get_data(self, key: str) -> Optional[str]:
+        """Returns the JSON-encoded value at `key`, or None if it doesn't exist."""
+        if self._cache_enabled and key in self._cache:
+            return self._cache[key]
+        if self._keys is not None and key not in self._keys:
+            return None
+        data = self._fetch(key)
+        if self._cache_enabled:
+            self._cache[key] = data
+        return data
+
+    def _fetch(self, key: str) -> Optional[str]:
+        return self._backend.get(self._access_token, self._agent_id, key)
+
+    def _fetch_chunk(self, manifest: "_Manifest", key: str) -> str:
+        # Chunks are read once, so they aren't cached, but they may still be buffered.
+        data = self._cache.get(key) if self._cache_enabled else None
+        if data is None:
+            data = self._fetch(key)
+        return _check_chunk(manifest, key, data)
+
+    def _iter_chunks(self, manifest: "_Manifest", keys: Sequence[str]) -> Iterator[str]:
+        """Streams the chunks of `manifest` at `keys` in order, fetching a few
+        ahead."""
+        fetch_chunk = functools.partial(self._fetch_chunk, manifest)
+        with concurrent.futures.ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS) as executor:
+            remaining = iter(keys)
+            futures = collections.deque(
+                executor.submit(fetch_chunk, key)
+                for key in itertools.islice(remaining, MAX_CONCURRENT_REQUESTS)
+            )
+            while futures:
+                chunk = futures.popleft().result()
+                for key in itertools.islice(remaining, 1):
+                    futures.append(executor.submit(fetch_chunk, key))
+                yield chunk
+
+    def _iter_byte_range(
+        self, manifest: "_Manifest", start: int, end: int
+    ) -> Iterator[bytes]:
+        if start >= end:
+            return
+        first = start // manifest.chunk_size
+        last = (end - 1) // manifest.chunk_size
+        chunks = self._iter_chunks(manifest, manifest.chunks[first : last + 1])
+        for index, data in enumerate(chunks, start=first):
+            chunk = decode(data)
+            assert isinstance(chunk, bytes)
+            offset = index * manifest.chunk_size
+            yield chunk[max(start - offset, 0) : end - offset]
+
+    def _decode(self, data: str) -> UserStorageType:
+        """Decodes a stored value, reassembling it from its chunks if needed."""
+        manifest = _Manifest.from_data(data)
+        if manifest is None:
+            return decode(data)
+        fetch_chunk = functools.partial(self._fetch_chunk, manifest)
+        return _join_chunks(manifest, self._map(fetch_chunk, manifest.chunks))
+
+    def _store(self, key: str, data: str):
+        self._backend.set(self._access_token, self._agent_id, key, data)
+
+    def _store_item(self, item: Tuple[str, str]):
+        self._store(*item)
+
+    def _remove(self, key: str) -> bool:
+        return self._backend.delete(self._access_token, self._agent_id, key)
+
+    def _fetch_items(self, keys: List[str]) -> Iterator[Tuple[str, UserStorageType]]:
+        values = self.get_many(keys)
+        for key in keys:
+            if key in values:
+                yield key, values[key]
+
+    def _iter_entries(self, prefix: str) -> Iterator[Tuple[str, Optional[str]]]:
+        """Streams (key, JSON-encoded value) of the stored keys that start with
+        `prefix`, with buffered writes applied. The value is None if unknown."""
+        if self._keys is not None:
+            for key in list(self._keys):
+                if key.startswith(prefix):
+                    yield key, self._cache.get(key)
+            return
+
+        keys: Dict[str, None] = {}
+        for key, data in self._backend.iter_items(self._access_token, self._agent_id):
+            if key.startswith(CHUNK_KEY_PREFIX):
+                continue
+            if self._cache_enabled:
+                if key in self._pending:
+                    continue
+                if key in self._cache:
+                    data = self._cache[key]
+                    if data is None:
+                        continue
+                elif data is not None:
+                    self._cache[key] = data
+                keys[key] = None
+            if key.startswith(prefix):
+                yield key, data
+        if not self._cache_enabled:
+            return
+
+        # Apply buffered writes and deletions on top of the stored keys.
+        for key, data in list(self._pending.items()):
+            if data is not None and not key.startswith(CHUNK_KEY_PREFIX):
+                keys[key] = None
+                if key.startswith(prefix):
+                    yield key, data
+        self._keys = keys
+
+    def __iter__(self) -> Iterator[str]:
+        return self.iter_keys()
+
+    def __len__(self) -> int:
+        if self._cache_enabled:
+            for _ in self._iter_entries(""):
+                pass
+            assert self._keys is not None
+            return len(self._keys)
+        return sum(1 for _ in self._iter_entries(""))
+
+
+class _ItemsView(ItemsView[str, UserStorageType]):
+    """The items of a UserStorage, with values fetched along with the key listing."""
+
+    _mapping: UserStorage
+
+    def __iter__(self) -> Iterator[Tuple[str, UserStorageType]]:
+        return self._mapping.iter_items()
+
+
+class AsyncUserStorage:
+    """AsyncUserStorage is the asyncio counterpart of UserStorage, for async Funcs.
+
+    With the Fixie service, or a stand-in for it, all instances share one aiohttp
+    connection pool per event loop. Other backends are called from the loop's default
+    executor. Values are encoded the same way as in UserStorage, with any of `CODECS`,
+    and large values are chunked the same way, so both can be used on the same storage.
+
+    Usage:
+        @agent.register_func
+        async def func(query: fixieai.Message, user_storage: AsyncUserStorage) -> str:
+            count = await user_storage.get("count", 0)
+            await user_storage.set("count", count + 1)
+            async for key in user_storage:
+                ...
+    """
+
+    def __init__(
+        self,
+        query: "AgentQuery",
+        agent_id: str,
+        userstorage_url: Optional[str] = None,
+        codec: Optional[str] = None,
+        backend: Optional[UserStorageBackend] = None,
+    ):
+        self._agent_id = agent_id
+        self._access_token = query.access_token or ""
+        self._backend = _resolve_backend(userstorage_url, backend)
+        self._codec = _check_codec(codec or DEFAULT_CODEC)
+        self._headers = {"Authorization": f"Bearer {self._access_token}"}
+
+    async def get(self, key: str, default: UserStorageType = None) -> UserStorageType:
+        """Returns the value at `key`, or `default` if it doesn't exist."""
+        data = await self._fetch(key)
+        if data is None:
+            return default
+        manifest = _Manifest.from_data(data)
+        if manifest is None:
+            return decode(data)
+        chunks = await self._gather(self._fetch(chunk) for chunk in manifest.chunks)
+        return _join_chunks(
+            manifest,
+            [_check_chunk(manifest, *item) for item in zip(manifest.chunks, chunks)],
+        )
+
+    async def contains(self, key: str) -> bool:
+        """Returns whether `key` exists."""
+        if not isinstance(self._backend, HttpBackend):
+            exists: bool = await self._run(self._backend.contains, key)
+            return exists
+        async with _get_async_session().head(
+            self._key_url(key), headers=self._headers
+        ) as response:
+            if response.status == 404:
+                return False
             response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            raise KeyError(f"Key {key} not found") from e
+            return True
 
-    def _get_all_keys(self):
-        url = f"{self._userstorage_url}/{self._agent_id}"
-        response = self._session.get(url)
-        response.raise_for_status()
-        return [value["key"] for value in response.json()]
+    async def set(self, key: str, value: UserStorageType):
+        """Stores `value` at `key`."""
+        data, chunks = _split_value(key, value, self._codec)
+        # The value only references its chunks once these are all stored.
+        await self._gather(self._store(*chunk) for chunk in chunks)
+        await self._store(key, data)
+
+    async def delete(self, key: str):
+        """Deletes `key`, or raises a KeyError if it doesn't exist."""
+        if not await self._remove(key):
+            raise KeyError(f"Key {key} not found")
+
+    async def keys(self) -> List[str]:
+        """Returns all stored keys."""
+        return [key async for key in self]
+
+    async def __aiter__(self) -> AsyncIterator[str]:
+        async for key in self._iter_keys():
+            if not key.startswith(CHUNK_KEY_PREFIX):
+                yield key
+
+    async def _iter_keys(self) -> AsyncIterator[str]:
+        """Streams all stored keys, including those of chunks."""
+        if not isinstance(self._backend, HttpBackend):
+            for key, _ in await self._run(self._list_items):
+                yield key
+            return
+        # Stream the listing, as it may be large.
+        async with _get_async_session().get(
+            f"{self._backend.url}/{self._agent_id}", headers=self._headers
+        ) as response:
+            response.raise_for_status()
+            parser = _JsonArrayParser()
+            async for chunk in response.content.iter_chunked(LISTING_CHUNK_SIZE):
+                for entry in parser.feed(chunk):
+                    yield entry["key"]
+            parser.close()
+
+    async def _fetch(self, key: str) -> Optional[str]:
+        if not isinstance(self._backend, HttpBackend):
+            data: Optional[str] = await self._run(self._backend.get, key)
+            return data
+        async with _get_async_session().get(
+            self._key_url(key), headers=self._headers
+        ) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            stored: str = (await response.json())["data"]
+            return stored
+
+    async def _store(self, key: str, data: str):
+        if not isinstance(self._backend, HttpBackend):
+            await self._run(self._backend.set, key, data)
+            return
+        async with _get_async_session().post(
+            self._key_url(key), headers=self._headers, json={"data": data}
+        ) as response:
+            response.raise_for_status()
+
+    async def _remove(self, key: str) -> bool:
+        if not isinstance(self._backend, HttpBackend):
+            existed: bool = await self._run(self._backend.delete, key)
+            return existed
+        async with _get_async_session().delete(
+            self._key_url(key), headers=self._headers
+        ) as response:
+            if response.status == 404:
+                return False
+            response.raise_for_status()
+            return True
+
+    async def _gather(self, awaitables: Iterable[Awaitable[_R]]) -> List[_R]:
+        """Awaits all `awaitables`, at most MAX_CONCURRENT_REQUESTS at a time, and
+        returns their results in order."""
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def run(awaitable: Awaitable[_R]) -> _R:
+            async with semaphore:
+                return await awaitable
+
+        return list(await asyncio.gather(*(run(a) for a in awaitables)))
+
+    def _key_url(self, key: str) -> str:
+        assert isinstance(self._backend, HttpBackend)
+        return f"{self._backend.url}/{self._agent_id}/{key}"
+
+    def _list_items(
+        self, access_token: str, agent_id: str
+    ) -> List[Tuple[str, Optional[str]]]:
+        return list(self._backend.iter_items(access_token, agent_id))
+
+    async def _run(self, method: Callable[..., _R], *args: Any) -> _R:
+        """Calls a backend method with the storage's user and agent, off the loop."""
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(method, self._access_token, self._agent_id, *args),
+        )
+
+
+# Default backends by FIXIE_USER_STORAGE_BACKEND value.
+_backends: Dict[str, UserStorageBackend] = {}
+_backends_lock = threading.Lock()
+
+# The requests session, and its connection pool, shared by all HttpBackends.
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+_connection_pool_size = DEFAULT_CONNECTION_POOL_SIZE
+
+
+def set_connection_pool_size(size: int):
+    """Sets how many connections to the storage service are kept open for reuse.
+
+    This applies to all storages using the Fixie service in the process. Requests
+    beyond that many at once still go through, over short-lived connections.
+    """
+    if size < 1:
+        raise ValueError(f"Connection pool size must be positive, got {size}.")
+    global _session, _connection_pool_size
+    with _session_lock:
+        _connection_pool_size = size
+        if _session is not None:
+            # Idle connections are closed; the new pool is made on the next request.
+            _session.close()
+            _session = None
+
+
+def _get_session() -> requests.Session:
+    global _session
+    session = _session
+    if session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _make_session(_connection_pool_size)
+            session = _session
+    return session
+
+
+def _make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # The session is shared across users, so it must not keep cookies.
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+# Shared aiohttp sessions, and their connection pools, by event loop.
+_async_sessions: MutableMapping[
+    asyncio.AbstractEventLoop, aiohttp.ClientSession
+] = weakref.WeakKeyDictionary()
+
+
+def _get_async_session() -> aiohttp.ClientSession:
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=_connection_pool_size),
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+        _async_sessions[loop] = session
+    return session
+
+
+async def close_async_session():
+    """Closes the connection pool shared by AsyncUserStorages on the current loop."""
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+# Characters that may change the nesting of JSON outside of strings, and that may end
+# a string inside of them.
+_JSON_STRUCTURE_RE = re.compile(r'["\[\]{}]')
+_JSON_STRING_END_RE = re.compile(r'["\\]')
+
+
+class _JsonArrayParser:
+    """Incrementally parses the items of a JSON array fed in chunks of bytes.
+
+    Object and array items are only decoded once they're complete, so large items
+    spanning many chunks are scanned, and decoded, once.
+    """
+
+    def __init__(self):
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._started = False
+        self._done = False
+        # Where scanning for the end of the current item resumes, and its state there.
+        self._scan_position = 0
+        self._depth = 0
+        self._in_string = False
+
+    def feed(self, chunk: bytes) -> List[Any]:
+        """Returns the items completed by `chunk`."""
+        self._buffer += self._text_decoder.decode(chunk)
+        items = []
+        position = 0
+        while not self._done:
+            while position < len(self._buffer) and self._buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(self._buffer):
+                break
+            if not self._started:
+                if self._buffer[position] != "[":
+                    raise ValueError("Expected a JSON array")
+                self._started = True
+                position += 1
+            elif self._buffer[position] == "]":
+                self._done = True
+            else:
+                scanned = self._buffer[position] in "[{"
+                if scanned and not self._scan_item(position):
+                    break
+                try:
+                    item, end = self._decoder.raw_decode(self._buffer, position)
+                except json.JSONDecodeError:
+                    # The item is incomplete, or malformed, which `close` reports.
+                    break
+                if end == len(self._buffer) and not scanned:
+                    # A number may continue in the next chunk.
+                    break
+                items.append(item)
+                position = end
+        self._buffer = self._buffer[position:]
+        self._scan_position = max(self._scan_position - position, 0)
+        return items
+
+    def _scan_item(self, start: int) -> bool:
+        """Returns whether the object or array item at `start` is complete in the
+        buffer, resuming the scan where the previous call for it stopped."""
+        position = max(self._scan_position, start)
+        while True:
+            if self._in_string:
+                match = _JSON_STRING_END_RE.search(self._buffer, position)
+                if match is None:
+                    position = len(self._buffer)
+                    break
+                if match.group() == "\\":
+                    if match.end() == len(self._buffer):
+                        # The escaped character is in the next chunk.
+                        position = match.start()
+                        break
+                    position = match.end() + 1
+                    continue
+                self._in_string = False
+                position = match.end()
+                continue
+            match = _JSON_STRUCTURE_RE.search(self._buffer, position)
+            if match is None:
+                position = len(self._buffer)
+                break
+            position = match.end()
+            if match.group() == '"':
+                self._in_string = True
+            elif match.group() in "[{":
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth <= 0:
+                    self._scan_position, self._depth = 0, 0
+                    return True
+        self._scan_position = position
+        return False
+
+    def close(self):
+        """Raises a ValueError if the array was malformed or incomplete."""
+        if not self._done:
+            raise ValueError(
+                f"Malformed or truncated JSON array: {self._buffer[:100]!r}"
+            )
+
+
+@dataclasses.dataclass
+class _Manifest:
+    """Describes a value stored in chunks."""
+
+    # "bytes" if the chunks are slices of a bytes value, each encoded on its own, or
+    # "encoded" if they are slices of the encoded value.
+    kind: str
+    # Size of the bytes value, or length of the encoded value.
+    size: int
+    chunk_size: int
+    # The keys of the chunks, in order.
+    chunks: List[str]
+    # Unique to each write, and telling when it happened. Chunks are stored with it,
+    # as the chunks of a value are replaced by those of the next one.
+    version: str
+
+    def to_data(self) -> str:
+        return _CHUNKED_TAG + json.dumps(dataclasses.asdict(self))
+
+    @staticmethod
+    def from_data(data: str) -> Optional["_Manifest"]:
+        """Returns the manifest in `data`, or None if it's a plain value."""
+        if not data.startswith(_CHUNKED_TAG):
+            return None
+        return _Manifest(**json.loads(data[len(_CHUNKED_TAG) :]))
+
+    @staticmethod
+    def chunks_of(data: Optional[str]) -> List[str]:
+        """Returns the chunk keys referenced by a stored value, if any."""
+        manifest = None if data is None else _Manifest.from_data(data)
+        return [] if manifest is None else manifest.chunks
+
+
+def _split_value(
+    key: str, value: UserStorageType, codec: str
+) -> Tuple[str, List[Tuple[str, str]]]:
+    """Encodes `value`, and returns what to store at `key` and its chunks, if it's
+    large enough to be split."""
+    chunk_size = CHUNK_SIZE
+    if isinstance(value, bytes) and len(value) > chunk_size:
+        # Slice the bytes rather than their encoding, so that ranges can be read.
+        kind, size = "bytes", len(value)
+        pieces = [
+            encode(value[i : i + chunk_size], codec)
+            for i in range(0, len(value), chunk_size)
+        ]
+    else:
+        data = encode(value, codec)
+        if len(data) <= chunk_size:
+            return data, []
+        kind, size = "encoded", len(data)
+        pieces = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+    version = f"{int(time.time()):x}.{uuid.uuid4().hex}"
+    chunks = [
+        (f"{CHUNK_KEY_PREFIX}{key}.{i}", f"{version}:{piece}")
+        for i, piece in enumerate(pieces)
+    ]
+    manifest = _Manifest(
+        kind, size, chunk_size, [chunk_key for chunk_key, _ in chunks], version
+    )
+    return manifest.to_data(), chunks
+
+
+def _join_chunks(manifest: _Manifest, chunks: Sequence[str]) -> UserStorageType:
+    """Returns the value reassembled from the stored `chunks` of its manifest."""
+    if manifest.kind == "bytes":
+        return b"".join(decode(chunk) for chunk in chunks)  # type: ignore
+    return decode("".join(chunks))
 
-    def __iter__(self):
-        return iter(self._get_all_keys())
 
-    def __len__(self):
-        return len(self._get_all_keys())
+def _check_chunk(manifest: _Manifest, key: str, data: Optional[str]) -> str:
+    """Returns the piece of the value stored in the chunk at `key`."""
+    if data is None:
+        raise ValueError(f"Chunk {key} of a stored value is missing")
+    version, _, piece = data.partition(":")
+    if version != manifest.version:
+        raise ValueError(f"Chunk {key} was replaced while its value was being read")
+    return piece
+
+
+def _replaced_chunks(old_data: Optional[str], data: Optional[str]) -> List[str]:
+    """Returns the chunk keys of a replaced or deleted value that the value replacing
+    it doesn't overwrite, which must be deleted once it's stored."""
+    new_chunks = set(_Manifest.chunks_of(data))
+    return [key for key in _Manifest.chunks_of(old_data) if key not in new_chunks]
+
+
+def _chunk_created_at(data: str) -> float:
+    """Returns when the chunk holding `data` was written, or 0 if unknown."""
+    try:
+        return float(int(data.partition(".")[0], 16))
+    except ValueError:
+        return 0.0
+
+
+def encode(value: UserStorageType, codec: Optional[str] = None) -> str:
+    """Encodes `value` to a string for storage, with one of `CODECS`.
+
+    Args:
+        value: The value to encode.
+        codec: The codec to use. Defaults to `DEFAULT_CODEC`.
+    """
+    codec = _check_codec(codec or DEFAULT_CODEC)
+    if codec == "json":
+        return to_json(value)
+    data = cbor.dumps(value)
+    # Tag values as compressed only if compressing them paid off.
+    tag = "cbor"
+    if codec == "cbor+zlib" and len(data) >= _MIN_COMPRESSED_SIZE:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data, tag = compressed, codec
+    return f"{_BINARY_TAG}{tag}:{base64.b64encode(data).decode('ascii')}"
+
+
+def decode(data: str) -> UserStorageType:
+    """Decodes a value encoded by `encode` with any codec."""
+    if not data.startswith(_BINARY_TAG):
+        return from_json(data)
+    if data.startswith(_CHUNKED_TAG):
+        raise ValueError("The value is stored in chunks; read it with a UserStorage.")
+    codec, separator, payload = data[len(_BINARY_TAG) :].partition(":")
+    if not separator or codec not in CODECS:
+        raise ValueError(f"Unknown codec of stored value: {data[:20]!r}")
+    binary = base64.b64decode(payload)
+    if codec == "cbor+zlib":
+        binary = zlib.decompress(binary)
+    value: UserStorageType = cbor.loads(binary)
+    return value
+
+
+def _check_codec(codec: str) -> str:
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}.")
+    return codec
 
 
 JsonType = Union[None, int, float, str, bool, List["JsonType"], Dict[str, "JsonType"]]
@@ -95,45 +1181,124 @@ JsonType = Union[None, int, float, str, bool, List["JsonType"], Dict[str, "JsonT
 
 def to_json(obj: UserStorageType) -> str:
     """Serialize a UserStorageType to a JSON string."""
-    return json.dumps(to_json_type(obj))
+    # Bytes are encoded as the JSON encoder reaches them, rather than by copying the
+    # value with `to_json_type` first.
+    try:
+        return json.dumps(obj, default=_encode_bytes)
+    except RecursionError as e:
+        raise ValueError("The value is nested too deeply to encode as JSON") from e
 
 
 def from_json(json_dump: str) -> UserStorageType:
     """Deserializes a UserStorageType from a JSON string."""
-    return from_json_type(json.loads(json_dump))
+    try:
+        if _BYTES_TYPE not in json_dump:
+            # Nothing to decode, as is the case for most values.
+            value: UserStorageType = json.loads(json_dump)
+        else:
+            value = json.loads(json_dump, object_hook=_decode_bytes)
+    except RecursionError as e:
+        raise ValueError("The value is nested too deeply to decode from JSON") from e
+    return value
 
 
 def to_json_type(obj: UserStorageType) -> JsonType:
-    """Encodes a UserStorageType to JsonType."""
-    if isinstance(obj, bytes):
-        return {"type": "_bytes_ascii", "data": base64.b64encode(obj).decode("ASCII")}
-    elif isinstance(obj, list):
-        return [to_json_type(item) for item in obj]
-    elif isinstance(obj, dict):
-        return {key: to_json_type(value) for key, value in obj.items()}
-    else:
-        return obj
+    """Encodes a UserStorageType to JsonType.
+
+    Lists and dicts that don't contain bytes are returned as-is, rather than copied.
+    """
+    encoded: JsonType = _replace_values(obj, (bytes,), _encode_bytes)
+    return encoded
 
 
 def from_json_type(obj: JsonType) -> UserStorageType:
-    """Decodes a JsonType to UserStorageType."""
+    """Decodes a JsonType to UserStorageType.
+
+    Lists and dicts that don't contain encoded bytes are returned as-is, rather than
+    copied.
+    """
+    decoded: UserStorageType = _replace_values(obj, (dict,), _decode_bytes_value)
+    return decoded
+
+
+# The "type" of dicts that encode bytes in JSON.
+_BYTES_TYPE = "_bytes_ascii"
+# Returned by replacement functions to leave a value unchanged.
+_UNCHANGED: Any = object()
+
+
+def _encode_bytes(obj: Any) -> Dict[str, str]:
+    """Encodes bytes for `json.dumps`, which calls it for values it can't encode."""
+    if not isinstance(obj, bytes):
+        raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+    return {"type": _BYTES_TYPE, "data": base64.b64encode(obj).decode("ASCII")}
+
+
+def _decode_bytes(obj: Dict[str, Any]) -> Any:
+    """Decodes a dict encoding bytes, as the `object_hook` of `json.loads`."""
+    return base64.b64decode(obj["data"]) if _is_bytes_encoded_json_dict(obj) else obj
+
+
+def _decode_bytes_value(obj: Dict[str, Any]) -> Any:
     if _is_bytes_encoded_json_dict(obj):
-        return base64.b64decode(obj["data"])  # type: ignore
-    elif isinstance(obj, list):
-        return [from_json_type(item) for item in obj]
-    elif isinstance(obj, dict):
-        return {key: from_json_type(value) for key, value in obj.items()}
-    else:
+        return base64.b64decode(obj["data"])
+    return _UNCHANGED
+
+
+def _replace_values(
+    obj: Any, types: Tuple[type, ...], replace: Callable[[Any], Any]
+) -> Any:
+    """Returns `obj` with the values of `types` for which `replace` doesn't return
+    `_UNCHANGED` replaced by what it returns. Replaced values aren't walked into.
+
+    Values are walked without recursion, so that deeply nested values don't hit the
+    recursion limit, and only the lists and dicts containing replaced values are
+    copied.
+    """
+    if isinstance(obj, types):
+        replaced = replace(obj)
+        if replaced is not _UNCHANGED:
+            return replaced
+    if not isinstance(obj, (list, dict)):
         return obj
 
+    # Each frame holds a list or dict, an iterator over its items, the replacements of
+    # its items by key, and its own key in the parent frame's container.
+    stack: List[Tuple[Any, Iterator[Tuple[Any, Any]], Dict[Any, Any], Any]] = [
+        (obj, _iter_children(obj), {}, None)
+    ]
+    while True:
+        container, children, replacements, parent_key = stack[-1]
+        for key, child in children:
+            if isinstance(child, types):
+                replaced = replace(child)
+                if replaced is not _UNCHANGED:
+                    replacements[key] = replaced
+                    continue
+            if isinstance(child, (list, dict)) and child:
+                stack.append((child, _iter_children(child), {}, key))
+                break
+        else:
+            stack.pop()
+            if replacements:
+                container = container.copy()
+                for key, replaced in replacements.items():
+                    container[key] = replaced
+            if not stack:
+                return container
+            if replacements:
+                stack[-1][2][parent_key] = container
+
+
+def _iter_children(obj: Union[list, dict]) -> Iterator[Tuple[Any, Any]]:
+    return iter(obj.items()) if isinstance(obj, dict) else enumerate(obj)
 
-def _is_bytes_encoded_json_dict(obj: JsonType) -> bool:
+
+def _is_bytes_encoded_json_dict(obj: Any) -> bool:
     """Returns True if obj is a {"type": "_bytes_ascii", "data": encoded_string}."""
-    if not isinstance(obj, dict):
-        return False
-    if set(obj.keys()) != {"type", "data"}:
-        return False
-    elif obj["type"] != "_bytes_ascii" or not isinstance(obj["data"], str):
-        return False
-    else:
-        return True
+    return (
+        isinstance(obj, dict)
+        and len(obj) == 2
+        and obj.get("type") == _BYTES_TYPE
+        and isinstance(obj.get("data"), str)
+    )
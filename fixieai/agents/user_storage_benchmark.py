@@ -0,0 +1,81 @@
+"""Micro-benchmarks of how UserStorage encodes and decodes values.
+
+Usage:
+    python -m fixieai.agents.user_storage_benchmark --number 100
+"""
+
+import functools
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+import click
+
+from fixieai.agents import user_storage
+
+
+def _make_documents() -> Dict[str, user_storage.UserStorageType]:
+    """Returns sample values, shaped like the documents agents store."""
+    wide: user_storage.UserStorageType = {
+        f"user{i}": {"name": f"User {i}", "scores": list(range(20)), "active": True}
+        for i in range(1000)
+    }
+    deep: user_storage.UserStorageType = "leaf"
+    for i in range(200):
+        deep = {"level": i, "children": [deep]}
+    with_bytes: user_storage.UserStorageType = {
+        f"image{i}": {"name": f"Image {i}", "thumbnail": bytes(range(256))}
+        for i in range(200)
+    }
+    return {"wide": wide, "deep": deep, "with_bytes": with_bytes}
+
+
+def _make_cases(
+    documents: Dict[str, user_storage.UserStorageType]
+) -> List[Tuple[str, Callable[[], object]]]:
+    cases: List[Tuple[str, Callable[[], object]]] = []
+    for name, value in documents.items():
+        json_value = user_storage.to_json_type(value)
+        cases += [
+            (f"to_json[{name}]", functools.partial(user_storage.to_json, value)),
+            (
+                f"from_json[{name}]",
+                functools.partial(user_storage.from_json, user_storage.to_json(value)),
+            ),
+            (
+                f"to_json_type[{name}]",
+                functools.partial(user_storage.to_json_type, value),
+            ),
+            (
+                f"from_json_type[{name}]",
+                functools.partial(user_storage.from_json_type, json_value),
+            ),
+        ]
+        for codec in user_storage.CODECS[1:]:
+            data = user_storage.encode(value, codec)
+            cases += [
+                (
+                    f"encode[{name}, {codec}]",
+                    functools.partial(user_storage.encode, value, codec),
+                ),
+                (
+                    f"decode[{name}, {codec}]",
+                    functools.partial(user_storage.decode, data),
+                ),
+            ]
+    return cases
+
+
+@click.command()
+@click.option("--number", default=100, help="Number of calls timed per benchmark.")
+@click.option(
+    "--repeat", default=5, help="Number of timings, of which the best is kept."
+)
+def main(number: int, repeat: int):
+    """Times encoding and decoding sample values, in microseconds per call."""
+    for name, func in _make_cases(_make_documents()):
+        best = min(timeit.repeat(func, number=number, repeat=repeat))
+        click.echo(f"{name:40} {best / number * 1e6:12.1f} us")
+
+
+if __name__ == "__main__":
+    main()
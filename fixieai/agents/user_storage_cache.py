@@ -0,0 +1,264 @@
+"""A process-wide UserStorage cache, shared across requests.
+
+The same user often queries the same agent many times a minute, and the agent reads
+the same keys each time. Storages created with `shared_cache=True`, or all storages if
+the FIXIE_USER_STORAGE_SHARED_CACHE environment variable is "1", keep the values they
+read in `SHARED_CACHE`, keyed by agent, user and key:
+
+    user_storage_cache.SHARED_CACHE.configure(max_entries=10000, ttl=30.0)
+    storage = UserStorage(query, agent_id, shared_cache=True, user_id=user_id)
+
+Agents get a new access token with each query, so entries are only shared across
+queries by storages given the ID of their user, verified from the token. Funcs' storages
+are. Other storages only share entries with those using the very same token.
+
+Entries are evicted once they are the least recently used of `max_entries`, or once
+the values cached add up to more than `max_bytes`, and expire after `ttl` seconds. Expired entries that have a version (the service's ETag)
+are revalidated with a conditional request rather than fetched again. Writes and
+deletions made by this process invalidate the entries they affect; writes made
+elsewhere are only seen once entries expire. The chunks of large values are never
+cached, as they're read at most once.
+"""
+
+import collections
+import dataclasses
+import hashlib
+import threading
+import time
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+from fixieai.agents import user_storage
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 30.0
+
+
+@dataclasses.dataclass
+class _Entry:
+    # The cached value, or None if the key doesn't exist.
+    data: Optional[str]
+    version: Optional[str]
+    expires_at: float
+
+    @property
+    def size(self) -> int:
+        # Values encoded by the SDK are ASCII, so their length is their size in bytes.
+        return 0 if self.data is None else len(self.data)
+
+
+# (backend, agent id, "user:" and the verified user ID, or "token:" and the SHA-256 of
+# the access token, key)
+_CacheKey = Tuple[Hashable, str, str, str]
+
+
+class SharedCache:
+    """A thread-safe LRU cache of stored values, whose entries expire.
+
+    Args:
+        max_entries: Maximum number of values kept.
+        ttl: Seconds after which values are revalidated or fetched again.
+        revalidate: Whether to revalidate expired values that have a version, rather
+            than fetch them again.
+        max_bytes: Maximum total size of the values kept. Larger values aren't
+            cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL,
+        revalidate: bool = True,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self._lock = threading.Lock()
+        self._entries: "collections.OrderedDict[_CacheKey, _Entry]" = (
+            collections.OrderedDict()
+        )
+        # Total size of the values kept.
+        self._size = 0
+        # [reads in flight, invalidations since the first of them] of keys being read
+        # from the backend, so that reads overlapping a write don't cache old values.
+        self._reads: Dict[_CacheKey, List[int]] = {}
+        self.configure(max_entries, ttl, revalidate, max_bytes)
+        # Number of reads served from the cache, or not.
+        self.hits = 0
+        self.misses = 0
+
+    def configure(
+        self,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl: float = DEFAULT_TTL,
+        revalidate: bool = True,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        """Changes the cache's settings. See the class for the arguments."""
+        if max_entries < 0 or ttl < 0 or max_bytes < 0:
+            raise ValueError("max_entries, ttl and max_bytes must not be negative.")
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.ttl = ttl
+            self.revalidate = revalidate
+            self._evict()
+
+    def clear(self):
+        """Drops all entries, and resets the hit and miss counts."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """Returns the total size of the values kept, in bytes."""
+        return self._size
+
+    def _lookup(self, key: _CacheKey) -> Tuple[Optional[_Entry], bool, int]:
+        """Returns the entry at `key` if any, whether it's still fresh, and if not, the
+        generation to `_put` the value read from the backend with.
+
+        Unless the entry is fresh, `_end_read` must be called once the read is done.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            fresh = entry is not None and time.monotonic() < entry.expires_at
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if fresh:
+                self.hits += 1
+                return entry, True, 0
+            self.misses += 1
+            reads = self._reads.setdefault(key, [0, 0])
+            reads[0] += 1
+            return entry, False, reads[1]
+
+    def _put(
+        self,
+        key: _CacheKey,
+        generation: int,
+        data: Optional[str],
+        version: Optional[str],
+    ):
+        """Caches a value read from the backend, unless `key` was invalidated since
+        the read started."""
+        with self._lock:
+            reads = self._reads.get(key)
+            if reads is not None and reads[1] != generation:
+                return
+            self._pop(key)
+            entry = _Entry(data, version, time.monotonic() + self.ttl)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[key] = entry
+            self._size += entry.size
+            self._evict()
+
+    def _end_read(self, key: _CacheKey):
+        with self._lock:
+            reads = self._reads[key]
+            reads[0] -= 1
+            if reads[0] == 0:
+                del self._reads[key]
+
+    def _invalidate(self, key: _CacheKey):
+        with self._lock:
+            self._pop(key)
+            reads = self._reads.get(key)
+            if reads is not None:
+                reads[1] += 1
+
+    def _pop(self, key: _CacheKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry.size
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+
+
+# The cache shared by all storages of the process.
+SHARED_CACHE = SharedCache()
+
+
+class CachingBackend(user_storage.UserStorageBackend):
+    """Serves reads of another backend from a SharedCache.
+
+    Args:
+        backend: The backend to cache.
+        cache: The cache to use. Defaults to `SHARED_CACHE`.
+        user_id: The ID of the user of the access tokens this backend is called with,
+            verified from them. Entries are then shared by all the user's tokens,
+            rather than only by requests made with the same token.
+    """
+
+    def __init__(
+        self,
+        backend: user_storage.UserStorageBackend,
+        cache: Optional[SharedCache] = None,
+        user_id: Optional[str] = None,
+    ):
+        self.backend = backend
+        self.cache = cache if cache is not None else SHARED_CACHE
+        self.user_id = user_id
+
+    def get(self, access_token: str, agent_id: str, key: str) -> Optional[str]:
+        if key.startswith(user_storage.CHUNK_KEY_PREFIX):
+            return self.backend.get(access_token, agent_id, key)
+        cache_key = self._cache_key(access_token, agent_id, key)
+        entry, fresh, generation = self.cache._lookup(cache_key)
+        if entry is not None and fresh:
+            return entry.data
+
+        version = None
+        if entry is not None and self.cache.revalidate:
+            version = entry.version
+        try:
+            changed, data, version = self.backend.get_if_changed(
+                access_token, agent_id, key, version
+            )
+            if not changed:
+                assert entry is not None
+                data = entry.data
+            self.cache._put(cache_key, generation, data, version)
+        finally:
+            self.cache._end_read(cache_key)
+        return data
+
+    def contains(self, access_token: str, agent_id: str, key: str) -> bool:
+        return self.get(access_token, agent_id, key) is not None
+
+    def set(self, access_token: str, agent_id: str, key: str, data: str):
+        try:
+            self.backend.set(access_token, agent_id, key, data)
+        finally:
+            self._invalidate(access_token, agent_id, key)
+
+    def delete(self, access_token: str, agent_id: str, key: str) -> bool:
+        try:
+            return self.backend.delete(access_token, agent_id, key)
+        finally:
+            self._invalidate(access_token, agent_id, key)
+
+    def iter_items(
+        self, access_token: str, agent_id: str
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        return self.backend.iter_items(access_token, agent_id)
+
+    def _invalidate(self, access_token: str, agent_id: str, key: str):
+        if not key.startswith(user_storage.CHUNK_KEY_PREFIX):
+            self.cache._invalidate(self._cache_key(access_token, agent_id, key))
+
+    def _cache_key(self, access_token: str, agent_id: str, key: str) -> _CacheKey:
+        if self.user_id is not None:
+            return self.backend, agent_id, f"user:{self.user_id}", key
+        # Tokens aren't verified here, so without a verified user, entries are only
+        # shared by requests made with the very same token.
+        token_hash = hashlib.sha256(access_token.encode("utf-8")).hexdigest()
+        return self.backend, agent_id, f"token:{token_hash}", key
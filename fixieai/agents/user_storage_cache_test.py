@@ -0,0 +1,181 @@
+import jwt
+import pytest
+
+from fixieai.agents import api
+from fixieai.agents import user_storage
+from fixieai.agents import user_storage_cache
+from fixieai.agents import user_storage_service
+
+AGENT_ID = "fake-agent"
+
+
+@pytest.fixture
+def local_service():
+    with user_storage_service.LocalUserStorageService() as service:
+        yield service
+
+
+@pytest.fixture(autouse=True)
+def shared_cache():
+    cache = user_storage_cache.SHARED_CACHE
+    cache.clear()
+    yield cache
+    cache.configure()
+    cache.clear()
+
+
+def _storage(service, access_token="fake-access-token", **kwargs):
+    query = api.AgentQuery(message=api.Message("query"), access_token=access_token)
+    return user_storage.UserStorage(
+        query, AGENT_ID, userstorage_url=service.url, **kwargs
+    )
+
+
+def test_reads_are_shared_across_storages(local_service):
+    _storage(local_service)["key"] = "value"
+    assert _storage(local_service, shared_cache=True)["key"] == "value"
+    assert "missing" not in _storage(local_service, shared_cache=True)
+    request_count = local_service.request_count
+
+    for _ in range(3):
+        storage = _storage(local_service, shared_cache=True)
+        assert storage["key"] == "value"
+        assert "missing" not in storage
+    assert local_service.request_count == request_count
+    # Other tokens and storages without the shared cache aren't served from it.
+    assert "key" not in _storage(local_service, "other-token", shared_cache=True)
+    assert _storage(local_service)["key"] == "value"
+    assert local_service.request_count == request_count + 2
+
+
+def test_writes_invalidate(local_service):
+    storage = _storage(local_service, shared_cache=True)
+    storage["key"] = "value"
+    assert storage["key"] == "value"
+    _storage(local_service, shared_cache=True)["key"] = "new value"
+    assert storage["key"] == "new value"
+    del storage["key"]
+    assert "key" not in _storage(local_service, shared_cache=True)
+
+
+def test_expired_values_are_revalidated(local_service, shared_cache):
+    shared_cache.configure(ttl=0)
+    storage = _storage(local_service, shared_cache=True)
+    storage["key"] = "value"
+    assert storage["key"] == "value"
+    assert storage["key"] == "value"
+    # A write made elsewhere.
+    _storage(local_service)["key"] = "new value"
+    assert storage["key"] == "new value"
+    assert shared_cache.hits == 0
+
+
+def test_revalidation_uses_etags(local_service, shared_cache, mocker):
+    shared_cache.configure(ttl=0)
+    backend = user_storage.HttpBackend(local_service.url)
+    spy = mocker.spy(backend, "get_if_changed")
+    storage = _storage(local_service)
+    storage["key"] = "value"
+    caching_backend = user_storage_cache.CachingBackend(backend, shared_cache)
+
+    assert caching_backend.get("fake-access-token", AGENT_ID, "key") == '"value"'
+    version = spy.spy_return[2]
+    assert version is not None
+    assert caching_backend.get("fake-access-token", AGENT_ID, "key") == '"value"'
+    assert spy.spy_return == (False, None, version)
+
+
+def test_least_recently_used_values_are_evicted(local_service, shared_cache):
+    shared_cache.configure(max_entries=2)
+    storage = _storage(local_service, shared_cache=True)
+    storage.set_many({"a": 1, "b": 2, "c": 3})
+    assert storage["a"] == 1
+    assert storage["b"] == 2
+    assert storage["a"] == 1
+    assert storage["c"] == 3
+    assert len(shared_cache) == 2
+    request_count = local_service.request_count
+    assert storage["a"] == 1
+    assert local_service.request_count == request_count
+    assert storage["b"] == 2
+    assert local_service.request_count == request_count + 1
+
+
+def test_invalid_settings(shared_cache):
+    with pytest.raises(ValueError):
+        shared_cache.configure(ttl=-1)
+    with pytest.raises(ValueError):
+        shared_cache.configure(max_bytes=-1)
+
+
+def test_values_are_evicted_past_max_bytes(local_service, shared_cache):
+    shared_cache.configure(max_bytes=25)
+    storage = _storage(local_service, shared_cache=True)
+    storage.set_many({"a": "x" * 8, "b": "y" * 8, "c": "z" * 8, "large": "w" * 30})
+    assert storage["a"] == "x" * 8
+    assert storage["b"] == "y" * 8
+    assert shared_cache.size == 20
+    # Each value is 10 bytes once encoded, so the least recently used one goes.
+    assert storage["c"] == "z" * 8
+    assert len(shared_cache) == 2
+    assert shared_cache.size == 20
+    # Values larger than the whole cache aren't cached.
+    assert storage["large"] == "w" * 30
+    assert len(shared_cache) == 2
+    request_count = local_service.request_count
+    assert storage["b"] == "y" * 8
+    assert storage["c"] == "z" * 8
+    assert local_service.request_count == request_count
+
+    storage["b"] = "new"
+    assert shared_cache.size == 10
+    shared_cache.clear()
+    assert shared_cache.size == 0
+
+
+def test_tokens_of_the_same_user_share_entries_if_verified(local_service):
+    # Per-query tokens of the same user.
+    tokens = [jwt.encode({"sub": "user", "n": n}, "a" * 32) for n in (1, 2, 3, 4)]
+    _storage(local_service, tokens[0])["key"] = "value"
+    for token in tokens[:2]:
+        storage = _storage(local_service, token, shared_cache=True, user_id="user")
+        assert storage["key"] == "value"
+    assert local_service.request_count == 2
+
+    # Without a verified user, tokens only share entries with themselves.
+    for token in tokens[2:] + tokens[2:]:
+        assert _storage(local_service, token, shared_cache=True)["key"] == "value"
+    assert local_service.request_count == 4
+
+    # Another user's entries aren't served.
+    storage = _storage(local_service, tokens[0], shared_cache=True, user_id="other")
+    assert storage.get("key") == "value"
+    assert local_service.request_count == 5
+
+
+def test_reads_overlapping_writes_arent_cached(local_service, shared_cache, mocker):
+    storage = _storage(local_service, shared_cache=True)
+    storage["key"] = "old value"
+    backend = storage._backend
+    assert isinstance(backend, user_storage_cache.CachingBackend)
+    get_if_changed = backend.backend.get_if_changed
+
+    def get_then_write(*args):
+        result = get_if_changed(*args)
+        # A write lands after the read got the old value, but before it's cached.
+        _storage(local_service, shared_cache=True)["key"] = "new value"
+        return result
+
+    mocker.patch.object(backend.backend, "get_if_changed", get_then_write)
+    assert storage["key"] == "old value"
+    mocker.stopall()
+    assert storage["key"] == "new value"
+    assert shared_cache._reads == {}
+
+
+def test_chunks_arent_cached(local_service, shared_cache, monkeypatch):
+    monkeypatch.setattr(user_storage, "CHUNK_SIZE", 10)
+    storage = _storage(local_service, shared_cache=True)
+    storage["large"] = b"x" * 100
+    assert storage["large"] == b"x" * 100
+    assert len(shared_cache) == 1
@@ -0,0 +1,237 @@
+"""A local stand-in for Fixie's user storage service.
+
+It implements the same HTTP API as `constants.FIXIE_USER_STORAGE_URL`, keeping values
+in any UserStorage backend, so that UserStorage can be tested and benchmarked offline.
+
+Usage:
+    with LocalUserStorageService() as service:
+        storage = UserStorage(query, agent_id, userstorage_url=service.url)
+
+For end-to-end benchmarks of an agent, run it as a standalone server:
+
+    python -m fixieai.agents.user_storage_service --port 8765 --database storage.db
+
+and point the agent at it with:
+
+    FIXIE_USER_STORAGE_BACKEND=http://127.0.0.1:8765/api/userstorage
+"""
+
+import hashlib
+import http.server
+import json
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib import parse
+
+import click
+
+from fixieai.agents import user_storage
+from fixieai.agents import user_storage_sqlite
+
+# The path prefix the service is served under, same as the Fixie platform.
+PATH_PREFIX = "/api/userstorage"
+
+
+class LocalUserStorageService:
+    """Serves the user storage API on a local port from a background thread.
+
+    Values are partitioned by bearer token and agent id, the same way the platform
+    partitions them by user and agent.
+
+    Args:
+        host: The address to listen at.
+        port: The port to listen at. By default, a free port is picked.
+        latency: Seconds to wait before answering each request, to simulate the
+            round trip to the real service.
+        backend: Where to keep values. Defaults to an in-memory SQLite database.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        backend: Optional[user_storage.UserStorageBackend] = None,
+    ):
+        self.latency = latency
+        self.request_count = 0
+        self.connection_count = 0
+        # The most requests that were being handled at once.
+        self.max_concurrent_requests = 0
+        self._concurrent_requests = 0
+        self.backend = backend or user_storage_sqlite.SqliteBackend()
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), _make_handler(self)
+        )
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """The URL to pass to UserStorage as `userstorage_url`."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host!s}:{port}{PATH_PREFIX}"
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+
+    def serve_forever(self):
+        """Serves in the current thread until interrupted, then closes the socket."""
+        try:
+            self._server.serve_forever(0.05)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._server.server_close()
+
+    def stop(self):
+        """Stops serving and closes the listening socket."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "LocalUserStorageService":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(
+        self, method: str, path: str, token: str, body: Optional[Dict[str, Any]]
+    ) -> Tuple[int, Any]:
+        """Handles a single API request, and returns the status code and JSON body."""
+        with self._lock:
+            self.request_count += 1
+            self._concurrent_requests += 1
+            self.max_concurrent_requests = max(
+                self.max_concurrent_requests, self._concurrent_requests
+            )
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            return self._handle(method, path, token, body)
+        finally:
+            with self._lock:
+                self._concurrent_requests -= 1
+
+    def _handle(
+        self, method: str, path: str, token: str, body: Optional[Dict[str, Any]]
+    ) -> Tuple[int, Any]:
+        if not path.startswith(PATH_PREFIX + "/"):
+            return 404, {"msg": "not found"}
+        agent_id, _, key = path[len(PATH_PREFIX) + 1 :].partition("/")
+        if not agent_id:
+            return 404, {"msg": "not found"}
+        key = parse.unquote(key)
+
+        if not key:
+            if method != "GET":
+                return 405, {"msg": "method not allowed"}
+            return 200, [
+                {"key": k, "value": v}
+                for k, v in self.backend.iter_items(token, agent_id)
+            ]
+        elif method == "GET" or method == "HEAD":
+            data = self.backend.get(token, agent_id, key)
+            if data is None:
+                return 404, {"msg": "key doesn't exist"}
+            return 200, {"data": data}
+        elif method == "POST":
+            if body is None or not isinstance(body.get("data"), str):
+                return 400, {"msg": "missing data"}
+            self.backend.set(token, agent_id, key, body["data"])
+            return 200, {"msg": "success"}
+        elif method == "DELETE":
+            if not self.backend.delete(token, agent_id, key):
+                return 404, {"msg": "key doesn't exist"}
+            return 200, {"msg": "success"}
+        else:
+            return 405, {"msg": "method not allowed"}
+
+
+def _make_handler(service: LocalUserStorageService):
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            super().setup()
+            with service._lock:
+                service.connection_count += 1
+
+        def _handle(self):
+            authorization = self.headers.get("Authorization", "")
+            if not authorization.startswith("Bearer "):
+                self._respond(401, {"msg": "unauthorized"})
+                return
+            body = None
+            length = int(self.headers.get("Content-Length") or 0)
+            if length:
+                body = json.loads(self.rfile.read(length))
+            status, response = service.handle(
+                self.command,
+                parse.urlsplit(self.path).path,
+                authorization[len("Bearer ") :],
+                body,
+            )
+            etag = None
+            if status == 200 and self.command in ("GET", "HEAD") and "data" in response:
+                # Values are versioned by their content, so that clients can
+                # revalidate cached values.
+                digest = hashlib.sha1(response["data"].encode("utf-8")).hexdigest()
+                etag = f'"{digest}"'
+                if self.headers.get("If-None-Match") == etag:
+                    status, response = 304, None
+            self._respond(status, response, etag)
+
+        def _respond(self, status: int, response: Any, etag: Optional[str] = None):
+            content = b"" if status == 304 else json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            if etag is not None:
+                self.send_header("ETag", etag)
+            self.end_headers()
+            if self.command != "HEAD":
+                self.wfile.write(content)
+
+        do_GET = do_HEAD = do_POST = do_DELETE = _handle
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
+
+
+@click.command()
+@click.option("--host", default="127.0.0.1", help="The address to listen at.")
+@click.option("--port", default=8765, help="The port to listen at.")
+@click.option(
+    "--database",
+    default=":memory:",
+    help="Path to the SQLite database to keep values in. Defaults to memory.",
+)
+@click.option(
+    "--latency",
+    default=0.0,
+    help="Seconds to wait before answering each request.",
+)
+def main(host: str, port: int, database: str, latency: float):
+    """Serves the user storage API locally until interrupted."""
+    service = LocalUserStorageService(
+        host, port, latency, user_storage_sqlite.SqliteBackend(database)
+    )
+    click.echo(f"Serving user storage at {service.url}")
+    service.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""A UserStorage backend that keeps values in a local SQLite database.
+
+It lets agents, and their tests, run without the Fixie service, e.g.:
+
+    FIXIE_USER_STORAGE_BACKEND=sqlite:storage.db fixie agent serve
+
+or with an explicit backend:
+
+    storage = UserStorage(query, agent_id, backend=SqliteBackend("storage.db"))
+"""
+
+import sqlite3
+import threading
+from typing import Iterator, Optional, Tuple
+
+from fixieai.agents import user_storage
+
+# Number of rows read at once when listing keys.
+_LISTING_PAGE_SIZE = 1000
+
+
+class SqliteBackend(user_storage.UserStorageBackend):
+    """Keeps UserStorage values in a SQLite database.
+
+    Users are told apart by the "sub" claim of their access token if it's a JWT that
+    has one, and by the access token itself otherwise, so that values outlive the
+    per-query tokens agents get.
+
+    Args:
+        path: Path to the database file, which is created if needed. Defaults to an
+            in-memory database.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        with self._lock:
+            if path != ":memory:":
+                self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS user_storage ("
+                "user TEXT NOT NULL, agent_id TEXT NOT NULL, key TEXT NOT NULL, "
+                "data TEXT NOT NULL, PRIMARY KEY (user, agent_id, key)"
+                ") WITHOUT ROWID"
+            )
+
+    def get(self, access_token: str, agent_id: str, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM user_storage WHERE user = ? AND agent_id = ? "
+                "AND key = ?",
+                (user_storage._user_id(access_token), agent_id, key),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def set(self, access_token: str, agent_id: str, key: str, data: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO user_storage VALUES (?, ?, ?, ?)",
+                (user_storage._user_id(access_token), agent_id, key, data),
+            )
+
+    def delete(self, access_token: str, agent_id: str, key: str) -> bool:
+        with self._lock:
+            cursor = self._connection.execute(
+                "DELETE FROM user_storage WHERE user = ? AND agent_id = ? AND key = ?",
+                (user_storage._user_id(access_token), agent_id, key),
+            )
+        return cursor.rowcount > 0
+
+    def iter_items(
+        self, access_token: str, agent_id: str
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        # Read a page at a time, so that the lock isn't held while the caller is
+        # consuming the listing.
+        user = user_storage._user_id(access_token)
+        last_key = None
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT key, data FROM user_storage WHERE user = ? AND "
+                    "agent_id = ? AND (? IS NULL OR key > ?) ORDER BY key LIMIT ?",
+                    (user, agent_id, last_key, last_key, _LISTING_PAGE_SIZE),
+                ).fetchall()
+            yield from rows
+            if len(rows) < _LISTING_PAGE_SIZE:
+                return
+            last_key = rows[-1][0]
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._connection.close()
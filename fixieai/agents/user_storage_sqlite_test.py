@@ -0,0 +1,112 @@
+import asyncio
+
+import jwt
+import pytest
+
+from fixieai.agents import api
+from fixieai.agents import oauth
+from fixieai.agents import user_storage
+from fixieai.agents import user_storage_sqlite
+
+AGENT_ID = "fake-agent"
+
+
+def _query(access_token="fake-access-token"):
+    return api.AgentQuery(message=api.Message("query"), access_token=access_token)
+
+
+@pytest.fixture
+def backend():
+    backend = user_storage_sqlite.SqliteBackend()
+    yield backend
+    backend.close()
+
+
+def test_backend_operations(backend):
+    assert backend.get("token", AGENT_ID, "key") is None
+    backend.set("token", AGENT_ID, "key", '"value"')
+    backend.set("token", AGENT_ID, "key", '"new value"')
+    assert backend.get("token", AGENT_ID, "key") == '"new value"'
+    assert backend.contains("token", AGENT_ID, "key")
+    assert list(backend.iter_items("token", AGENT_ID)) == [("key", '"new value"')]
+    assert backend.delete("token", AGENT_ID, "key")
+    assert not backend.delete("token", AGENT_ID, "key")
+    assert not backend.contains("token", AGENT_ID, "key")
+
+
+def test_backend_partitions_by_user_and_agent(backend):
+    first_token = jwt.encode({"sub": "user1", "iat": 1}, "s" * 32, algorithm="HS256")
+    second_token = jwt.encode({"sub": "user1", "iat": 2}, "s" * 32, algorithm="HS256")
+    backend.set(first_token, AGENT_ID, "key", "1")
+    # Another query of the same user.
+    assert backend.get(second_token, AGENT_ID, "key") == "1"
+    assert backend.get(second_token, "other-agent", "key") is None
+    assert backend.get("other-user-token", AGENT_ID, "key") is None
+
+
+def test_backend_lists_in_pages(backend, mocker):
+    mocker.patch.object(user_storage_sqlite, "_LISTING_PAGE_SIZE", 3)
+    for i in range(10):
+        backend.set("token", AGENT_ID, f"key{i}", str(i))
+    items = backend.iter_items("token", AGENT_ID)
+    assert next(items) == ("key0", "0")
+    # The backend stays usable while the listing is consumed.
+    backend.delete("token", AGENT_ID, "key9")
+    assert [key for key, _ in items] == [f"key{i}" for i in range(1, 9)]
+
+
+def test_user_storage_with_backend(backend):
+    storage = user_storage.UserStorage(_query(), AGENT_ID, backend=backend)
+    storage["key"] = {"bytes": b"binary"}
+    storage.set_many({"a": 1, "b": 2})
+    assert storage["key"] == {"bytes": b"binary"}
+    assert dict(storage.items()) == {"a": 1, "b": 2, "key": {"bytes": b"binary"}}
+    del storage["a"]
+    with pytest.raises(KeyError):
+        del storage["a"]
+    assert len(storage) == 2
+
+    with pytest.raises(ValueError):
+        user_storage.UserStorage(
+            _query(), AGENT_ID, userstorage_url="http://localhost", backend=backend
+        )
+
+
+def test_backend_from_environment(tmp_path, monkeypatch):
+    path = tmp_path / "storage.db"
+    monkeypatch.setenv(user_storage.BACKEND_ENV_VAR, f"sqlite:{path}")
+    user_storage.UserStorage(_query(), AGENT_ID)["key"] = "value"
+    assert user_storage.default_backend() is user_storage.default_backend()
+
+    # OAuthHandler stores its state in the same backend.
+    params = oauth.OAuthParams("id", "secret", "http://auth", "http://token", ["x"])
+    oauth.OAuthHandler(params, _query(), AGENT_ID).get_authorization_url()
+
+    reopened = user_storage_sqlite.SqliteBackend(str(path))
+    assert reopened.get("fake-access-token", AGENT_ID, "key") == '"value"'
+    assert reopened.contains(
+        "fake-access-token", AGENT_ID, oauth.OAuthHandler.OAUTH_STATE_KEY
+    )
+    reopened.close()
+
+
+def test_unknown_backend(monkeypatch):
+    monkeypatch.setenv(user_storage.BACKEND_ENV_VAR, "carrier-pigeon")
+    with pytest.raises(ValueError):
+        user_storage.default_backend()
+
+
+def test_async_user_storage_with_backend(backend):
+    storage = user_storage.AsyncUserStorage(_query(), AGENT_ID, backend=backend)
+
+    async def run():
+        await storage.set("key", [1, b"2"])
+        assert await storage.get("key") == [1, b"2"]
+        assert await storage.contains("key")
+        assert await storage.keys() == ["key"]
+        await storage.delete("key")
+        with pytest.raises(KeyError):
+            await storage.delete("key")
+        assert await storage.get("key", "default") == "default"
+
+    asyncio.run(run())
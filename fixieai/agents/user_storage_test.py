@@ -1,11 +1,16 @@
+import asyncio
 import doctest
+import json
 import re
+from typing import List
 
+import aiohttp
 import pytest
 
 from fixieai import constants
 from fixieai.agents import api
 from fixieai.agents import user_storage
+from fixieai.agents import user_storage_service
 
 FAKE_AGENT_ID = "fake-agent"
 FAKE_ACCESS_TOKEN = "fake-access-token"
@@ -33,7 +38,11 @@ class MockUserStorageService:
     def get(self, request, context):
         key = self._parse_request(request)
         if key:
-            return {"data": self._data[key]}
+            try:
+                return {"data": self._data[key]}
+            except KeyError:
+                context.status_code = 404
+                return {"msg": "key doesn't exist"}
         else:
             return [{"key": key, "value": value} for key, value in self._data.items()]
 
@@ -52,7 +61,11 @@ class MockUserStorageService:
     def delete(self, request, context):
         key = self._parse_request(request)
         assert key
-        del self._data[key]
+        try:
+            del self._data[key]
+        except KeyError:
+            context.status_code = 404
+            return {"msg": "key doesn't exist"}
         return {"msg": "success"}
 
 
@@ -66,9 +79,10 @@ def mock_user_storage_urls(requests_mock):
     requests_mock.get(user_storage_path_re, json=mock_storage_service.get)
     requests_mock.head(user_storage_path_re, json=mock_storage_service.head)
     requests_mock.delete(user_storage_path_re, json=mock_storage_service.delete)
+    return mock_storage_service
 
 
-VALUES_TO_TEST = [
+VALUES_TO_TEST: List[user_storage.UserStorageType] = [
     1,
     2.4,
     True,
@@ -79,12 +93,13 @@ VALUES_TO_TEST = [
 ]
 
 
+@pytest.mark.parametrize("cache", [False, True])
 @pytest.mark.parametrize("test_value", VALUES_TO_TEST)
-def test_user_storage(mock_user_storage_urls, test_value):
+def test_user_storage(mock_user_storage_urls, test_value, cache):
     query = api.AgentQuery(
         message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
     )
-    storage = user_storage.UserStorage(query, agent_id=FAKE_AGENT_ID)
+    storage = user_storage.UserStorage(query, agent_id=FAKE_AGENT_ID, cache=cache)
 
     # Add the value and test its existence
     storage["key"] = test_value
@@ -103,5 +118,537 @@ def test_user_storage(mock_user_storage_urls, test_value):
     assert val == "default value"
 
 
+def test_user_storage_cache(mock_user_storage_urls, requests_mock):
+    query = api.AgentQuery(
+        message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
+    )
+    user_storage.UserStorage(query, agent_id=FAKE_AGENT_ID)["counter"] = 1
+    requests_mock.reset_mock()
+
+    storage = user_storage.UserStorage(query, agent_id=FAKE_AGENT_ID, cache=True)
+    assert "counter" in storage
+    counter = storage["counter"]
+    assert isinstance(counter, int)
+    storage["counter"] = counter + 1
+    assert "missing" not in storage
+    assert storage.get("missing") is None
+    storage["new"] = "value"
+    del storage["new"]
+    assert storage["counter"] == 2
+    # Only the two first reads reached the service.
+    assert requests_mock.call_count == 2
+    assert mock_user_storage_urls._data["counter"] == "1"
+
+    storage.flush()
+    assert mock_user_storage_urls._data == {"counter": "2"}
+    # Buffered changes are sent concurrently, so in no particular order.
+    assert sorted(r.method for r in requests_mock.request_history[2:]) == [
+        "DELETE",
+        "POST",
+    ]
+    storage.flush()
+    assert requests_mock.call_count == 4
+
+
 def test_doctest(mock_user_storage_urls):
     doctest.testmod(user_storage, raise_on_error=True)
+
+
+@pytest.fixture
+def local_service():
+    with user_storage_service.LocalUserStorageService() as service:
+        yield service
+
+
+def _local_storage(service, **kwargs):
+    query = api.AgentQuery(
+        message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
+    )
+    return user_storage.UserStorage(
+        query, FAKE_AGENT_ID, userstorage_url=service.url, **kwargs
+    )
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_user_storage_bulk_operations(local_service, cache):
+    storage = _local_storage(local_service, cache=cache)
+    values = {f"key{i}": VALUES_TO_TEST[i % len(VALUES_TO_TEST)] for i in range(20)}
+    storage.set_many(values)
+    storage.flush()
+
+    fresh_storage = _local_storage(local_service)
+    assert fresh_storage.get_many(list(values) + ["missing"]) == values
+    assert sorted(fresh_storage) == sorted(values)
+
+    storage.delete_many(["key0", "key1", "missing"])
+    storage.flush()
+    assert "key0" not in fresh_storage
+    assert len(fresh_storage) == len(values) - 2
+
+
+def test_user_storage_bulk_operations_are_concurrent(local_service):
+    storage = _local_storage(local_service)
+    storage.set_many({f"key{i}": i for i in range(10)})
+    local_service.latency = 0.1
+    local_service.max_concurrent_requests = 0
+
+    assert storage.get_many(f"key{i}" for i in range(10)) == {
+        f"key{i}": i for i in range(10)
+    }
+    assert local_service.max_concurrent_requests > 1
+
+
+def test_user_storage_bulk_operations_use_cache(local_service):
+    _local_storage(local_service).set_many({"a": 1, "b": 2})
+    storage = _local_storage(local_service, cache=True)
+    assert storage["a"] == 1
+    request_count = local_service.request_count
+    assert storage.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+    assert local_service.request_count == request_count + 2
+    assert storage.get_many(["a", "b", "c"]) == {"a": 1, "b": 2}
+    assert local_service.request_count == request_count + 2
+
+
+def test_async_user_storage(local_service):
+    query = api.AgentQuery(
+        message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
+    )
+    storage = user_storage.AsyncUserStorage(
+        query, FAKE_AGENT_ID, userstorage_url=local_service.url
+    )
+
+    async def run():
+        try:
+            for i, value in enumerate(VALUES_TO_TEST):
+                await storage.set(f"key{i}", value)
+            for i, value in enumerate(VALUES_TO_TEST):
+                assert await storage.get(f"key{i}") == value
+            assert await storage.get("missing", "default") == "default"
+            assert await storage.contains("key0")
+            assert not await storage.contains("missing")
+            await storage.delete("key0")
+            with pytest.raises(KeyError):
+                await storage.delete("key0")
+            assert sorted([key async for key in storage]) == sorted(
+                f"key{i}" for i in range(1, len(VALUES_TO_TEST))
+            )
+        finally:
+            await user_storage.close_async_session()
+
+    asyncio.run(run())
+
+    # Values written asynchronously are readable by a sync UserStorage.
+    assert _local_storage(local_service)["key1"] == VALUES_TO_TEST[1]
+
+
+def _async_storage(service, http=True):
+    query = api.AgentQuery(
+        message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
+    )
+    if http:
+        return user_storage.AsyncUserStorage(
+            query, FAKE_AGENT_ID, userstorage_url=service.url
+        )
+    return user_storage.AsyncUserStorage(query, FAKE_AGENT_ID, backend=service.backend)
+
+
+@pytest.mark.parametrize("http", [True, False])
+def test_async_user_storage_chunks_large_values(local_service, small_chunks, http):
+    storage = _async_storage(local_service, http)
+
+    async def run():
+        try:
+            await storage.set("large", LARGE_BYTES)
+            await storage.set("text", "y" * 500)
+            assert await storage.get("large") == LARGE_BYTES
+            assert await storage.get("text") == "y" * 500
+            assert sorted(await storage.keys()) == ["large", "text"]
+            chunk_keys = _chunk_keys(local_service)
+            assert len(chunk_keys) > 11
+
+            # Storing a large value replaces the chunks of the one before.
+            await storage.set("large", LARGE_BYTES[::-1])
+            assert await storage.get("large") == LARGE_BYTES[::-1]
+            assert _chunk_keys(local_service) == chunk_keys
+            await storage.delete("text")
+            assert await storage.keys() == ["large"]
+        finally:
+            await user_storage.close_async_session()
+
+    asyncio.run(run())
+
+
+def test_async_user_storage_raises_server_errors(local_service, monkeypatch):
+    storage = _async_storage(local_service)
+
+    async def run():
+        try:
+            # Only missing keys are treated as such.
+            assert await storage.get("missing", "default") == "default"
+            assert not await storage.contains("missing")
+            with pytest.raises(KeyError):
+                await storage.delete("missing")
+
+            monkeypatch.setattr(
+                local_service, "handle", lambda *args: (500, {"error": "Internal"})
+            )
+            with pytest.raises(aiohttp.ClientResponseError):
+                await storage.get("key", "default")
+            with pytest.raises(aiohttp.ClientResponseError):
+                await storage.contains("key")
+            with pytest.raises(aiohttp.ClientResponseError):
+                await storage.delete("key")
+        finally:
+            await user_storage.close_async_session()
+
+    asyncio.run(run())
+
+
+def test_async_and_sync_storages_share_chunked_values(local_service, small_chunks):
+    _local_storage(local_service)["sync"] = LARGE_BYTES
+    storage = _async_storage(local_service)
+
+    async def run():
+        try:
+            assert await storage.get("sync") == LARGE_BYTES
+            await storage.set("async", ["x" * 30] * 10)
+        finally:
+            await user_storage.close_async_session()
+
+    asyncio.run(run())
+    assert _local_storage(local_service)["async"] == ["x" * 30] * 10
+
+
+def test_user_storages_share_connections(local_service):
+    _local_storage(local_service)["key"] = "value"
+    for _ in range(5):
+        assert _local_storage(local_service)["key"] == "value"
+    assert local_service.connection_count == 1
+
+    # Resizing the pool drops the idle connections.
+    user_storage.set_connection_pool_size(2)
+    try:
+        assert _local_storage(local_service)["key"] == "value"
+        assert local_service.connection_count == 2
+        with pytest.raises(ValueError):
+            user_storage.set_connection_pool_size(0)
+    finally:
+        user_storage.set_connection_pool_size(user_storage.DEFAULT_CONNECTION_POOL_SIZE)
+
+
+def test_user_storage_token_is_per_storage(local_service):
+    other_query = api.AgentQuery(
+        message=api.Message("sample query"), access_token="other-access-token"
+    )
+    other_storage = user_storage.UserStorage(
+        other_query, FAKE_AGENT_ID, userstorage_url=local_service.url
+    )
+    _local_storage(local_service)["key"] = "value"
+    assert "key" not in other_storage
+
+
+def test_user_storage_items(local_service):
+    storage = _local_storage(local_service)
+    storage.set_many({"a/1": 1, "a/2": b"2", "b/1": "3"})
+    request_count = local_service.request_count
+    assert dict(storage.iter_items(prefix="a/")) == {"a/1": 1, "a/2": b"2"}
+    assert sorted(storage.iter_keys(prefix="b/")) == ["b/1"]
+    items = storage.items()
+    assert dict(items) == {"a/1": 1, "a/2": b"2", "b/1": "3"}
+    # Values come with the listing.
+    assert local_service.request_count == request_count + 3
+    # items() is still a view.
+    assert ("b/1", "3") in items
+    assert len(items) == 3
+
+
+def test_user_storage_items_fetches_unlisted_values(requests_mock):
+    url = f"{constants.FIXIE_USER_STORAGE_URL}/{FAKE_AGENT_ID}"
+    requests_mock.get(url, json=[{"key": "a"}, {"key": "b"}])
+    requests_mock.get(f"{url}/a", json={"data": "1"})
+    requests_mock.get(f"{url}/b", status_code=404)
+    query = api.AgentQuery(
+        message=api.Message("sample query"), access_token=FAKE_ACCESS_TOKEN
+    )
+    storage = user_storage.UserStorage(query, FAKE_AGENT_ID)
+    assert list(storage.items()) == [("a", 1)]
+
+
+def test_user_storage_cache_lists_keys_once(local_service):
+    _local_storage(local_service).set_many({"a": 1, "b": 2, "c": 3})
+    storage = _local_storage(local_service, cache=True)
+    storage["d"] = 4
+    del storage["a"]
+    request_count = local_service.request_count
+
+    assert len(storage) == 3
+    assert sorted(storage) == ["b", "c", "d"]
+    assert dict(storage.items()) == {"b": 2, "c": 3, "d": 4}
+    assert storage["b"] == 2
+    assert "missing" not in storage
+    storage["e"] = 5
+    del storage["b"]
+    assert sorted(storage) == ["c", "d", "e"]
+    # Only the first len() reached the service.
+    assert local_service.request_count == request_count + 1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 1000])
+def test_json_array_parser(chunk_size):
+    items = [{"key": "ä", "value": "[1, 2]"}, 12345, "x", [], {}]
+    content = json.dumps(items).encode("utf-8")
+    parser = user_storage._JsonArrayParser()
+    parsed = []
+    for i in range(0, len(content), chunk_size):
+        parsed.extend(parser.feed(content[i : i + chunk_size]))
+    parser.close()
+    assert parsed == items
+
+
+def test_json_array_parser_decodes_large_items_once(mocker):
+    items = [{"key": "large", "value": 'x"\\' * 100000}, {"key": "small"}]
+    content = json.dumps(items).encode("utf-8")
+    parser = user_storage._JsonArrayParser()
+    raw_decode = mocker.spy(parser._decoder, "raw_decode")
+    parsed = []
+    for i in range(0, len(content), 1000):
+        parsed.extend(parser.feed(content[i : i + 1000]))
+    parser.close()
+    assert parsed == items
+    assert raw_decode.call_count == len(items)
+
+
+@pytest.mark.parametrize("content", [b"", b"[1, 2", b"{}", b"[1, }"])
+def test_json_array_parser_rejects_malformed_arrays(content):
+    parser = user_storage._JsonArrayParser()
+    with pytest.raises(ValueError):
+        parser.feed(content)
+        parser.close()
+
+
+@pytest.mark.parametrize("codec", user_storage.CODECS)
+@pytest.mark.parametrize("test_value", VALUES_TO_TEST + [b"\x00" * 10000])
+def test_codecs(test_value, codec):
+    encoded = user_storage.encode(test_value, codec)
+    assert isinstance(encoded, str)
+    assert user_storage.decode(encoded) == test_value
+
+
+@pytest.mark.parametrize("codec", user_storage.CODECS)
+def test_codecs_reject_deep_values(codec):
+    value: user_storage.UserStorageType = b"data"
+    for i in range(1500):
+        value = [value] if i % 2 else {"nested": value}
+    with pytest.raises(ValueError, match="nested"):
+        user_storage.encode(value, codec)
+    with pytest.raises(ValueError, match="nested"):
+        user_storage.decode("[" * 1500 + "]" * 1500)
+
+
+def test_binary_codecs_are_compact():
+    image = bytes(range(256)) * 100
+    json_size = len(user_storage.encode(image, "json"))
+    cbor_size = len(user_storage.encode(image, "cbor"))
+    assert cbor_size < json_size
+    assert len(user_storage.encode(image, "cbor+zlib")) < cbor_size / 10
+    # Values that don't compress are stored uncompressed.
+    assert user_storage.encode(b"short", "cbor+zlib").startswith("~cbor:")
+
+
+def test_codec_can_be_changed(local_service):
+    _local_storage(local_service)["old"] = {"data": b"binary"}
+    storage = _local_storage(local_service, codec="cbor+zlib")
+    storage["new"] = {"data": b"binary"}
+    assert storage["old"] == storage["new"] == {"data": b"binary"}
+    assert _local_storage(local_service)["new"] == {"data": b"binary"}
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        user_storage.encode(1, "pickle")
+    with pytest.raises(ValueError):
+        user_storage.decode("~pickle:gAR9lC4=")
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(user_storage, "CHUNK_SIZE", 100)
+
+
+LARGE_BYTES = bytes(range(256)) * 4
+
+
+@pytest.mark.parametrize("cache", [False, True])
+@pytest.mark.parametrize("value", [LARGE_BYTES, ["x" * 30] * 10, "y" * 500])
+def test_large_values_are_chunked(local_service, small_chunks, cache, value):
+    storage = _local_storage(local_service, cache=cache)
+    storage["large"] = value
+    storage["small"] = 1
+    assert storage["large"] == value
+    storage.flush()
+
+    fresh_storage = _local_storage(local_service)
+    assert fresh_storage["large"] == value
+    assert sorted(fresh_storage) == ["large", "small"]
+    assert len(fresh_storage) == 2
+    assert dict(fresh_storage.items()) == {"large": value, "small": 1}
+    chunk_keys = [
+        key
+        for key, _ in local_service.backend.iter_items(FAKE_ACCESS_TOKEN, FAKE_AGENT_ID)
+        if key.startswith(user_storage.CHUNK_KEY_PREFIX)
+    ]
+    assert len(chunk_keys) > 1
+
+
+@pytest.mark.parametrize(
+    "start,end", [(0, None), (0, 1), (99, 101), (150, 450), (-10, None), (500, 400)]
+)
+def test_read_bytes(local_service, small_chunks, start, end):
+    storage = _local_storage(local_service)
+    storage["large"] = LARGE_BYTES
+    storage["small"] = b"small"
+    assert storage.read_bytes("large", start, end) == LARGE_BYTES[start:end]
+    assert storage.read_bytes("small", start, end) == b"small"[start:end]
+
+
+def test_read_bytes_fetches_only_the_range(local_service, small_chunks):
+    storage = _local_storage(local_service)
+    storage["large"] = LARGE_BYTES
+    count = local_service.request_count
+    chunks = list(storage.iter_bytes("large", 150, 250))
+    assert b"".join(chunks) == LARGE_BYTES[150:250]
+    assert len(chunks) == 2
+    # The manifest, then two chunks.
+    assert local_service.request_count == count + 3
+
+    with pytest.raises(KeyError):
+        storage.read_bytes("missing")
+    storage["text"] = "text"
+    with pytest.raises(TypeError):
+        storage.read_bytes("text")
+
+
+def test_chunks_are_written_concurrently(local_service, small_chunks):
+    storage = _local_storage(local_service)
+    local_service.latency = 0.05
+    storage["large"] = LARGE_BYTES
+    # The 11 chunks are written concurrently, rather than one at a time.
+    assert local_service.max_concurrent_requests > 1
+
+
+def _chunk_keys(service) -> List[str]:
+    return [
+        key
+        for key, _ in service.backend.iter_items(FAKE_ACCESS_TOKEN, FAKE_AGENT_ID)
+        if key.startswith(user_storage.CHUNK_KEY_PREFIX)
+    ]
+
+
+def test_cached_overwrites_delete_chunks(local_service, small_chunks):
+    storage = _local_storage(local_service, cache=True)
+    storage["large"] = LARGE_BYTES
+    storage.flush()
+    storage["large"] = b"small"
+    storage.flush()
+    assert list(local_service.backend.iter_items(FAKE_ACCESS_TOKEN, FAKE_AGENT_ID)) == [
+        ("large", user_storage.encode(b"small"))
+    ]
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_writes_and_deletions_dont_read_values(local_service, cache):
+    _local_storage(local_service).set_many({"replaced": 1, "deleted": 2})
+    storage = _local_storage(local_service, cache=cache)
+    count = local_service.request_count
+    storage["replaced"] = 3
+    storage.delete_many(["deleted"])
+    storage.flush()
+    assert local_service.request_count == count + 2
+
+
+def test_large_values_replace_the_chunks_of_the_one_before(local_service, small_chunks):
+    storage = _local_storage(local_service)
+    storage["large"] = LARGE_BYTES
+    chunk_keys = _chunk_keys(local_service)
+    storage["large"] = LARGE_BYTES[::-1]
+    assert storage["large"] == LARGE_BYTES[::-1]
+    assert _chunk_keys(local_service) == chunk_keys
+    storage["large"] = LARGE_BYTES[:150]
+    assert storage["large"] == LARGE_BYTES[:150]
+    # The chunks beyond the end of the smaller value are left for
+    # delete_orphaned_chunks.
+    assert _chunk_keys(local_service) == chunk_keys
+
+
+def test_reading_chunks_of_a_replaced_value_fails(local_service, small_chunks):
+    storage = _local_storage(local_service)
+    storage["large"] = LARGE_BYTES
+    manifest = local_service.backend.get(FAKE_ACCESS_TOKEN, FAKE_AGENT_ID, "large")
+    storage["large"] = LARGE_BYTES[::-1]
+    # A reader that got the manifest of the value before the chunks were replaced.
+    assert manifest is not None
+    with pytest.raises(ValueError, match="replaced"):
+        storage._decode(manifest)
+
+
+def test_delete_orphaned_chunks(local_service, small_chunks, monkeypatch):
+    storage = _local_storage(local_service)
+    storage.set_many({"kept": LARGE_BYTES, "shrunk": LARGE_BYTES, "deleted": b"x"})
+    # Chunks left behind by a write that failed midway.
+    _, failed_chunks = user_storage._split_value("failed", LARGE_BYTES, "json")
+    for key, data in failed_chunks:
+        storage._store(key, data)
+    storage["shrunk"] = LARGE_BYTES[:150]
+    storage["deleted"] = LARGE_BYTES
+    del storage["deleted"]
+    orphan_count = len(failed_chunks) + (11 - 2) + 11
+
+    # Recent chunks may belong to writes that are still ongoing.
+    assert storage.delete_orphaned_chunks() == 0
+    # Once they're old enough, they are deleted.
+    monkeypatch.setattr(user_storage, "ORPHANED_CHUNK_MIN_AGE", -1.0)
+    assert storage.delete_orphaned_chunks() == orphan_count
+    assert storage.delete_orphaned_chunks() == 0
+    assert len(_chunk_keys(local_service)) == 11 + 2
+    assert storage["kept"] == LARGE_BYTES
+    assert storage["shrunk"] == LARGE_BYTES[:150]
+    assert sorted(storage) == ["kept", "shrunk"]
+
+
+def test_chunked_values_need_a_storage(small_chunks):
+    data, chunks = user_storage._split_value("large", LARGE_BYTES, "json")
+    assert chunks
+    with pytest.raises(ValueError, match="chunks"):
+        user_storage.decode(data)
+
+
+@pytest.mark.parametrize("test_value", VALUES_TO_TEST)
+def test_json_types(test_value):
+    json_value = user_storage.to_json_type(test_value)
+    assert json.loads(json.dumps(json_value)) == json_value
+    assert user_storage.from_json_type(json_value) == test_value
+    assert json.loads(user_storage.to_json(test_value)) == json_value
+
+
+def test_json_types_leave_unchanged_values_alone():
+    unchanged: user_storage.UserStorageType = {"list": [1, 2, {"a": "b"}]}
+    value: user_storage.UserStorageType = {"unchanged": unchanged, "bytes": [b"data"]}
+    json_value = user_storage.to_json_type(value)
+    assert json_value["unchanged"] is unchanged  # type: ignore
+    assert json_value["bytes"] == [{"type": "_bytes_ascii", "data": "ZGF0YQ=="}]  # type: ignore
+    assert value["bytes"] == [b"data"]  # type: ignore
+    decoded = user_storage.from_json_type(json_value)
+    assert decoded == value
+    assert decoded["unchanged"] is unchanged  # type: ignore
+    assert user_storage.from_json_type(unchanged) is unchanged  # type: ignore
+
+
+def test_json_types_of_deep_values():
+    value: user_storage.UserStorageType = b"data"
+    for i in range(10000):
+        value = [value] if i % 2 else {"nested": value}
+    decoded = user_storage.from_json_type(user_storage.to_json_type(value))
+    # Comparing the values would hit the recursion limit.
+    for i in reversed(range(10000)):
+        decoded = decoded[0] if i % 2 else decoded["nested"]  # type: ignore
+    assert decoded == b"data"
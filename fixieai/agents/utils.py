@@ -1,7 +1,10 @@
 import enum
+import hashlib
 import inspect
+import logging
 import re
-from typing import TYPE_CHECKING, Callable, get_type_hints
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, get_type_hints
 from unittest import mock
 
 if TYPE_CHECKING:
@@ -12,18 +15,53 @@ else:
     code_shot = mock.MagicMock()
 
 
+# Name of the on-disk validation cache file, kept next to agent.yaml. It's only
+# written by `fixie agent serve`, and `fixie deploy` never uploads it.
+VALIDATION_CACHE_FILENAME = ".fixie_validation_cache"
+
+
 def strip_prompt_lines(agent_metadata: code_shot.AgentMetadata):
     """Strips all prompt lines."""
-    agent_metadata.base_prompt = _strip_all_lines(agent_metadata.base_prompt)
+    if not _VALIDATION_CACHE.contains(_BASE_PROMPT, agent_metadata.base_prompt):
+        agent_metadata.base_prompt = _strip_all_lines(agent_metadata.base_prompt)
     for i, fewshot in enumerate(agent_metadata.few_shots):
-        agent_metadata.few_shots[i] = _strip_all_lines(fewshot)
+        if not _VALIDATION_CACHE.contains(_FEW_SHOT, fewshot):
+            agent_metadata.few_shots[i] = _strip_all_lines(fewshot)
 
 
 def validate_code_shot_agent(agent_metadata: code_shot.AgentMetadata):
-    """A client-side validation of few_shots and agent."""
-    _validate_base_prompt(agent_metadata.base_prompt)
+    """A client-side validation of few_shots and agent.
+
+    Prompts that have already passed validation (in this process, or in a previous one
+    if a validation cache file is in use) are not validated again.
+    """
+    if not _VALIDATION_CACHE.contains(_BASE_PROMPT, agent_metadata.base_prompt):
+        _validate_base_prompt(agent_metadata.base_prompt)
+        _VALIDATION_CACHE.add(_BASE_PROMPT, agent_metadata.base_prompt)
     for fewshot in agent_metadata.few_shots:
-        _validate_few_shot_prompt(fewshot)
+        if not _VALIDATION_CACHE.contains(_FEW_SHOT, fewshot):
+            _validate_few_shot_prompt(fewshot)
+            _VALIDATION_CACHE.add(_FEW_SHOT, fewshot)
+
+
+def use_validation_cache_file(path: str):
+    """Persists the validation cache at `path`, loading any existing entries from it.
+
+    Args:
+        path: Path to the cache file, usually VALIDATION_CACHE_FILENAME in the agent's
+            directory.
+    """
+    _VALIDATION_CACHE.use_file(path)
+
+
+def flush_validation_cache():
+    """Writes the prompts validated so far to the cache file, if one is in use."""
+    _VALIDATION_CACHE.flush()
+
+
+def clear_validation_cache():
+    """Forgets all previously validated prompts, and stops using any cache file."""
+    _VALIDATION_CACHE.clear()
 
 
 def validate_registered_pyfunc(func: Callable, agent: code_shot.CodeShotAgent):
@@ -40,8 +78,17 @@ def validate_registered_pyfunc(func: Callable, agent: code_shot.CodeShotAgent):
 
     ALLOWED_FUNC_PARAMS = {
         "query": api.Message,
-        "user_storage": user_storage.UserStorage,
-        "oauth_handler": oauth.OAuthHandler,
+        # Async Funcs get the asyncio counterparts of UserStorage and OAuthHandler.
+        "user_storage": (
+            user_storage.AsyncUserStorage
+            if inspect.iscoroutinefunction(func)
+            else user_storage.UserStorage
+        ),
+        "oauth_handler": (
+            oauth.AsyncOAuthHandler
+            if inspect.iscoroutinefunction(func)
+            else oauth.OAuthHandler
+        ),
     }
 
     # Validate that func is a function type.
@@ -99,6 +146,86 @@ def validate_registered_pyfunc(func: Callable, agent: code_shot.CodeShotAgent):
     return func
 
 
+# Kinds of prompts held in the validation cache.
+_BASE_PROMPT = "base_prompt"
+_FEW_SHOT = "few_shot"
+
+
+class _ValidationCache:
+    """A set of digests of normalized prompts that are known to be valid.
+
+    A prompt is only added once it's passed validation and is unchanged by
+    _strip_all_lines, so cached prompts need neither stripping nor validation.
+    """
+
+    # Bump whenever validation rules change, to invalidate existing cache files.
+    VERSION = "fixie-validation-cache-v1"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._digests: Set[str] = set()
+        self._used_digests: Set[str] = set()
+        self._path: Optional[str] = None
+        self._dirty = False
+
+    def contains(self, kind: str, prompt: str) -> bool:
+        digest = self._digest(kind, prompt)
+        if digest not in self._digests:
+            return False
+        self._used_digests.add(digest)
+        return True
+
+    def add(self, kind: str, prompt: str):
+        if _strip_all_lines(prompt) != prompt:
+            return
+        digest = self._digest(kind, prompt)
+        with self._lock:
+            self._digests.add(digest)
+            self._used_digests.add(digest)
+            self._dirty = True
+
+    def use_file(self, path: str):
+        self._path = path
+        try:
+            with open(path, "r") as fp:
+                lines = fp.read().splitlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logging.warning(f"Cannot read validation cache {path!r}: {e}")
+            return
+        if lines and lines[0] == self.VERSION:
+            with self._lock:
+                self._digests.update(lines[1:])
+
+    def flush(self):
+        """Writes the digests used by this process to the cache file, if changed."""
+        if self._path is None or not self._dirty:
+            return
+        with self._lock:
+            contents = "\n".join([self.VERSION] + sorted(self._used_digests)) + "\n"
+            self._dirty = False
+        try:
+            with open(self._path, "w") as fp:
+                fp.write(contents)
+        except OSError as e:
+            logging.warning(f"Cannot write validation cache {self._path!r}: {e}")
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+            self._used_digests.clear()
+            self._path = None
+            self._dirty = False
+
+    @staticmethod
+    def _digest(kind: str, prompt: str) -> str:
+        return hashlib.sha256(f"{kind}\0{prompt}".encode("utf-8")).hexdigest()
+
+
+_VALIDATION_CACHE = _ValidationCache()
+
+
 def _strip_all_lines(prompt: str) -> str:
     prompt = prompt.strip()
     return "\n".join(line.strip() for line in prompt.splitlines())
@@ -140,19 +267,62 @@ class FewshotLinePattern(enum.Enum):
                 "Cannot get the pattern for a multi-line text. Patterns must be "
                 "extracted one line at a time."
             )
-        pattern_matches = [
-            prompt_pattern
-            for prompt_pattern in cls
-            if prompt_pattern is not cls.NO_PATTERN and prompt_pattern.value.match(line)
-        ]
-        if len(pattern_matches) > 1:
-            raise RuntimeError(
-                f"More than one pattern ({pattern_matches}) matched the line {line!r}."
-            )
-        elif len(pattern_matches) == 1:
-            return pattern_matches[0]
-        else:
-            return cls.NO_PATTERN
+        return _classify_line(line)
+
+    @classmethod
+    def patterns(cls, few_shot: str) -> List["FewshotLinePattern"]:
+        """Returns the matched PromptPattern for every line of a few-shot."""
+        return _classify_lines(few_shot.splitlines(False))
+
+
+# A single regex that classifies a line against all FewshotLinePatterns in one pass.
+# Each alternative is a named group after its enum member. The patterns have disjoint
+# prefixes, so at most one alternative can ever match a given line.
+_FEWSHOT_LINE_RE = re.compile(
+    "|".join(
+        f"(?P<{line_pattern.name}>{line_pattern.value.pattern})"
+        for line_pattern in FewshotLinePattern
+        if line_pattern is not FewshotLinePattern.NO_PATTERN
+    )
+)
+_PATTERNS_BY_GROUP_NAME: Dict[Optional[str], FewshotLinePattern] = {
+    line_pattern.name: line_pattern for line_pattern in FewshotLinePattern
+}
+
+
+def _classify_line(line: str) -> FewshotLinePattern:
+    match = _FEWSHOT_LINE_RE.match(line)
+    if match is None:
+        return FewshotLinePattern.NO_PATTERN
+    return _PATTERNS_BY_GROUP_NAME[match.lastgroup]
+
+
+def _classify_lines(lines: List[str]) -> List[FewshotLinePattern]:
+    match_line = _FEWSHOT_LINE_RE.match
+    no_pattern = FewshotLinePattern.NO_PATTERN
+    patterns_by_group_name = _PATTERNS_BY_GROUP_NAME
+    line_patterns = []
+    for line in lines:
+        match = match_line(line)
+        line_patterns.append(
+            no_pattern if match is None else patterns_by_group_name[match.lastgroup]
+        )
+    return line_patterns
+
+
+class FewShotValidationError(ValueError):
+    """Raised when a few-shot prompt is malformed.
+
+    Attributes:
+        msg: A description of the problem, without the offending prompt.
+        line: The 1-based line number within the few-shot the problem was found at,
+            if it can be pinned to a line.
+    """
+
+    def __init__(self, msg: str, prompt: str, line: Optional[int] = None):
+        super().__init__(f"{msg} in few-shot prompt: {prompt!r}.")
+        self.msg = msg
+        self.line = line
 
 
 def _validate_few_shot_prompt(prompt: str):
@@ -161,29 +331,33 @@ def _validate_few_shot_prompt(prompt: str):
 
     # Check that no line starts or ends in a whitespace.
     whitespaces = (" ", "\t", "\r")
-    bad_lines = [
-        line
-        for line in lines
+    bad_line_numbers = [
+        i + 1
+        for i, line in enumerate(lines)
         if line.startswith(whitespaces) or line.endswith(whitespaces)
     ]
+    bad_lines = [lines[i - 1] for i in bad_line_numbers]
     _assert(
         not bad_lines,
         f"Some lines in the fewshot start or end in whitespaces: {bad_lines!r}.",
         prompt,
+        bad_line_numbers[0] if bad_line_numbers else None,
     )
 
     # Check that it doesn't end with newline
-    _assert(not prompt.endswith("\n"), "Fewshot ends with newline.", prompt)
+    _assert(not prompt.endswith("\n"), "Fewshot ends with newline.", prompt, len(lines))
 
     # Check that fewshot starts with a Q:, ends in an A:, and a Func says and Agent
     # says follows every Ask Func and Ask Agent.
-    lines_patterns = [FewshotLinePattern.pattern(line) for line in lines]
+    lines_patterns = _classify_lines(lines)
     _assert(
-        lines_patterns[0] is FewshotLinePattern.QUERY,
+        bool(lines_patterns) and lines_patterns[0] is FewshotLinePattern.QUERY,
         "Fewshot must start with a 'Q:'",
         prompt,
+        1,
     )
     last_pattern = FewshotLinePattern.QUERY
+    last_pattern_line = 1
     for i, pattern in enumerate(lines_patterns):
         if pattern is FewshotLinePattern.ASK_AGENT:
             _assert(
@@ -191,6 +365,7 @@ def _validate_few_shot_prompt(prompt: str):
                 and lines_patterns[i + 1] is FewshotLinePattern.AGENT_SAYS,
                 "Each 'Ask Agent' line must be followed by an 'Agent says' line.",
                 prompt,
+                i + 1,
             )
         if pattern is FewshotLinePattern.ASK_FUNC:
             _assert(
@@ -198,29 +373,43 @@ def _validate_few_shot_prompt(prompt: str):
                 and lines_patterns[i + 1] is FewshotLinePattern.FUNC_SAYS,
                 "Each 'Ask Func' line must be followed by an 'Func says' line.",
                 prompt,
+                i + 1,
             )
         if pattern is not FewshotLinePattern.NO_PATTERN:
             last_pattern = pattern
+            last_pattern_line = i + 1
     _assert(
         last_pattern is FewshotLinePattern.RESPONSE,
         f"Fewshot must end with a 'A:' pattern, but it ends with {last_pattern}",
         prompt,
+        last_pattern_line,
     )
 
     # Check that there's Q: and A: lines are interleaved.
-    all_qa_lines = [
-        "Q" if pattern is FewshotLinePattern.QUERY else "A"
-        for pattern in lines_patterns
+    qa_lines = [
+        (i + 1, "Q" if pattern is FewshotLinePattern.QUERY else "A")
+        for i, pattern in enumerate(lines_patterns)
         if pattern in (FewshotLinePattern.QUERY, FewshotLinePattern.RESPONSE)
     ]
-    qa_str = "".join(all_qa_lines)
-    _assert(
-        qa_str.replace("QA", "") == "",
-        "Q: and A: lines must be interleaved in fewshot.",
-        prompt,
-    )
+    qa_str = "".join(qa for _, qa in qa_lines)
+    if qa_str.replace("QA", "") != "":
+        # Point at the first Q: or A: line that breaks the alternation.
+        misplaced_line = next(
+            (
+                line_number
+                for j, (line_number, qa) in enumerate(qa_lines)
+                if qa != "QA"[j % 2]
+            ),
+            None,
+        )
+        _assert(
+            False,
+            "Q: and A: lines must be interleaved in fewshot.",
+            prompt,
+            misplaced_line,
+        )
 
 
-def _assert(condition: bool, msg: str, prompt: str):
+def _assert(condition: bool, msg: str, prompt: str, line: Optional[int] = None):
     if not condition:
-        raise ValueError(f"{msg} in few-shot prompt: {prompt!r}.")
+        raise FewShotValidationError(msg, prompt, line)
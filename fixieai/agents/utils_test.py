@@ -1,3 +1,5 @@
+import os
+
 import pytest
 
 from fixieai.agents import utils
@@ -73,3 +75,80 @@ A: I replaced the background with a beautiful sunset: [image2]""",
 @pytest.mark.parametrize("good_prompt", GOOD_PROMPTS)
 def test_fewshot_prompt_succeeds_with_good_prompt(good_prompt):
     utils._validate_few_shot_prompt(good_prompt)
+
+
+@pytest.mark.parametrize(
+    "line,expected_pattern",
+    [
+        ("Q: Who is the president?", utils.FewshotLinePattern.QUERY),
+        ("Agent[search] says: Joe Biden", utils.FewshotLinePattern.AGENT_SAYS),
+        ("Func[edit] says: [image2]", utils.FewshotLinePattern.FUNC_SAYS),
+        ("Ask Agent[search]: Who?", utils.FewshotLinePattern.ASK_AGENT),
+        ("Ask Func[edit]: A sunset", utils.FewshotLinePattern.ASK_FUNC),
+        ("A: It's Joe Biden.", utils.FewshotLinePattern.RESPONSE),
+        ("Some free-form text", utils.FewshotLinePattern.NO_PATTERN),
+        ("Ask Func[]: no name", utils.FewshotLinePattern.NO_PATTERN),
+        (" Q: leading whitespace", utils.FewshotLinePattern.NO_PATTERN),
+    ],
+)
+def test_fewshot_line_pattern(line, expected_pattern):
+    assert utils.FewshotLinePattern.pattern(line) is expected_pattern
+
+
+def test_fewshot_line_pattern_rejects_multiline():
+    with pytest.raises(ValueError):
+        utils.FewshotLinePattern.pattern("Q: Hi\nA: Hello")
+
+
+@pytest.mark.parametrize("prompt", GOOD_PROMPTS + BAD_PROMPTS)
+def test_fewshot_line_patterns_matches_per_line_pattern(prompt):
+    assert utils.FewshotLinePattern.patterns(prompt) == [
+        utils.FewshotLinePattern.pattern(line) for line in prompt.splitlines()
+    ]
+
+
+@pytest.fixture
+def validation_cache():
+    utils.clear_validation_cache()
+    yield
+    utils.clear_validation_cache()
+
+
+def _agent_metadata(few_shots):
+    from fixieai.agents import code_shot
+
+    return code_shot.AgentMetadata("A base prompt.", list(few_shots))
+
+
+def test_validation_cache_skips_validated_few_shots(validation_cache, mocker):
+    spy = mocker.spy(utils, "_validate_few_shot_prompt")
+    _agent_metadata(GOOD_PROMPTS)
+    assert spy.call_count == len(GOOD_PROMPTS)
+
+    spy.reset_mock()
+    _agent_metadata(GOOD_PROMPTS[:-1] + ["Q: A new few-shot\nA: Sure."])
+    assert spy.call_count == 1
+
+
+def test_validation_cache_does_not_cache_failures(validation_cache):
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            _agent_metadata([BAD_PROMPTS[0]])
+
+
+def test_validation_cache_file(validation_cache, tmp_path, mocker):
+    cache_path = str(tmp_path / utils.VALIDATION_CACHE_FILENAME)
+    utils.use_validation_cache_file(cache_path)
+    _agent_metadata(GOOD_PROMPTS)
+    # Validating agents never writes the file by itself.
+    assert not os.path.exists(cache_path)
+    utils.flush_validation_cache()
+    with open(cache_path) as fp:
+        assert len(fp.read().splitlines()) == len(GOOD_PROMPTS) + 2
+
+    # A fresh process only validates the few-shots missing from the file.
+    utils.clear_validation_cache()
+    utils.use_validation_cache_file(cache_path)
+    spy = mocker.spy(utils, "_validate_few_shot_prompt")
+    _agent_metadata(GOOD_PROMPTS + ["Q: A new few-shot\nA: Sure."])
+    assert spy.call_count == 1
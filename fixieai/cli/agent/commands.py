@@ -1,6 +1,9 @@
 import contextlib
+import dataclasses
 import functools
+import importlib
 import io
+import json
 import os
 import pathlib
 import random
@@ -17,9 +20,12 @@ import validators
 
 import fixieai.client
 from fixieai import constants
+from fixieai.agents import prompt_analysis
+from fixieai.agents import utils
 from fixieai.cli.agent import agent_config
 from fixieai.cli.agent import loader
 from fixieai.cli.agent import tunnel as tunnel_
+from fixieai.cli.agent import validator
 
 # Regex pattern to match valid entry points: "module:object"
 VAR_NAME_RE = r"(?![0-9])\w+"
@@ -68,6 +74,12 @@ def _validate_entry_point(ctx, param, value):
             return value
 
 
+def _validate_tokenizer(ctx, param, value):
+    if value and not ENTRY_POINT_PATTERN.match(value):
+        raise click.BadParameter("must be in module:function format")
+    return value
+
+
 def _update_agent_requirements(
     existing_requirements: List[str], new_requirements: List[str]
 ) -> List[str]:
@@ -303,6 +315,110 @@ def _ensure_agent_updated(
     return agent
 
 
+@agent.command("validate", help="Validate the current agent without serving it.")
+@click.argument("path", callback=_validate_agent_path, required=False)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    help="Output format for the diagnostics.",
+)
+@click.option(
+    "--jobs",
+    type=int,
+    default=None,
+    help="Number of worker processes. Defaults to the number of CPUs.",
+)
+def validate(path, output_format, jobs):
+    _, agent_impl = loader.load_agent_from_path(path)
+    diagnostics = validator.validate_agent(agent_impl, jobs)
+
+    if output_format == "json":
+        click.echo(
+            json.dumps(
+                {
+                    "valid": not diagnostics,
+                    "errors": [dataclasses.asdict(d) for d in diagnostics],
+                },
+                indent=2,
+            )
+        )
+    elif diagnostics:
+        for diagnostic in diagnostics:
+            click.secho(str(diagnostic), fg="red")
+        click.secho(f"Found {len(diagnostics)} error(s).", fg="red")
+    else:
+        click.secho("Agent is valid.", fg="green")
+
+    if diagnostics:
+        raise click.exceptions.Exit(1)
+
+
+@agent.command(
+    "analyze", help="Analyze the token budget and duplicates of the agent's prompts."
+)
+@click.argument("path", callback=_validate_agent_path, required=False)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["text", "json"]),
+    default="text",
+    help="Output format for the analysis.",
+)
+@click.option(
+    "--tokenizer",
+    default=None,
+    callback=_validate_tokenizer,
+    help="A module:function that counts the tokens in a string. Defaults to a local "
+    "estimate.",
+)
+@click.option(
+    "--threshold",
+    type=click.FloatRange(0, 1),
+    default=0.8,
+    help="Minimum similarity for few-shots to be reported as near-duplicates.",
+)
+def analyze(path, output_format, tokenizer, threshold):
+    _, agent_impl = loader.load_agent_from_path(path)
+    token_counter = prompt_analysis.estimate_tokens
+    if tokenizer:
+        module_name, attr = tokenizer.split(":")
+        token_counter = getattr(importlib.import_module(module_name), attr)
+    analysis = prompt_analysis.analyze_agent(agent_impl, token_counter, threshold)
+
+    if output_format == "json":
+        click.echo(
+            json.dumps(
+                {
+                    **dataclasses.asdict(analysis),
+                    "total_tokens": analysis.total_tokens,
+                    "covering_subset_tokens": analysis.covering_subset_tokens,
+                },
+                indent=2,
+            )
+        )
+        return
+
+    click.echo(f"Base prompt: {analysis.base_prompt_tokens} tokens")
+    click.echo(
+        f"Few-shots: {len(analysis.few_shot_tokens)} few-shots, "
+        f"{sum(analysis.few_shot_tokens)} tokens"
+    )
+    click.secho(f"Total: {analysis.total_tokens} tokens", fg="green")
+    for group in analysis.exact_duplicates:
+        click.secho(f"Identical few-shots: {group}", fg="yellow")
+    for first, second, similarity in analysis.near_duplicates:
+        click.secho(
+            f"Similar few-shots: [{first}, {second}] ({similarity:.0%})", fg="yellow"
+        )
+    click.echo(
+        f"{len(analysis.covering_subset)} few-shots cover every Ask Func/Ask Agent "
+        f"pattern ({analysis.covering_subset_tokens} tokens with the base prompt): "
+        f"{analysis.covering_subset}"
+    )
+
+
 @agent.command(
     "serve", help="Serve the current agent locally via a publicly-accessible URL."
 )
@@ -357,8 +473,11 @@ def serve(ctx, path, host, port, tunnel, reload):
                 reload_dirs=["."],
             )
         else:
-            _, agent_impl = loader.load_agent_from_path(".")
-            agent_impl.serve(agent_api.agent_id, host, port)
+            _, agent_impl = loader.load_agent_from_path(".", validation_cache=True)
+            app = agent_impl.app(agent_api.agent_id)
+            # The app has validated the agent's prompts.
+            utils.flush_validation_cache()
+            uvicorn.run(app, host=host, port=port)
 
 
 _DEPLOYMENT_BOOTSTRAP_SOURCE = """
@@ -417,6 +536,9 @@ def deploy(ctx, path, metadata_only):
                     del dirs[i]
 
             for filename in files:
+                if filename == utils.VALIDATION_CACHE_FILENAME:
+                    # Only used locally, by `fixie agent serve`.
+                    continue
                 if filename.startswith("."):
                     console.print(
                         f"Ignoring hidden file {os.path.join(root, filename)}",
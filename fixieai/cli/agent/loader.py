@@ -5,6 +5,7 @@ import sys
 from typing import Tuple
 
 from fixieai import agents
+from fixieai.agents import utils
 from fixieai.cli.agent import agent_config
 
 
@@ -25,13 +26,25 @@ def _ensure_serving_disabled():
 
 
 def load_agent_from_path(
-    path: str,
+    path: str, validation_cache: bool = False
 ) -> Tuple[agent_config.AgentConfig, agents.CodeShotAgent]:
-    """Loads an Agent and its config from a path."""
+    """Loads an Agent and its config from a path.
+
+    Args:
+        path: Path to agent.yaml, or to the directory containing it.
+        validation_cache: Whether to cache prompt validation results in a file next to
+            agent.yaml, so that reloads only re-validate the few-shots that changed.
+            Only local development commands should set this, and call
+            utils.flush_validation_cache() once the agent has been validated.
+    """
 
     path = agent_config.normalize_path(path)
     config = agent_config.load_config(path)
     agent_dir = os.path.dirname(path)
+    if validation_cache:
+        utils.use_validation_cache_file(
+            os.path.join(agent_dir, utils.VALIDATION_CACHE_FILENAME)
+        )
 
     # Inject the agent directory into PYTHONPATH
     sys.path.insert(0, agent_dir)
@@ -51,5 +64,10 @@ def uvicorn_app_factory():
     The FIXIE_AGENT_PATH environment variable should be set if agent.yaml is not in the current directory.
     The FIXIE_REFRESH_AGENT_ID environment variable can be set to trigger a refresh on startup.
     """
-    _, impl = load_agent_from_path(os.getenv("FIXIE_AGENT_PATH", "."))
-    return impl.app(os.getenv("FIXIE_REFRESH_AGENT_ID"))
+    _, impl = load_agent_from_path(
+        os.getenv("FIXIE_AGENT_PATH", "."), validation_cache=True
+    )
+    app = impl.app(os.getenv("FIXIE_REFRESH_AGENT_ID"))
+    # The app has validated the agent's prompts.
+    utils.flush_validation_cache()
+    return app
@@ -0,0 +1,97 @@
+"""Validates an agent's prompts and Func references without serving it."""
+
+import concurrent.futures
+import dataclasses
+import os
+import re
+from typing import List, Optional, Tuple
+
+from fixieai import agents
+from fixieai.agents import utils
+
+# Regex that extracts the Func name from an "Ask Func[name]:" line.
+_ASK_FUNC_RE = re.compile(r"^Ask Func\[(\w+)]:")
+
+
+@dataclasses.dataclass
+class Diagnostic:
+    """A single problem found in an agent's prompts."""
+
+    message: str
+    # Index of the offending few-shot in agent.few_shots, or None for the base prompt.
+    few_shot: Optional[int] = None
+    # 1-based line number within the (stripped) few-shot, if known.
+    line: Optional[int] = None
+
+    def __str__(self) -> str:
+        location = (
+            "base_prompt" if self.few_shot is None else f"few_shots[{self.few_shot}]"
+        )
+        if self.line is not None:
+            location += f", line {self.line}"
+        return f"{location}: {self.message}"
+
+
+def validate_agent(
+    agent: agents.CodeShotAgent, jobs: Optional[int] = None
+) -> List[Diagnostic]:
+    """Validates all prompts of `agent` and returns every problem found.
+
+    Few-shots are validated in parallel across a process pool. Unlike the validation
+    that happens on handshake, this doesn't stop at the first bad few-shot.
+
+    Args:
+        agent: The agent to validate.
+        jobs: Number of worker processes to use. Defaults to the number of CPUs. If 1,
+            few-shots are validated in the current process.
+    """
+    diagnostics: List[Diagnostic] = []
+    try:
+        utils._validate_base_prompt(utils._strip_all_lines(agent.base_prompt))
+    except ValueError as e:
+        diagnostics.append(Diagnostic(str(e)))
+
+    few_shots = [utils._strip_all_lines(few_shot) for few_shot in agent.few_shots]
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(few_shots) < 2:
+        results = list(map(_validate_few_shot, few_shots))
+    else:
+        chunksize = max(1, len(few_shots) // (jobs * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(
+                executor.map(_validate_few_shot, few_shots, chunksize=chunksize)
+            )
+
+    for i, (few_shot, errors) in enumerate(zip(few_shots, results)):
+        diagnostics.extend(Diagnostic(msg, i, line) for line, msg in errors)
+        diagnostics.extend(
+            Diagnostic(msg, i, line)
+            for line, msg in _check_func_references(few_shot, agent)
+        )
+    return diagnostics
+
+
+def _validate_few_shot(few_shot: str) -> List[Tuple[Optional[int], str]]:
+    """Returns (line, message) for the problem in a few-shot, if any.
+
+    This runs in pool worker processes, so it must stay a picklable top-level function.
+    """
+    try:
+        utils._validate_few_shot_prompt(few_shot)
+    except utils.FewShotValidationError as e:
+        return [(e.line, e.msg)]
+    return []
+
+
+def _check_func_references(
+    few_shot: str, agent: agents.CodeShotAgent
+) -> List[Tuple[Optional[int], str]]:
+    """Returns (line, message) for every "Ask Func" to a Func the agent lacks."""
+    errors: List[Tuple[Optional[int], str]] = []
+    for i, line in enumerate(few_shot.splitlines()):
+        match = _ASK_FUNC_RE.match(line)
+        if match and match.group(1) not in agent._funcs:
+            errors.append(
+                (i + 1, f"Func[{match.group(1)}] is not registered with the agent.")
+            )
+    return errors
@@ -0,0 +1,84 @@
+import json
+import sys
+
+import pytest
+
+from fixieai import agents
+
+from . import loader
+from . import validator
+
+BASE_PROMPT = "I am a simple dummy agent."
+FEW_SHOTS = [
+    """Q: Sample query 1
+Ask Func[simple]: Simple argument
+Func[simple] says: Simple response
+A: Simple final response""",
+    # Ask Func without Func says
+    """Q: Sample query 2
+Ask Func[simple]: Simple argument
+A: Simple final response""",
+    # Unregistered Func
+    """Q: Sample query 3
+Ask Func[missing]: Simple argument
+Func[missing] says: Simple response
+A: Simple final response""",
+    # Q: and A: are not interleaved
+    """Q: Sample query 4
+A: Simple response
+A: Another simple response""",
+]
+
+
+@pytest.fixture
+def dummy_agent():
+    agent = agents.CodeShotAgent(BASE_PROMPT, FEW_SHOTS)
+
+    @agent.register_func
+    def simple(query):
+        return "Simple response"
+
+    return agent
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_validate_agent_reports_all_errors(dummy_agent, jobs):
+    diagnostics = validator.validate_agent(dummy_agent, jobs=jobs)
+    assert [(d.few_shot, d.line) for d in diagnostics] == [(1, 2), (2, 2), (3, 3)]
+    assert "Func[missing]" in diagnostics[1].message
+    assert str(diagnostics[0]) == (
+        "few_shots[1], line 2: Each 'Ask Func' line must be followed by an "
+        "'Func says' line."
+    )
+
+
+def test_validate_agent_valid(dummy_agent):
+    dummy_agent.few_shots = FEW_SHOTS[:1]
+    assert validator.validate_agent(dummy_agent, jobs=1) == []
+
+
+def test_validate_agent_from_path(tmp_path):
+    (tmp_path / "agent.yaml").write_text(
+        "handle: path-agent\nentry_point: main:agent\n"
+    )
+    (tmp_path / "few_shots.jsonl").write_text(
+        "\n".join(json.dumps(few_shot) for few_shot in FEW_SHOTS)
+    )
+    (tmp_path / "main.py").write_text(
+        "from fixieai import agents\n"
+        f"agent = agents.CodeShotAgent({BASE_PROMPT!r}, "
+        "few_shots_path='few_shots.jsonl')\n"
+        "@agent.register_func\n"
+        "def simple(query):\n"
+        "    return 'Simple response'\n"
+    )
+    try:
+        _, agent = loader.load_agent_from_path(str(tmp_path))
+    finally:
+        sys.path.remove(str(tmp_path))
+        sys.modules.pop("main", None)
+
+    # The few-shots the agent loaded are validated, rather than read again.
+    (tmp_path / "few_shots.jsonl").unlink()
+    diagnostics = validator.validate_agent(agent, jobs=1)
+    assert [(d.few_shot, d.line) for d in diagnostics] == [(1, 2), (2, 2), (3, 3)]
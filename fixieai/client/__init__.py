@@ -1,13 +1,17 @@
+from fixieai.client.client import AsyncFixieClient
 from fixieai.client.client import FixieClient
 from fixieai.client.client import get_agents
 from fixieai.client.client import get_client
 from fixieai.client.client import get_embeds
 from fixieai.client.client import query
+from fixieai.client.client import query_many
 
 __all__ = [
     "FixieClient",
+    "AsyncFixieClient",
     "get_agents",
     "get_client",
     "get_embeds",
     "query",
+    "query_many",
 ]
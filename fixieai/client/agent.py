@@ -1,34 +1,170 @@
 from __future__ import annotations
 
 import datetime
-from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple
 
 from gql import gql
+from graphql import DocumentNode
+
+from fixieai.client import documents
 
 if TYPE_CHECKING:
     import fixieai.client as fixie_client
 
     FixieClient = fixie_client.FixieClient
+    AsyncFixieClient = fixie_client.AsyncFixieClient
 else:
     FixieClient = Any
+    AsyncFixieClient = Any
+
+
+# The fields of an Agent's metadata.
+_AGENT_FIELDS = """
+    agentId
+    handle
+    name
+    description
+    queries
+    moreInfoUrl
+    published
+    owner {
+        username
+    }
+    queryUrl
+    funcUrl
+    created
+    modified
+"""
+
+_GET_AGENT_BY_HANDLE_QUERY = documents.register(
+    """
+    query getAgentByHandle($handle: String!) {
+        agentByHandle(handle: $handle) {
+            %s
+        }
+    }
+"""
+    % _AGENT_FIELDS
+)
+
+_GET_AGENT_BY_ID_QUERY = documents.register(
+    """
+    query getAgentById($agentId: String!) {
+        agentById(agentId: $agentId) {
+            %s
+        }
+    }
+"""
+    % _AGENT_FIELDS
+)
+
+_CREATE_AGENT_MUTATION = documents.register(
+    """
+    mutation CreateAgent(
+        $handle: String!,
+        $name: String!,
+        $description: String!,
+        $queryUrl: String,
+        $funcUrl: String,
+        $moreInfoUrl: String,
+        $published: Boolean) {
+        createAgent(
+            agentData: {
+                handle: $handle,
+                name: $name,
+                description: $description,
+                queryUrl: $queryUrl,
+                funcUrl: $funcUrl,
+                moreInfoUrl: $moreInfoUrl,
+                published: $published
+            }
+        ) {
+            agent {
+                agentId
+            }
+        }
+    }
+"""
+)
 
+_UPDATE_AGENT_MUTATION = documents.register(
+    """
+    mutation UpdateAgent(
+        $handle: String!,
+        $newHandle: String,
+        $name: String,
+        $description: String,
+        $queryUrl: String,
+        $funcUrl: String,
+        $moreInfoUrl: String,
+        $published: Boolean) {
+        updateAgent(
+            agentData: {
+                handle: $handle,
+                newHandle: $newHandle,
+                name: $name,
+                description: $description,
+                queryUrl: $queryUrl,
+                funcUrl: $funcUrl,
+                moreInfoUrl: $moreInfoUrl,
+                published: $published
+            }
+        ) {
+            agent {
+                agentId
+            }
+        }
+    }
+"""
+)
 
-class Agent:
-    """Provides an interface to the Fixie GraphQL Agent API.
+_DELETE_AGENT_MUTATION = documents.register(
+    """
+    mutation DeleteAgent($handle: String!) {
+        deleteAgent(handle: $handle) {
+            agent {
+                handle
+            }
+        }
+    }
+"""
+)
 
-    Args:
-        client: The FixieClient instance to use.
-        agent_id: The Agent ID, e.g., "fixie/calc", or handle, e.g., "dice".
+
+def _get_agents_request(
+    agent_ids: Sequence[str],
+) -> Tuple[DocumentNode, Dict[str, Any]]:
+    """Return a query for the metadata of many Agents, and its variables.
+
+    The metadata of the i-th Agent is in the field "agent{i}" of the result. Agent
+    IDs are looked up with `agentById`, and handles with `agentByHandle`. There's
+    no end to the combinations of lookups, so the query isn't registered, and is
+    always sent in full.
     """
+    parameters = []
+    fields = []
+    variable_values: Dict[str, Any] = {}
+    for index, agent_id in enumerate(agent_ids):
+        if "/" in agent_id:
+            parameters.append(f"$agentId{index}: String!")
+            fields.append(f"agent{index}: agentById(agentId: $agentId{index})")
+            variable_values[f"agentId{index}"] = agent_id
+        else:
+            parameters.append(f"$handle{index}: String!")
+            fields.append(f"agent{index}: agentByHandle(handle: $handle{index})")
+            variable_values[f"handle{index}"] = agent_id
+    text = "query getAgentsById%d(%s) {\n%s\n}\n" % (
+        len(agent_ids),
+        ", ".join(parameters),
+        "\n".join(f"{field} {{{_AGENT_FIELDS}}}" for field in fields),
+    )
+    return gql(text), variable_values
 
-    def __init__(
-        self,
-        client: FixieClient,
-        agent_id: str,
-    ):
-        self._client = client
-        self._gqlclient = self._client.gqlclient
 
+class _AgentBase:
+    """The parts of Agent and AsyncAgent that don't talk to the Fixie API."""
+
+    def __init__(self, agent_id: str):
         self._agent_id = agent_id
         self._owner: Optional[str] = None
         if "/" in agent_id:
@@ -37,10 +173,6 @@ class Agent:
             self._handle = agent_id
 
         self._metadata: Optional[Dict[str, Any]] = None
-        try:
-            self._metadata = self.get_metadata()
-        except:
-            self._metadata = None
 
     @property
     def agent_id(self) -> str:
@@ -55,32 +187,35 @@ class Agent:
     @property
     def valid(self) -> bool:
         """Return whether this Agent is valid."""
-        return self._metadata is not None
+        return self._loaded_metadata() is not None
 
     @property
     def name(self) -> Optional[str]:
         """Return the name for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        name = self._metadata["name"]
+        name = metadata["name"]
         assert name is None or isinstance(name, str)
         return name
 
     @property
     def description(self) -> Optional[str]:
         """Return the description for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        description = self._metadata["description"]
+        description = metadata["description"]
         assert description is None or isinstance(description, str)
         return description
 
     @property
     def queries(self) -> Optional[List[str]]:
         """Return the queries for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        queries = self._metadata["queries"]
+        queries = metadata["queries"]
         assert queries is None or (
             isinstance(queries, list) and all(isinstance(q, str) for q in queries)
         )
@@ -89,54 +224,60 @@ class Agent:
     @property
     def more_info_url(self) -> Optional[str]:
         """Return the more info URL for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        more_info_url = self._metadata["moreInfoUrl"]
+        more_info_url = metadata["moreInfoUrl"]
         assert more_info_url is None or isinstance(more_info_url, str)
         return more_info_url
 
     @property
     def published(self) -> Optional[bool]:
         """Return the published status for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        published = self._metadata["published"]
+        published = metadata["published"]
         assert published is None or isinstance(published, bool)
         return published
 
     @property
     def owner(self) -> Optional[str]:
         """Return the owner of this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        owner_username = self._metadata["owner"]["username"]
+        owner_username = metadata["owner"]["username"]
         assert owner_username is None or isinstance(owner_username, str)
         return owner_username
 
     @property
     def query_url(self) -> Optional[str]:
         """Return the query URL for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        url = self._metadata["queryUrl"]
+        url = metadata["queryUrl"]
         assert url is None or isinstance(url, str)
         return url
 
     @property
     def func_url(self) -> Optional[str]:
         """Return the func URL for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        url = self._metadata["funcUrl"]
+        url = metadata["funcUrl"]
         assert url is None or isinstance(url, str)
         return url
 
     @property
     def created(self) -> Optional[datetime.datetime]:
         """Return the creation timestamp for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        ts = self._metadata["created"]
+        ts = metadata["created"]
         if ts is not None:
             return datetime.datetime.fromisoformat(ts)
         else:
@@ -145,87 +286,66 @@ class Agent:
     @property
     def modified(self) -> Optional[datetime.datetime]:
         """Return the modification timestamp for this Agent."""
-        if self._metadata is None:
+        metadata = self._loaded_metadata()
+        if metadata is None:
             return None
-        ts = self._metadata["modified"]
+        ts = metadata["modified"]
         if ts is not None:
             return datetime.datetime.fromisoformat(ts)
         else:
             return None
 
-    def get_metadata(self) -> Dict[str, Any]:
-        """Return metadata about this Agent."""
+    def _loaded_metadata(self) -> Optional[Dict[str, Any]]:
+        """Return this Agent's metadata, or None if it doesn't exist."""
+        return self._metadata
 
+    def _rename(self, new_handle: str):
+        """Give this Agent the handle it was renamed to."""
+        self._handle = new_handle
+        self._agent_id = (
+            new_handle if self._owner is None else f"{self._owner}/{new_handle}"
+        )
+
+    def _cache_key(self) -> str:
+        """Return the key of this Agent's metadata in its client's cache."""
+        if self._owner is None:
+            return self._handle
+        return f"{self._owner}/{self._handle}"
+
+    def _get_metadata_request(self) -> Tuple[documents.Document, Dict[str, Any], str]:
+        """Return the query for this Agent's metadata, its variables, and the field
+        of the result that holds the metadata."""
         if self._owner is None:
             # Query by handle.
-            query = gql(
-                """
-                query getAgentByHandle($handle: String!) {
-                    agentByHandle(handle: $handle) {
-                        agentId
-                        handle
-                        name
-                        description
-                        queries
-                        moreInfoUrl
-                        published
-                        owner {
-                            username
-                        }
-                        queryUrl
-                        funcUrl
-                        created
-                        modified
-                    }
-                }
-            """
+            return (
+                _GET_AGENT_BY_HANDLE_QUERY,
+                {"handle": self._handle},
+                "agentByHandle",
             )
-            result = self._gqlclient.execute(
-                query, variable_values={"handle": self._handle}
-            )
-            if "agentByHandle" not in result or result["agentByHandle"] is None:
-                raise ValueError(f"Cannot fetch agent metadata for {self._handle}")
-            agent_dict = result["agentByHandle"]
-
         else:
             # Query by agent ID.
-            query = gql(
-                """
-                query getAgentById($agentId: String!) {
-                    agentById(agentId: $agentId) {
-                        agentId
-                        handle
-                        name
-                        description
-                        queries
-                        moreInfoUrl
-                        published
-                        owner {
-                            username
-                        }
-                        queryUrl
-                        funcUrl
-                        created
-                        modified
-                    }
-                }
-            """
-            )
-            result = self._gqlclient.execute(
-                query, variable_values={"agentId": f"{self._owner}/{self._handle}"}
+            return (
+                _GET_AGENT_BY_ID_QUERY,
+                {"agentId": f"{self._owner}/{self._handle}"},
+                "agentById",
             )
-            if "agentById" not in result or result["agentById"] is None:
-                raise ValueError(
-                    f"Cannot fetch agent metadata for {self._owner}/{self._handle}"
-                )
-            agent_dict = result["agentById"]
 
+    def _metadata_from_result(
+        self, result: Dict[str, Any], field: str
+    ) -> Dict[str, Any]:
+        if field not in result or result[field] is None:
+            if self._owner is None:
+                raise ValueError(f"Cannot fetch agent metadata for {self._handle}")
+            raise ValueError(
+                f"Cannot fetch agent metadata for {self._owner}/{self._handle}"
+            )
+        agent_dict = result[field]
         assert isinstance(agent_dict, dict) and all(
             isinstance(k, str) for k in agent_dict.keys()
         )
         return agent_dict
 
-    def create_agent(
+    def _create_variables(
         self,
         name: str,
         description: str,
@@ -233,37 +353,7 @@ class Agent:
         func_url: Optional[str] = None,
         more_info_url: Optional[str] = None,
         published: Optional[bool] = None,
-    ) -> str:
-        """Create a new Agent with the given parameters."""
-        query = gql(
-            """
-            mutation CreateAgent(
-                $handle: String!,
-                $name: String!,
-                $description: String!,
-                $queryUrl: String,
-                $funcUrl: String,
-                $moreInfoUrl: String,
-                $published: Boolean) {
-                createAgent(
-                    agentData: {
-                        handle: $handle,
-                        name: $name,
-                        description: $description,
-                        queryUrl: $queryUrl,
-                        funcUrl: $funcUrl,
-                        moreInfoUrl: $moreInfoUrl,
-                        published: $published
-                    }
-                ) {
-                    agent {
-                        agentId
-                    }
-                }
-            }
-            """
-        )
-
+    ) -> Dict[str, Any]:
         variable_values: Dict[str, Any] = {"handle": self._handle}
         variable_values["name"] = name
         variable_values["description"] = description
@@ -275,17 +365,9 @@ class Agent:
             variable_values["moreInfoUrl"] = more_info_url
         if published is not None:
             variable_values["published"] = published
+        return variable_values
 
-        result = self._gqlclient.execute(query, variable_values=variable_values)
-        if "createAgent" not in result or result["createAgent"] is None:
-            raise ValueError(f"Failed to create Agent")
-        assert isinstance(result["createAgent"], dict)
-        assert isinstance(result["createAgent"]["agent"], dict)
-        assert isinstance(result["createAgent"]["agent"]["agentId"], str)
-        self._metadata = self.get_metadata()
-        return result["createAgent"]["agent"]["agentId"]
-
-    def update_agent(
+    def _update_variables(
         self,
         new_handle: Optional[str] = None,
         name: Optional[str] = None,
@@ -294,39 +376,7 @@ class Agent:
         func_url: Optional[str] = None,
         more_info_url: Optional[str] = None,
         published: Optional[bool] = None,
-    ) -> str:
-        """Update the Agent with the given parameters."""
-        query = gql(
-            """
-            mutation UpdateAgent(
-                $handle: String!,
-                $newHandle: String,
-                $name: String,
-                $description: String,
-                $queryUrl: String,
-                $funcUrl: String,
-                $moreInfoUrl: String,
-                $published: Boolean) {
-                updateAgent(
-                    agentData: {
-                        handle: $handle,
-                        newHandle: $newHandle,
-                        name: $name,
-                        description: $description,
-                        queryUrl: $queryUrl,
-                        funcUrl: $funcUrl,
-                        moreInfoUrl: $moreInfoUrl,
-                        published: $published
-                    }
-                ) {
-                    agent {
-                        agentId
-                    }
-                }
-            }
-            """
-        )
-
+    ) -> Dict[str, Any]:
         variable_values: Dict[str, Any] = {"handle": self._handle}
         if new_handle is not None:
             variable_values["newHandle"] = new_handle
@@ -342,29 +392,244 @@ class Agent:
             variable_values["moreInfoUrl"] = more_info_url
         if published is not None:
             variable_values["published"] = published
+        return variable_values
+
+
+def _agent_id_from_result(result: Dict[str, Any], field: str, action: str) -> str:
+    if field not in result or result[field] is None:
+        raise ValueError(f"Failed to {action} Agent")
+    assert isinstance(result[field], dict)
+    assert isinstance(result[field]["agent"], dict)
+    agent_id = result[field]["agent"]["agentId"]
+    assert isinstance(agent_id, str)
+    return agent_id
+
+
+class Agent(_AgentBase):
+    """Provides an interface to the Fixie GraphQL Agent API.
+
+    The Agent's metadata is fetched when first needed, and shared with other Agent
+    objects of the same client through the client's cache.
+
+    Args:
+        client: The FixieClient instance to use.
+        agent_id: The Agent ID, e.g., "fixie/calc", or handle, e.g., "dice".
+    """
+
+    def __init__(
+        self,
+        client: FixieClient,
+        agent_id: str,
+    ):
+        super().__init__(agent_id)
+        self._client = client
+        self._gqlclient = self._client.gqlclient
+        # Whether _metadata was fetched, or found in the client's cache.
+        self._metadata_loaded = False
+
+    def _loaded_metadata(self) -> Optional[Dict[str, Any]]:
+        if not self._metadata_loaded:
+            self._metadata = self._client._cache.get_agent_metadata(self._cache_key())
+            if self._metadata is None:
+                try:
+                    self._metadata = self.get_metadata()
+                except:
+                    self._metadata = None
+            self._metadata_loaded = True
+        return self._metadata
+
+    def get_metadata(self) -> Dict[str, Any]:
+        """Return metadata about this Agent, fetching it from the Fixie API."""
+        query, variable_values, field = self._get_metadata_request()
+        result = self._gqlclient.execute(query.node, variable_values=variable_values)
+        metadata = self._metadata_from_result(result, field)
+        self._client._cache.put_agent_metadata(self._cache_key(), metadata)
+        return metadata
+
+    def _set_metadata(self, metadata: Optional[Dict[str, Any]]):
+        """Set this Agent's metadata, as fetched along with other Agents'."""
+        self._metadata = metadata
+        self._metadata_loaded = True
+        if metadata is not None:
+            self._client._cache.put_agent_metadata(self._cache_key(), metadata)
+
+    def _invalidate_metadata(self, *old_cache_keys: str):
+        """Drop this Agent's metadata after changing it, to fetch it again lazily,
+        along with any cached under its keys before it was renamed."""
+        self._client._cache.invalidate_agent(self._cache_key(), *old_cache_keys)
+        self._metadata = None
+        self._metadata_loaded = False
+
+    def create_agent(
+        self,
+        name: str,
+        description: str,
+        query_url: Optional[str] = None,
+        func_url: Optional[str] = None,
+        more_info_url: Optional[str] = None,
+        published: Optional[bool] = None,
+    ) -> str:
+        """Create a new Agent with the given parameters."""
+        variable_values = self._create_variables(
+            name, description, query_url, func_url, more_info_url, published
+        )
+        result = self._gqlclient.execute(
+            _CREATE_AGENT_MUTATION.node, variable_values=variable_values
+        )
+        agent_id = _agent_id_from_result(result, "createAgent", "create")
+        self._invalidate_metadata()
+        return agent_id
 
-        result = self._gqlclient.execute(query, variable_values=variable_values)
-        if "updateAgent" not in result or result["updateAgent"] is None:
-            raise ValueError(f"Failed to update Agent")
-        assert isinstance(result["updateAgent"], dict)
-        assert isinstance(result["updateAgent"]["agent"], dict)
-        assert isinstance(result["updateAgent"]["agent"]["agentId"], str)
-        self._metadata = self.get_metadata()
+    def update_agent(
+        self,
+        new_handle: Optional[str] = None,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        query_url: Optional[str] = None,
+        func_url: Optional[str] = None,
+        more_info_url: Optional[str] = None,
+        published: Optional[bool] = None,
+    ) -> str:
+        """Update the Agent with the given parameters."""
+        variable_values = self._update_variables(
+            new_handle,
+            name,
+            description,
+            query_url,
+            func_url,
+            more_info_url,
+            published,
+        )
+        result = self._gqlclient.execute(
+            _UPDATE_AGENT_MUTATION.node, variable_values=variable_values
+        )
+        agent_id = _agent_id_from_result(result, "updateAgent", "update")
+        old_cache_key = self._cache_key()
         if new_handle:
-            self._handle = new_handle
-        return result["updateAgent"]["agent"]["agentId"]
+            self._rename(new_handle)
+        self._invalidate_metadata(old_cache_key)
+        return agent_id
 
     def delete_agent(self) -> None:
         """Delete this Agent."""
-        query = gql(
-            """
-            mutation DeleteAgent($handle: String!) {
-                deleteAgent(handle: $handle) {
-                    agent {
-                        handle
-                    }
-                }
-            }
-        """
+        _ = self._gqlclient.execute(
+            _DELETE_AGENT_MUTATION.node, variable_values={"handle": self._handle}
+        )
+        self._invalidate_metadata()
+
+
+class AsyncAgent(_AgentBase):
+    """Provides an asyncio interface to the Fixie GraphQL Agent API.
+
+    The Agent's metadata is shared with other AsyncAgent objects of the same client
+    through the client's cache. Its properties can't fetch it though, so unless it's
+    cached, it must be loaded with `load_metadata` first.
+
+    Args:
+        client: The AsyncFixieClient instance to use.
+        agent_id: The Agent ID, e.g., "fixie/calc", or handle, e.g., "dice".
+    """
+
+    def __init__(
+        self,
+        client: AsyncFixieClient,
+        agent_id: str,
+    ):
+        super().__init__(agent_id)
+        self._client = client
+        # Whether _metadata was fetched, or found in the client's cache.
+        self._metadata_loaded = False
+
+    def _loaded_metadata(self) -> Optional[Dict[str, Any]]:
+        if not self._metadata_loaded:
+            self._metadata = self._client._cache.get_agent_metadata(self._cache_key())
+            if self._metadata is None:
+                raise RuntimeError(
+                    f"The metadata of Agent {self._cache_key()} isn't loaded. Call "
+                    "`await agent.load_metadata()` first."
+                )
+            self._metadata_loaded = True
+        return self._metadata
+
+    async def load_metadata(self):
+        """Load this Agent's metadata for its properties, fetching it unless it's
+        cached. If the Agent doesn't exist, it isn't `valid`."""
+        self._metadata = self._client._cache.get_agent_metadata(self._cache_key())
+        if self._metadata is None:
+            try:
+                self._metadata = await self.get_metadata()
+            except Exception:
+                self._metadata = None
+        self._metadata_loaded = True
+
+    async def get_metadata(self) -> Dict[str, Any]:
+        """Return metadata about this Agent, fetching it from the Fixie API."""
+        query, variable_values, field = self._get_metadata_request()
+        result = await self._client._execute(query.node, variable_values)
+        metadata = self._metadata_from_result(result, field)
+        self._client._cache.put_agent_metadata(self._cache_key(), metadata)
+        return metadata
+
+    def _invalidate_metadata(self, *old_cache_keys: str):
+        """Drop this Agent's metadata after changing it, to load it again, along
+        with any cached under its keys before it was renamed."""
+        self._client._cache.invalidate_agent(self._cache_key(), *old_cache_keys)
+        self._metadata = None
+        self._metadata_loaded = False
+
+    async def create_agent(
+        self,
+        name: str,
+        description: str,
+        query_url: Optional[str] = None,
+        func_url: Optional[str] = None,
+        more_info_url: Optional[str] = None,
+        published: Optional[bool] = None,
+    ) -> str:
+        """Create a new Agent with the given parameters."""
+        variable_values = self._create_variables(
+            name, description, query_url, func_url, more_info_url, published
+        )
+        result = await self._client._execute(
+            _CREATE_AGENT_MUTATION.node, variable_values
+        )
+        agent_id = _agent_id_from_result(result, "createAgent", "create")
+        self._invalidate_metadata()
+        return agent_id
+
+    async def update_agent(
+        self,
+        new_handle: Optional[str] = None,
+        name: Optional[str] = None,
+        description: Optional[str] = None,
+        query_url: Optional[str] = None,
+        func_url: Optional[str] = None,
+        more_info_url: Optional[str] = None,
+        published: Optional[bool] = None,
+    ) -> str:
+        """Update the Agent with the given parameters."""
+        variable_values = self._update_variables(
+            new_handle,
+            name,
+            description,
+            query_url,
+            func_url,
+            more_info_url,
+            published,
+        )
+        result = await self._client._execute(
+            _UPDATE_AGENT_MUTATION.node, variable_values
+        )
+        agent_id = _agent_id_from_result(result, "updateAgent", "update")
+        old_cache_key = self._cache_key()
+        if new_handle:
+            self._rename(new_handle)
+        self._invalidate_metadata(old_cache_key)
+        return agent_id
+
+    async def delete_agent(self) -> None:
+        """Delete this Agent."""
+        _ = await self._client._execute(
+            _DELETE_AGENT_MUTATION.node, {"handle": self._handle}
         )
-        _ = self._gqlclient.execute(query, variable_values={"handle": self._handle})
+        self._invalidate_metadata()
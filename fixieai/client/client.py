@@ -2,21 +2,96 @@
 
 from __future__ import annotations
 
+import asyncio
+import concurrent.futures
+import contextlib
+import dataclasses
+import itertools
 import logging
-from typing import Any, BinaryIO, Dict, List, Optional
-
+import queue
+import threading
+import time
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import aiohttp
 import requests
 from gql import Client
-from gql import gql
+from gql.client import AsyncClientSession
+from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import TransportQueryError
 from gql.transport.requests import RequestsHTTPTransport
+from gql.transport.websockets import WebsocketsTransport
+from graphql import DocumentNode
 
 from fixieai import constants
+from fixieai.client import agent as agent_module
+from fixieai.client import documents
 from fixieai.client.agent import Agent
+from fixieai.client.agent import AsyncAgent
+from fixieai.client.session import AsyncSession
 from fixieai.client.session import Session
 
 _CLIENT: Optional["FixieClient"] = None
 _SESSION: Optional[Session] = None
 
+# The default number of queries that `FixieClient.query_many` runs at once.
+DEFAULT_QUERY_CONCURRENCY = 8
+# The default number of HTTP connections that an AsyncFixieClient opens at once.
+DEFAULT_MAX_CONNECTIONS = 100
+# Seconds for which FixieClient and AsyncFixieClient reuse the current user's
+# username.
+USERNAME_CACHE_TTL = 3600.0
+# Seconds for which FixieClient and AsyncFixieClient reuse agent metadata, unless the
+# agent is changed through them.
+AGENT_METADATA_CACHE_TTL = 60.0
+# Paths of the agent refresh and deployment endpoints, under the API URL.
+_REFRESH_PATH = "/api/refresh"
+_DEPLOYMENT_PATH = "/api/deployments"
+
+_GET_AGENTS_QUERY = documents.register(
+    """
+    query getAgents {
+        allAgents {
+            agentId
+            name
+            description
+            moreInfoUrl
+        }
+    }
+"""
+)
+
+_GET_SESSIONS_QUERY = documents.register(
+    """
+    query getSessions {
+        allSessions {
+            handle
+        }
+    }
+"""
+)
+
+_GET_USERNAME_QUERY = documents.register(
+    """
+    query getUsername {
+        user {
+            username
+        }
+    }
+"""
+)
+
 
 def get_client() -> FixieClient:
     """Return the global FixieClient instance."""
@@ -48,11 +123,82 @@ def query(text: str) -> str:
     return get_session().query(text)
 
 
+def query_many(texts: Iterable[str], **kwargs) -> Iterator[QueryResult]:
+    """Run many queries concurrently. See `FixieClient.query_many`."""
+    return get_client().query_many(texts, **kwargs)
+
+
 def get_embeds() -> List[Dict[str, Any]]:
     """Return a list of Embeds."""
     return get_session().get_embeds()
 
 
+@dataclasses.dataclass
+class QueryResult:
+    """The outcome of one of the queries run by `FixieClient.query_many`."""
+
+    # The position of the query in the texts passed to query_many.
+    index: int
+    text: str
+    # The response to the query, if it succeeded.
+    response: Optional[str] = None
+    # The error that the query failed with, or a TimeoutError if it timed out.
+    error: Optional[Exception] = None
+    # The session the query ran in, if one was created.
+    session_id: Optional[str] = None
+
+
+class _ClientCache:
+    """The username and agent metadata fetched by a FixieClient or AsyncFixieClient,
+    and its clones."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # The username, and when it expires.
+        self._username: Optional[Tuple[str, float]] = None
+        # Agent metadata and when it expires, by the agent ID or handle it was
+        # fetched with.
+        self._agents: Dict[str, Tuple[Dict[str, Any], float]] = {}
+
+    def get_username(self) -> Optional[str]:
+        with self._lock:
+            if self._username is None or self._username[1] <= time.monotonic():
+                return None
+            return self._username[0]
+
+    def put_username(self, username: str):
+        with self._lock:
+            self._username = (username, time.monotonic() + USERNAME_CACHE_TTL)
+
+    def get_agent_metadata(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._agents.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                return None
+            return entry[0]
+
+    def put_agent_metadata(self, key: str, metadata: Dict[str, Any]):
+        with self._lock:
+            self._agents[key] = (metadata, time.monotonic() + AGENT_METADATA_CACHE_TTL)
+
+    def invalidate_agent(self, *keys: str):
+        """Drop the metadata of the agents with the IDs or handles `keys`."""
+        with self._lock:
+            for cached_key, (metadata, _) in list(self._agents.items()):
+                cached_keys = (
+                    cached_key,
+                    metadata.get("agentId"),
+                    metadata.get("handle"),
+                )
+                if any(key in cached_keys for key in keys):
+                    del self._agents[cached_key]
+
+    def clear(self):
+        with self._lock:
+            self._username = None
+            self._agents.clear()
+
+
 class FixieClient:
     """FixieClient is a client to the Fixie system.
 
@@ -61,20 +207,40 @@ class FixieClient:
             FIXIE_API_KEY environment variable will be used. If that is not
             set, the authenticated user API key will be used, or a ValueError
             will be raised if the user is not authenticated.
+        api_url: The URL of the Fixie API server. Defaults to the FIXIE_API_URL
+            environment variable, or the Fixie platform.
+        persisted_queries: Whether to send queries as automatic persisted queries,
+            by their hash, if the server supports it.
+        timeout: Seconds after which a request to the Fixie API server is given
+            up on. By default, requests wait for as long as the server takes.
     """
 
     def __init__(
         self,
         api_key: Optional[str] = None,
+        api_url: Optional[str] = None,
+        persisted_queries: bool = False,
+        timeout: Optional[float] = None,
     ):
         self._api_key = api_key or constants.fixie_api_key()
-        logging.info(f"Using Fixie API URL: {constants.FIXIE_API_URL}")
+        self._api_url = api_url or constants.FIXIE_API_URL
+        self._persisted_queries = persisted_queries
+        self._timeout = timeout
+        logging.info(f"Using Fixie API URL: {self._api_url}")
         self._request_headers = {"Authorization": f"Bearer {self._api_key}"}
-        transport = RequestsHTTPTransport(
-            url=constants.FIXIE_GRAPHQL_URL,
+        transport_class = (
+            documents.PersistedQueryRequestsTransport
+            if persisted_queries
+            else RequestsHTTPTransport
+        )
+        transport = transport_class(
+            url=f"{self._api_url}/graphql",
             headers=self._request_headers,
+            # Passed on to requests, which takes fractions of a second too.
+            timeout=timeout,  # type: ignore
         )
         self._gqlclient = Client(transport=transport, fetch_schema_from_transport=False)
+        self._cache = _ClientCache()
 
     @property
     def gqlclient(self) -> Client:
@@ -84,38 +250,90 @@ class FixieClient:
     @property
     def url(self) -> str:
         """Return the URL of the Fixie API server."""
-        return constants.FIXIE_API_URL
+        return self._api_url
+
+    def subscription_client(self) -> Client:
+        """Return a new GraphQL client for subscriptions to the Fixie API server.
+
+        Subscriptions are served over websockets. The client is not connected until
+        it's used in an async context.
+        """
+        scheme, _, rest = self._api_url.partition("://")
+        ws_scheme = "wss" if scheme == "https" else "ws"
+        transport = WebsocketsTransport(
+            url=f"{ws_scheme}://{rest}/graphql",
+            headers=self._request_headers,
+        )
+        return Client(transport=transport, fetch_schema_from_transport=False)
 
     def clone(self) -> "FixieClient":
-        """Return a new FixieClient instance with the same configuration."""
-        return FixieClient(api_key=self._api_key)
+        """Return a new FixieClient instance with the same configuration.
+
+        The clone shares this client's cache of the username and agent metadata.
+        """
+        return self._clone(self._timeout)
+
+    def _clone(self, timeout: Optional[float]) -> "FixieClient":
+        """Return a clone of this client, whose requests time out after
+        `timeout`."""
+        client = FixieClient(
+            api_key=self._api_key,
+            api_url=self._api_url,
+            persisted_queries=self._persisted_queries,
+            timeout=timeout,
+        )
+        client._cache = self._cache
+        return client
+
+    def invalidate_cache(self):
+        """Forget the username and agent metadata cached by this client and its
+        clones, e.g., after changing agents through another client."""
+        self._cache.clear()
 
     def get_agents(self) -> Dict[str, Dict[str, str]]:
         """Return metadata about all running Fixie Agents. The keys of the returned
         dictionary are the Agent handles, and the values are dictionaries containing
         metadata about each Agent."""
-
-        query = gql(
-            """
-            query getAgents {
-                allAgents {
-                    agentId
-                    name
-                    description
-                    moreInfoUrl
-                }
-            }
-        """
-        )
-        result = self._gqlclient.execute(query)
-        assert "allAgents" in result and isinstance(result["allAgents"], list)
-        agents = result["allAgents"]
-        return {agent["agentId"]: agent for agent in agents}
+        result = self._gqlclient.execute(_GET_AGENTS_QUERY.node)
+        return _agents_from_result(result)
 
     def get_agent(self, agent_id: str) -> Agent:
         """Return an existing Agent object."""
         return Agent(self, agent_id)
 
+    def get_agents_by_id(self, agent_ids: Sequence[str]) -> List[Agent]:
+        """Return Agent objects for many Agents, with their metadata fetched in a
+        single request.
+
+        Args:
+            agent_ids: The Agent IDs, e.g., "fixie/calc", or handles, e.g., "dice".
+                Agents that don't exist are returned, but aren't valid.
+        """
+        agents = [Agent(self, agent_id) for agent_id in agent_ids]
+        missing = []
+        for agent in agents:
+            metadata = self._cache.get_agent_metadata(agent._cache_key())
+            if metadata is not None:
+                agent._set_metadata(metadata)
+            else:
+                missing.append(agent)
+        if not missing:
+            return agents
+
+        query, variable_values = agent_module._get_agents_request(
+            [agent.agent_id for agent in missing]
+        )
+        try:
+            result = self._gqlclient.execute(query, variable_values=variable_values)
+        except TransportQueryError as e:
+            # Agents that don't exist fail their own fields, not the whole query.
+            if not e.data:
+                raise
+            result = e.data
+        for index, agent in enumerate(missing):
+            agent._set_metadata(result.get(f"agent{index}"))
+        return agents
+
     def create_agent(
         self,
         handle: str,
@@ -146,20 +364,8 @@ class FixieClient:
 
     def get_sessions(self) -> List[str]:
         """Return a list of all session IDs."""
-
-        query = gql(
-            """
-            query getSessions {
-                allSessions {
-                    handle
-                }
-            }
-        """
-        )
-        result = self._gqlclient.execute(query)
-        assert "allSessions" in result and isinstance(result["allSessions"], list)
-        sessions = result["allSessions"]
-        return [session["handle"] for session in sessions]
+        result = self._gqlclient.execute(_GET_SESSIONS_QUERY.node)
+        return _sessions_from_result(result)
 
     def create_session(self, frontend_agent_id: Optional[str] = None) -> Session:
         """Create a new Session."""
@@ -169,36 +375,409 @@ class FixieClient:
         """Return an existing Session object."""
         return Session(self, session_id)
 
+    def query_many(
+        self,
+        texts: Iterable[str],
+        concurrency: int = DEFAULT_QUERY_CONCURRENCY,
+        reuse_sessions: bool = True,
+        timeout: Optional[float] = None,
+        frontend_agent_id: Optional[str] = None,
+    ) -> Iterator[QueryResult]:
+        """Run many queries concurrently, yielding their results as they complete.
+
+        Texts are consumed lazily, so that there are at most `concurrency` queries
+        in flight. A query that fails or times out yields a QueryResult with an
+        error, and doesn't stop the others.
+
+        Args:
+            texts: The queries to run.
+            concurrency: The maximum number of queries to run at once.
+            reuse_sessions: Whether to run queries in a pool of at most
+                `concurrency` sessions, each running one query after another. If
+                False, each query runs in a session of its own.
+            timeout: Seconds after which a query that hasn't completed is given up
+                on. Its session is no longer reused, and it counts towards
+                `concurrency` until its requests, which time out too, return.
+            frontend_agent_id: The frontend agent of the sessions created.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1.")
+        idle_sessions: "queue.SimpleQueue[Session]" = queue.SimpleQueue()
+        # Indices of the queries that timed out, whose sessions aren't reused.
+        timed_out: Set[int] = set()
+
+        def run_query(text: str, result: QueryResult) -> QueryResult:
+            try:
+                session = idle_sessions.get_nowait()
+            except queue.Empty:
+                # Sessions aren't shared across threads, so each has a client.
+                client = self._clone(timeout or self._timeout)
+                session = client.create_session(frontend_agent_id)
+            result.session_id = session.session_id
+            result.response = session.query(text)
+            if reuse_sessions and result.index not in timed_out:
+                idle_sessions.put(session)
+            return result
+
+        pending: Dict[concurrent.futures.Future, Tuple[QueryResult, float]] = {}
+        # Queries that timed out, but are still running.
+        abandoned: Set[concurrent.futures.Future] = set()
+        items = enumerate(texts)
+        exhausted = False
+        while True:
+            available = concurrency - len(pending) - len(abandoned)
+            if not exhausted and available > 0:
+                started = 0
+                for index, text in itertools.islice(items, available):
+                    result = QueryResult(index, text)
+                    future = _run_in_background(run_query, text, result)
+                    deadline = time.monotonic() + timeout if timeout else float("inf")
+                    pending[future] = (result, deadline)
+                    started += 1
+                exhausted = started < available
+            if not pending and exhausted:
+                return
+
+            next_deadline = min(
+                (deadline for _, deadline in pending.values()), default=float("inf")
+            )
+            done, _ = concurrent.futures.wait(
+                {*pending, *abandoned},
+                timeout=(
+                    max(next_deadline - time.monotonic(), 0)
+                    if next_deadline < float("inf")
+                    else None
+                ),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            abandoned -= done
+            now = time.monotonic()
+            for future in list(pending):
+                result, deadline = pending[future]
+                if future in done:
+                    del pending[future]
+                    error = future.exception()
+                    assert error is None or isinstance(error, Exception)
+                    result.error = error
+                    yield result
+                elif deadline <= now:
+                    # The query keeps running in the background, but its result
+                    # is dropped, and its session isn't reused.
+                    del pending[future]
+                    abandoned.add(future)
+                    timed_out.add(result.index)
+                    yield QueryResult(
+                        result.index,
+                        result.text,
+                        error=TimeoutError(f"Query timed out after {timeout}s"),
+                        session_id=result.session_id,
+                    )
+
     def get_current_username(self) -> str:
         """Returns the username of the current user."""
-        query = gql(
-            """
-            query getUsername {
-                user {
-                    username
-                }
-            }
-        """
-        )
-        result = self._gqlclient.execute(query)
-        assert "user" in result and isinstance(result["user"], dict)
-        user = result["user"]
-        assert "username" in user and isinstance(user["username"], str)
-        return user["username"]
+        username = self._cache.get_username()
+        if username is None:
+            result = self._gqlclient.execute(_GET_USERNAME_QUERY.node)
+            username = _username_from_result(result)
+            self._cache.put_username(username)
+        return username
 
     def refresh_agent(self, agent_handle: str):
         """Indicates that an agent's prompts should be refreshed."""
         username = self.get_current_username()
         requests.post(
-            f"{constants.FIXIE_REFRESH_URL}/{username}/{agent_handle}",
+            f"{self._api_url}{_REFRESH_PATH}/{username}/{agent_handle}",
             headers=self._request_headers,
         ).raise_for_status()
+        self._cache.invalidate_agent(f"{username}/{agent_handle}")
 
     def deploy_agent(self, agent_handle: str, files: Dict[str, BinaryIO]):
         """Deploys an agent implementation."""
         username = self.get_current_username()
         requests.post(
-            f"{constants.FIXIE_DEPLOYMENT_URL}/{username}/{agent_handle}",
+            f"{self._api_url}{_DEPLOYMENT_PATH}/{username}/{agent_handle}",
             headers=self._request_headers,
             files=files,
         ).raise_for_status()
+        self._cache.invalidate_agent(f"{username}/{agent_handle}")
+
+
+class AsyncFixieClient:
+    """AsyncFixieClient is a client to the Fixie system, for use with asyncio.
+
+    Requests are sent over a pool of HTTP connections, so that many sessions can
+    run concurrently from a single event loop. The pool is opened on first use, and
+    should be closed with `close`, or by using the client as an async context
+    manager:
+
+        async with AsyncFixieClient() as client:
+            session = await client.create_session()
+            print(await session.query("Hello"))
+
+    Args:
+        api_key: The API key for the Fixie API server. If not provided, the
+            FIXIE_API_KEY environment variable will be used. If that is not
+            set, the authenticated user API key will be used, or a ValueError
+            will be raised if the user is not authenticated.
+        api_url: The URL of the Fixie API server. Defaults to the FIXIE_API_URL
+            environment variable, or the Fixie platform.
+        persisted_queries: Whether to send queries as automatic persisted queries,
+            by their hash, if the server supports it.
+        max_connections: The maximum number of HTTP connections to open at once.
+            Further requests wait for a connection to be free.
+        client_session_args: Extra arguments for the underlying
+            `aiohttp.ClientSession`. A `connector` given here takes precedence over
+            `max_connections`.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        api_url: Optional[str] = None,
+        persisted_queries: bool = False,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        client_session_args: Optional[Dict[str, Any]] = None,
+    ):
+        if max_connections < 1:
+            raise ValueError("max_connections must be at least 1")
+        self._api_key = api_key or constants.fixie_api_key()
+        self._api_url = api_url or constants.FIXIE_API_URL
+        self._persisted_queries = persisted_queries
+        self._max_connections = max_connections
+        self._client_session_args = dict(client_session_args or {})
+        logging.info(f"Using Fixie API URL: {self._api_url}")
+        self._request_headers = {"Authorization": f"Bearer {self._api_key}"}
+        async_transport_class = (
+            documents.PersistedQueryAIOHTTPTransport
+            if persisted_queries
+            else AIOHTTPTransport
+        )
+        self._transport = async_transport_class(
+            url=f"{self._api_url}/graphql",
+            headers=self._request_headers,
+        )
+        self._gqlclient = Client(
+            transport=self._transport, fetch_schema_from_transport=False
+        )
+        self._connecting: Optional["asyncio.Future[AsyncClientSession]"] = None
+        self._cache = _ClientCache()
+
+    @property
+    def gqlclient(self) -> Client:
+        """Return the underlying GraphQL client used by this AsyncFixieClient."""
+        return self._gqlclient
+
+    @property
+    def url(self) -> str:
+        """Return the URL of the Fixie API server."""
+        return self._api_url
+
+    def clone(self) -> "AsyncFixieClient":
+        """Return a new AsyncFixieClient instance with the same configuration.
+
+        The clone shares this client's cache of the username and agent metadata.
+        """
+        client = AsyncFixieClient(
+            api_key=self._api_key,
+            api_url=self._api_url,
+            persisted_queries=self._persisted_queries,
+            max_connections=self._max_connections,
+            client_session_args=self._client_session_args,
+        )
+        client._cache = self._cache
+        return client
+
+    def invalidate_cache(self):
+        """Forget the username and agent metadata cached by this client and its
+        clones, e.g., after changing agents through another client."""
+        self._cache.clear()
+
+    async def close(self):
+        """Close the client's connections."""
+        if self._connecting is not None:
+            connecting, self._connecting = self._connecting, None
+            with contextlib.suppress(Exception):
+                await connecting
+            await self._gqlclient.close_async()
+
+    async def __aenter__(self) -> "AsyncFixieClient":
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _execute(
+        self, document: DocumentNode, variable_values: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        """Execute a GraphQL request, connecting first if needed."""
+        session = await self._connected()
+        result = await session.execute(document, variable_values=variable_values)
+        return result
+
+    async def _post(self, url: str, data: Any = None):
+        """POST `data` to an endpoint of the Fixie API outside of GraphQL, over the
+        client's pool of connections."""
+        await self._connected()
+        http_session = self._transport.session
+        assert http_session is not None
+        async with http_session.post(
+            url, headers=self._request_headers, data=data
+        ) as response:
+            response.raise_for_status()
+
+    async def _connected(self) -> AsyncClientSession:
+        """Return the client's GraphQL session, connecting first if needed."""
+        if self._connecting is None:
+            # Concurrent requests share a single connection attempt.
+            self._connecting = asyncio.ensure_future(self._connect())
+        connecting = self._connecting
+        try:
+            session = await connecting
+        except BaseException:
+            # Let the next request try again, rather than failing it too.
+            if self._connecting is connecting:
+                self._connecting = None
+            raise
+        return session
+
+    async def _connect(self) -> AsyncClientSession:
+        """Open the client's pool of connections."""
+        client_session_args = dict(self._client_session_args)
+        if "connector" not in client_session_args:
+            # Connectors must be created in the event loop they are used from, and
+            # are closed along with the client.
+            client_session_args["connector"] = aiohttp.TCPConnector(
+                limit=self._max_connections
+            )
+        self._transport.client_session_args = client_session_args
+        session: AsyncClientSession = await self._gqlclient.connect_async()
+        return session
+
+    async def get_agents(self) -> Dict[str, Dict[str, str]]:
+        """Return metadata about all running Fixie Agents. The keys of the returned
+        dictionary are the Agent handles, and the values are dictionaries containing
+        metadata about each Agent."""
+        result = await self._execute(_GET_AGENTS_QUERY.node)
+        return _agents_from_result(result)
+
+    async def get_agent(self, agent_id: str) -> AsyncAgent:
+        """Return an existing Agent object.
+
+        Its metadata is served from the client's cache, or fetched once
+        `AsyncAgent.load_metadata` is awaited.
+        """
+        return AsyncAgent(self, agent_id)
+
+    async def create_agent(
+        self,
+        handle: str,
+        name: str,
+        description: str,
+        query_url: Optional[str] = None,
+        func_url: Optional[str] = None,
+        more_info_url: Optional[str] = None,
+        published: Optional[bool] = None,
+    ) -> AsyncAgent:
+        """Create a new Agent.
+
+        Args:
+            handle: The handle for the new Agent. This must be unique across all
+                Agents owned by this user.
+            name: The name of the new Agent.
+            description: A description of the new Agent.
+            query_url: The URL of the new Agent's query endpoint.
+            func_url: The URL of the new Agent's func endpoint.
+            more_info_url: A URL with more information about the new Agent.
+            published: Whether the new Agent should be published.
+        """
+        agent = AsyncAgent(self, f"{await self.get_current_username()}/{handle}")
+        await agent.create_agent(
+            name, description, query_url, func_url, more_info_url, published
+        )
+        return agent
+
+    async def get_sessions(self) -> List[str]:
+        """Return a list of all session IDs."""
+        result = await self._execute(_GET_SESSIONS_QUERY.node)
+        return _sessions_from_result(result)
+
+    async def create_session(
+        self, frontend_agent_id: Optional[str] = None
+    ) -> AsyncSession:
+        """Create a new Session."""
+        session = AsyncSession(self)
+        await session._create_session(frontend_agent_id)
+        return session
+
+    async def get_session(self, session_id: str) -> AsyncSession:
+        """Return an existing Session object."""
+        session = AsyncSession(self, session_id)
+        # Test that the session exists.
+        _ = await session.get_metadata()
+        return session
+
+    async def get_current_username(self) -> str:
+        """Returns the username of the current user."""
+        username = self._cache.get_username()
+        if username is None:
+            result = await self._execute(_GET_USERNAME_QUERY.node)
+            username = _username_from_result(result)
+            self._cache.put_username(username)
+        return username
+
+    async def refresh_agent(self, agent_handle: str):
+        """Indicates that an agent's prompts should be refreshed."""
+        username = await self.get_current_username()
+        await self._post(f"{self._api_url}{_REFRESH_PATH}/{username}/{agent_handle}")
+        self._cache.invalidate_agent(f"{username}/{agent_handle}")
+
+    async def deploy_agent(self, agent_handle: str, files: Dict[str, BinaryIO]):
+        """Deploys an agent implementation."""
+        username = await self.get_current_username()
+        form = aiohttp.FormData()
+        for name, file in files.items():
+            # Named like requests names uploaded files, as FixieClient uploads them.
+            form.add_field(
+                name, file, filename=requests.utils.guess_filename(file) or name
+            )
+        await self._post(
+            f"{self._api_url}{_DEPLOYMENT_PATH}/{username}/{agent_handle}", form
+        )
+        self._cache.invalidate_agent(f"{username}/{agent_handle}")
+
+
+def _run_in_background(fn, *args) -> concurrent.futures.Future:
+    """Call `fn` in a new daemon thread, and return a future of its result.
+
+    Unlike a thread pool's, the thread of a query that timed out doesn't hold up
+    the interpreter exiting.
+    """
+    future: concurrent.futures.Future = concurrent.futures.Future()
+
+    def run():
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+def _agents_from_result(result: Dict[str, Any]) -> Dict[str, Dict[str, str]]:
+    assert "allAgents" in result and isinstance(result["allAgents"], list)
+    agents = result["allAgents"]
+    return {agent["agentId"]: agent for agent in agents}
+
+
+def _sessions_from_result(result: Dict[str, Any]) -> List[str]:
+    assert "allSessions" in result and isinstance(result["allSessions"], list)
+    sessions = result["allSessions"]
+    return [session["handle"] for session in sessions]
+
+
+def _username_from_result(result: Dict[str, Any]) -> str:
+    assert "user" in result and isinstance(result["user"], dict)
+    user = result["user"]
+    assert "username" in user and isinstance(user["username"], str)
+    return user["username"]
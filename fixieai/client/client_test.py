@@ -1,7 +1,19 @@
+import asyncio
+import io
+import time
+from typing import Any, List, Tuple
+
 import pytest
+import requests
+from gql.transport.aiohttp import AIOHTTPTransport
 
 from fixieai import constants
+from fixieai.client import client as client_module
+from fixieai.client import documents
+from fixieai.client import local_service
+from fixieai.client.client import AsyncFixieClient
 from fixieai.client.client import FixieClient
+from fixieai.client.session import Session
 
 
 @pytest.fixture
@@ -156,3 +168,373 @@ def test_get_session(fixie_client, requests_mock):
         },
     )
     assert session.get_messages() == [{"id": 1, "text": "Test message"}]
+
+
+def test_async_client_agents():
+    async def run(url):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            agent = await client.create_agent(
+                "test-agent", "Test Agent", "Test Agent Description", published=True
+            )
+            await agent.load_metadata()
+            assert agent.valid
+            assert agent.agent_id == "testuser/test-agent"
+            assert agent.name == "Test Agent"
+            assert agent.published is True
+            assert "testuser/test-agent" in await client.get_agents()
+
+            await agent.update_agent(description="New Description")
+            agent = await client.get_agent("testuser/test-agent")
+            await agent.load_metadata()
+            assert agent.description == "New Description"
+
+            await agent.delete_agent()
+            agent = await client.get_agent("testuser/test-agent")
+            await agent.load_metadata()
+            assert not agent.valid
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+
+
+def test_async_client_renames_agents():
+    async def run(url):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            agent = await client.create_agent(
+                "test-agent", "Test Agent", "Test Agent Description"
+            )
+            await agent.update_agent(new_handle="renamed-agent")
+            assert agent.handle == "renamed-agent"
+            assert agent.agent_id == "testuser/renamed-agent"
+            # Changes invalidate the metadata, rather than fetching it again.
+            names = [name for name, _ in service.operations]
+            assert names == ["getUsername", "CreateAgent", "UpdateAgent"]
+            await agent.load_metadata()
+            assert agent.valid
+            assert agent.name == "Test Agent"
+            assert "testuser/renamed-agent" in await client.get_agents()
+            old = await client.get_agent("testuser/test-agent")
+            await old.load_metadata()
+            assert not old.valid
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+
+
+def test_async_client_limits_connections():
+    async def run(url):
+        async with AsyncFixieClient(
+            api_key="test-key", api_url=url, max_connections=2
+        ) as client:
+            await client.get_agents()
+            transport = client.gqlclient.transport
+            assert isinstance(transport, AIOHTTPTransport)
+            assert transport.session is not None
+            assert transport.session.connector is not None
+            assert transport.session.connector.limit == 2
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+
+    with pytest.raises(ValueError):
+        AsyncFixieClient(api_key="test-key", max_connections=0)
+
+
+def test_async_client_retries_failed_connections(mocker):
+    async def run(url):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            connect_async = client.gqlclient.connect_async
+            failures = [ConnectionError("Connection refused")]
+
+            async def connect_once_failing():
+                if failures:
+                    raise failures.pop()
+                return await connect_async()
+
+            mocker.patch.object(
+                client.gqlclient, "connect_async", side_effect=connect_once_failing
+            )
+            with pytest.raises(ConnectionError):
+                await client.get_agents()
+            assert await client.get_agents() == {}
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+
+
+def test_async_client_sessions():
+    async def run(url):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            session = await client.create_session()
+            assert await session.query("Hello") == "You said: Hello"
+            assert await session.get_embeds() == []
+            assert await client.get_sessions() == [session.session_id]
+
+            assert session.session_id is not None
+            session = await client.get_session(session.session_id)
+            messages = await session.get_messages()
+            assert [m["text"] for m in messages][-1] == "You said: Hello"
+            await session.delete_session()
+            assert await client.get_sessions() == []
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+
+
+def test_async_client_runs_sessions_concurrently():
+    async def run(url):
+        async with AsyncFixieClient(
+            api_key="test-key", api_url=url, max_connections=5
+        ) as client:
+            sessions = await asyncio.gather(
+                *[client.create_session() for _ in range(20)]
+            )
+            return await asyncio.gather(
+                *[session.query(f"Hello {i}") for i, session in enumerate(sessions)]
+            )
+
+    with local_service.LocalFixieService(reply_delay=0.1) as service:
+        responses = asyncio.run(run(service.url))
+        assert responses == [f"You said: Hello {i}" for i in range(20)]
+        # Queries overlap, but only as many as there are connections.
+        assert 1 < service.max_concurrent_requests <= 5
+
+
+def _slow_responder(text):
+    if text == "fail":
+        raise ValueError("Cannot answer")
+    if text == "slow":
+        time.sleep(1.0)
+    yield "response", f"You said: {text}"
+
+
+def test_query_many():
+    with local_service.LocalFixieService(
+        responder=_slow_responder, reply_delay=0.1
+    ) as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        texts = [f"Hello {i}" for i in range(12)]
+        results = list(client.query_many(texts, concurrency=4))
+        # Queries overlap, but no more than four at a time.
+        assert 1 < service.max_concurrent_requests <= 4
+        assert sorted(r.index for r in results) == list(range(12))
+        for result in results:
+            assert result.error is None
+            assert result.response == f"You said: {texts[result.index]}"
+        # Sessions are reused across queries.
+        assert len({r.session_id for r in results}) <= 4
+
+
+def test_query_many_errors_and_timeouts():
+    with local_service.LocalFixieService(responder=_slow_responder) as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        texts = ["slow", "fail", "Hello"]
+        results = list(client.query_many(texts, timeout=0.5, reuse_sessions=False))
+        # Results come in as they complete.
+        assert [r.text for r in results][-1] == "slow"
+        by_text = {r.text: r for r in results}
+        assert by_text["Hello"].response == "You said: Hello"
+        assert isinstance(by_text["fail"].error, Exception)
+        assert by_text["fail"].response is None
+        assert isinstance(by_text["slow"].error, TimeoutError)
+        assert len({r.session_id for r in results}) == 3
+
+
+def test_query_many_counts_timed_out_queries_until_they_finish(monkeypatch):
+    events: List[Tuple[Any, ...]] = []
+    query = Session.query
+
+    def recording_query(session, text):
+        events.append(("start", text))
+        try:
+            return query(session, text)
+        except Exception as e:
+            events.append(("error", text, type(e)))
+            raise
+        finally:
+            events.append(("end", text))
+
+    monkeypatch.setattr(Session, "query", recording_query)
+    with local_service.LocalFixieService(responder=_slow_responder) as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        results = list(client.query_many(["slow", "Hello"], concurrency=1, timeout=0.3))
+        assert isinstance(results[0].error, TimeoutError)
+        assert results[1].response == "You said: Hello"
+        # The timed out query's requests time out too, and the next query only
+        # starts once they have.
+        assert events == [
+            ("start", "slow"),
+            ("error", "slow", requests.exceptions.ReadTimeout),
+            ("end", "slow"),
+            ("start", "Hello"),
+            ("end", "Hello"),
+        ]
+
+
+def test_query_many_doesnt_reuse_sessions_of_timed_out_queries(monkeypatch):
+    query = Session.query
+
+    def late_query(session, text):
+        if text == "late":
+            # Finishes after the timeout, without an error.
+            time.sleep(0.5)
+        return query(session, text)
+
+    monkeypatch.setattr(Session, "query", late_query)
+    with local_service.LocalFixieService() as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        results = list(client.query_many(["late", "Hello"], concurrency=1, timeout=0.2))
+        assert isinstance(results[0].error, TimeoutError)
+        assert results[1].response == "You said: Hello"
+        assert results[1].session_id != results[0].session_id
+
+
+def test_username_and_agent_metadata_are_cached(monkeypatch):
+    with local_service.LocalFixieService() as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        agent = client.create_agent("test-agent", "Test Agent", "Description")
+        assert client.get_current_username() == local_service.USERNAME
+        assert client.clone().get_current_username() == local_service.USERNAME
+        names = [name for name, _ in service.operations]
+        assert names == ["getUsername", "CreateAgent"]
+
+        # Metadata is fetched lazily, once per client.
+        assert agent.name == "Test Agent"
+        assert client.get_agent("testuser/test-agent").description == "Description"
+        assert [name for name, _ in service.operations][2:] == ["getAgentById"]
+
+        # Changes made through the client invalidate its cache.
+        agent.update_agent(description="New Description")
+        assert client.get_agent("testuser/test-agent").description == "New Description"
+        agent.delete_agent()
+        assert not client.get_agent("testuser/test-agent").valid
+
+        # Changes made elsewhere are seen once the cache is invalidated or expires.
+        other = FixieClient(api_key="test-key", api_url=service.url)
+        other.create_agent("other-agent", "Other Agent", "Description")
+        assert client.get_agent("testuser/other-agent").name == "Other Agent"
+        other.get_agent("testuser/other-agent").update_agent(name="Renamed")
+        assert client.get_agent("testuser/other-agent").name == "Other Agent"
+        monkeypatch.setattr(client_module, "AGENT_METADATA_CACHE_TTL", 0.0)
+        client.invalidate_cache()
+        assert client.get_agent("testuser/other-agent").name == "Renamed"
+        other.get_agent("testuser/other-agent").update_agent(name="Renamed again")
+        assert client.get_agent("testuser/other-agent").name == "Renamed again"
+
+
+def test_async_client_caches_username_and_agent_metadata():
+    async def run(url, service):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            agent = await client.create_agent("test-agent", "Test Agent", "Description")
+            assert await client.get_current_username() == local_service.USERNAME
+            assert await client.clone().get_current_username() == local_service.USERNAME
+            names = [name for name, _ in service.operations]
+            assert names[:2] == ["getUsername", "CreateAgent"]
+            assert "getUsername" not in names[2:]
+
+            # Agents are returned without fetching their metadata, which is shared
+            # through the client's cache once loaded.
+            client.invalidate_cache()
+            del service.operations[:]
+            agent = await client.get_agent("testuser/test-agent")
+            with pytest.raises(RuntimeError, match="load_metadata"):
+                agent.name
+            assert service.operations == []
+            await agent.load_metadata()
+            assert agent.name == "Test Agent"
+            agent = await client.clone().get_agent("testuser/test-agent")
+            assert agent.description == "Description"
+            assert [name for name, _ in service.operations] == ["getAgentById"]
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url, service))
+
+
+def test_refresh_and_deploy_agents():
+    files = {"agent/main.py": b"agent = None", "main.py": b"import agent"}
+
+    async def run(url):
+        async with AsyncFixieClient(api_key="test-key", api_url=url) as client:
+            await client.deploy_agent(
+                "async-agent",
+                {name: io.BytesIO(content) for name, content in files.items()},
+            )
+            await client.refresh_agent("async-agent")
+
+    with local_service.LocalFixieService() as service:
+        # The endpoints are under the client's API URL.
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        client.deploy_agent(
+            "agent", {name: io.BytesIO(content) for name, content in files.items()}
+        )
+        client.refresh_agent("agent")
+        asyncio.run(run(service.url))
+        assert service.deployments == [
+            ("testuser/agent", files),
+            ("testuser/async-agent", files),
+        ]
+        assert service.refreshed == ["testuser/agent", "testuser/async-agent"]
+
+
+def test_renamed_agents_are_cached_under_their_new_id():
+    with local_service.LocalFixieService() as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        agent = client.create_agent("test-agent", "Test Agent", "Description")
+        assert client.get_agent("testuser/test-agent").valid
+        agent.update_agent(new_handle="renamed-agent")
+        assert agent.agent_id == "testuser/renamed-agent"
+        assert agent._cache_key() == agent.agent_id
+        assert agent.name == "Test Agent"
+        assert client.get_agent("testuser/renamed-agent").valid
+        assert not client.get_agent("testuser/test-agent").valid
+        names = [name for name, _ in service.operations]
+        assert names.count("getAgentById") == 3
+
+
+def test_get_agents_by_id():
+    with local_service.LocalFixieService() as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+        for i in range(3):
+            client.create_agent(f"agent-{i}", f"Agent {i}", "Description")
+        client.invalidate_cache()
+        del service.operations[:]
+        registered = len(documents._BY_TEXT)
+
+        agents = client.get_agents_by_id(
+            ["testuser/agent-0", "agent-1", "testuser/missing", "testuser/agent-2"]
+        )
+        # Ad hoc batches aren't kept around as registered documents.
+        assert len(documents._BY_TEXT) == registered
+        assert [agent.name for agent in agents] == [
+            "Agent 0",
+            "Agent 1",
+            None,
+            "Agent 2",
+        ]
+        assert [agent.valid for agent in agents] == [True, True, False, True]
+        assert [name for name, _ in service.operations] == ["getAgentsById4"]
+
+        # Metadata in the cache isn't fetched again.
+        agents = client.get_agents_by_id(["testuser/agent-0", "testuser/missing"])
+        assert agents[0].owner == "testuser"
+        assert service.operations[-1] == (
+            "getAgentsById1",
+            {"agentId0": "testuser/missing"},
+        )
+        assert client.get_agents_by_id([]) == []
+
+
+def test_get_agents_by_id_with_errors(fixie_client, requests_mock):
+    requests_mock.post(
+        constants.FIXIE_GRAPHQL_URL,
+        json={
+            "data": {
+                "agent0": {"agentId": "testuser/test", "name": "Test Agent"},
+                "agent1": None,
+            },
+            "errors": [{"message": "No such agent: testuser/missing"}],
+        },
+    )
+    agents = fixie_client.get_agents_by_id(["testuser/test", "testuser/missing"])
+    assert agents[0].name == "Test Agent"
+    assert not agents[1].valid
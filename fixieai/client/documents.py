@@ -0,0 +1,200 @@
+"""The GraphQL documents sent to the Fixie API, each parsed only once.
+
+Documents are registered by the modules that send them:
+
+    _GET_AGENTS_QUERY = documents.register(
+        \"\"\"
+        query getAgents { ... }
+        \"\"\"
+    )
+    result = gqlclient.execute(_GET_AGENTS_QUERY.node)
+
+Clients created with `persisted_queries=True` send registered documents as
+automatic persisted queries: only the SHA-256 hash of the document is sent, and the
+full text is only sent again if the server hasn't seen the hash yet. Servers that
+don't support persisted queries are sent the full text from then on.
+"""
+
+import hashlib
+import threading
+from typing import Any, Dict, List, Optional
+
+from gql import gql
+from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.requests import RequestsHTTPTransport
+from graphql import DocumentNode
+from graphql import ExecutionResult
+from graphql import OperationDefinitionNode
+
+# Errors with which servers ask for the full text of a persisted query.
+_PERSISTED_QUERY_NOT_FOUND = "PersistedQueryNotFound"
+_PERSISTED_QUERY_NOT_SUPPORTED = "PersistedQueryNotSupported"
+
+
+class Document:
+    """A GraphQL document, parsed on first use.
+
+    Args:
+        text: The text of the document.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.sha256 = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        self._node: Optional[DocumentNode] = None
+        self._lock = threading.Lock()
+
+    @property
+    def node(self) -> DocumentNode:
+        """Return the parsed document."""
+        if self._node is None:
+            with self._lock:
+                if self._node is None:
+                    node = gql(self.text)
+                    _BY_NODE[id(node)] = self
+                    self._node = node
+        return self._node
+
+    @property
+    def operation_name(self) -> Optional[str]:
+        """Return the name of the document's first operation, if any."""
+        for definition in self.node.definitions:
+            if isinstance(definition, OperationDefinitionNode) and definition.name:
+                return definition.name.value
+        return None
+
+
+# Registered documents, by the ID of their parsed document, which they hold on to.
+_BY_NODE: Dict[int, Document] = {}
+# Registered documents, by their text.
+_BY_TEXT: Dict[str, Document] = {}
+
+
+def register(text: str) -> Document:
+    """Return the registered Document with `text`, registering it if needed."""
+    document = _BY_TEXT.get(text)
+    if document is None:
+        document = _BY_TEXT.setdefault(text, Document(text))
+    return document
+
+
+def lookup(node: DocumentNode) -> Optional[Document]:
+    """Return the registered Document that `node` was parsed from, if any."""
+    return _BY_NODE.get(id(node))
+
+
+def _persisted_query_kwargs(
+    kwargs: Dict[str, Any],
+    document: Document,
+    variable_values: Optional[Dict[str, Any]],
+    operation_name: Optional[str],
+    include_text: bool,
+) -> Dict[str, Any]:
+    """Return `kwargs` for a transport's `execute`, with the request's JSON body
+    replaced by that of a persisted query."""
+    payload: Dict[str, Any] = {
+        "extensions": {"persistedQuery": {"version": 1, "sha256Hash": document.sha256}},
+        "variables": variable_values,
+        "operationName": operation_name or document.operation_name,
+    }
+    if include_text:
+        payload["query"] = document.text
+    extra_args = {**(kwargs.get("extra_args") or {}), "json": payload}
+    return {**kwargs, "extra_args": extra_args}
+
+
+def _persisted_query_error(result: ExecutionResult) -> Optional[str]:
+    """Return the persisted query error in `result`, if it has one."""
+    # Transports return the errors as sent by the server, rather than GraphQLErrors.
+    errors: List[Any] = result.errors or []
+    for error in errors:
+        message: Optional[str] = (
+            error.get("message") if isinstance(error, dict) else None
+        )
+        if message in (_PERSISTED_QUERY_NOT_FOUND, _PERSISTED_QUERY_NOT_SUPPORTED):
+            return message
+    return None
+
+
+class PersistedQueryRequestsTransport(RequestsHTTPTransport):
+    """A RequestsHTTPTransport that sends registered documents by their hash."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Whether the server supports persisted queries, if known.
+        self.persisted_queries: Optional[bool] = None
+
+    def execute(  # type: ignore
+        self,
+        document: DocumentNode,
+        variable_values: Optional[Dict[str, Any]] = None,
+        operation_name: Optional[str] = None,
+        **kwargs,
+    ) -> ExecutionResult:
+        registered = lookup(document)
+        if registered is None or self.persisted_queries is False:
+            return super().execute(document, variable_values, operation_name, **kwargs)
+
+        args = (document, variable_values, operation_name)
+        result = super().execute(
+            *args,
+            **_persisted_query_kwargs(
+                kwargs, registered, variable_values, operation_name, False
+            ),
+        )
+        error = _persisted_query_error(result)
+        if error == _PERSISTED_QUERY_NOT_FOUND:
+            # Send the full text, which the server then knows the hash of.
+            result = super().execute(
+                *args,
+                **_persisted_query_kwargs(
+                    kwargs, registered, variable_values, operation_name, True
+                ),
+            )
+        elif error == _PERSISTED_QUERY_NOT_SUPPORTED:
+            self.persisted_queries = False
+            result = super().execute(*args, **kwargs)
+        return result
+
+
+class PersistedQueryAIOHTTPTransport(AIOHTTPTransport):
+    """An AIOHTTPTransport that sends registered documents by their hash."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Whether the server supports persisted queries, if known.
+        self.persisted_queries: Optional[bool] = None
+
+    async def execute(  # type: ignore
+        self,
+        document: DocumentNode,
+        variable_values: Optional[Dict[str, Any]] = None,
+        operation_name: Optional[str] = None,
+        **kwargs,
+    ) -> ExecutionResult:
+        registered = lookup(document)
+        if registered is None or self.persisted_queries is False:
+            return await super().execute(
+                document, variable_values, operation_name, **kwargs
+            )
+
+        args = (document, variable_values, operation_name)
+        result = await super().execute(
+            *args,
+            **_persisted_query_kwargs(
+                kwargs, registered, variable_values, operation_name, False
+            ),
+        )
+        error = _persisted_query_error(result)
+        if error == _PERSISTED_QUERY_NOT_FOUND:
+            # Send the full text, which the server then knows the hash of.
+            result = await super().execute(
+                *args,
+                **_persisted_query_kwargs(
+                    kwargs, registered, variable_values, operation_name, True
+                ),
+            )
+        elif error == _PERSISTED_QUERY_NOT_SUPPORTED:
+            self.persisted_queries = False
+            result = await super().execute(*args, **kwargs)
+        return result
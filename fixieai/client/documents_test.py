@@ -0,0 +1,74 @@
+import asyncio
+
+from fixieai.client import documents
+from fixieai.client import local_service
+from fixieai.client.client import AsyncFixieClient
+from fixieai.client.client import FixieClient
+
+GET_USERNAME = """
+    query getUsername {
+        user {
+            username
+        }
+    }
+"""
+
+
+def test_documents_are_parsed_once(mocker):
+    document = documents.register(GET_USERNAME)
+    assert documents.register(GET_USERNAME) is document
+    assert document.node is document.node
+    assert documents.lookup(document.node) is document
+    assert document.operation_name == "getUsername"
+
+    with local_service.LocalFixieService() as service:
+        session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+        list(session.run("Hello"))
+        list(session.run("Again"))
+        parse = mocker.spy(documents, "gql")
+        list(session.run("And again"))
+        session.query("Once more")
+        parse.assert_not_called()
+
+
+def test_persisted_queries():
+    with local_service.LocalFixieService() as service:
+        client = FixieClient(
+            api_key="test-key", api_url=service.url, persisted_queries=True
+        )
+        assert client.get_sessions() == []
+        # The server didn't know the query yet.
+        assert service.query_text_count == 1
+        assert client.get_sessions() == []
+        assert client.clone().get_sessions() == []
+        assert service.query_text_count == 1
+        assert [name for name, _ in service.operations] == ["getSessions"] * 3
+
+
+def test_persisted_queries_not_supported():
+    with local_service.LocalFixieService(persisted_queries=False) as service:
+        client = FixieClient(
+            api_key="test-key", api_url=service.url, persisted_queries=True
+        )
+        assert client.get_sessions() == []
+        assert client.get_sessions() == []
+        # The server is only sent a hash it doesn't support once.
+        assert service.query_text_count == 2
+        transport = client.gqlclient.transport
+        assert isinstance(transport, documents.PersistedQueryRequestsTransport)
+        assert transport.persisted_queries is False
+
+
+def test_async_persisted_queries():
+    async def run(url):
+        async with AsyncFixieClient(
+            api_key="test-key", api_url=url, persisted_queries=True
+        ) as client:
+            session = await client.create_session()
+            for text in ["Hello", "Again", "And again"]:
+                assert await session.query(text) == f"You said: {text}"
+
+    with local_service.LocalFixieService() as service:
+        asyncio.run(run(service.url))
+        # createSession, Post and getMessagesAfter were each sent in full once.
+        assert service.query_text_count == 3
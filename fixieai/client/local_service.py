@@ -0,0 +1,696 @@
+"""A local stand-in for the Fixie GraphQL API.
+
+It implements the subset of the platform's schema that FixieClient uses, and the
+agent refresh and deployment endpoints, keeping agents and sessions in memory, so that
+the client can be tested and benchmarked offline. Queries to agents are answered by a
+`responder`, which produces the messages an agent would.
+
+Usage:
+    with LocalFixieService() as service:
+        client = FixieClient(api_key="test-key", api_url=service.url)
+
+Subscriptions are served over websockets at the same URL, with the graphql-ws
+protocol that gql's WebsocketsTransport speaks.
+"""
+
+import asyncio
+import base64
+import datetime
+import email.parser
+import email.policy
+import hashlib
+import http.server
+import itertools
+import json
+import re
+import struct
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+import graphql
+
+# The username that all API keys authenticate as.
+USERNAME = "testuser"
+# Seconds that subscriptions wait for new messages before checking if they're done.
+_SUBSCRIPTION_POLL_TIMEOUT = 0.1
+# The paths of the agent refresh and deployment endpoints, by the agent ID.
+_AGENT_UPDATE_PATH_RE = re.compile(r"^/api/(refresh|deployments)/(\w+/[\w-]+)$")
+# Appended to a websocket key to accept it, per RFC 6455.
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+_SCHEMA = """
+type Query {
+    allAgents: [Agent!]!
+    agentById(agentId: String!): Agent
+    agentByHandle(handle: String!): Agent
+    allSessions: [Session!]!
+    sessionByHandle(handle: String!): Session
+    user: User!
+}
+
+type Mutation {
+    createSession(sessionData: SessionInput!): SessionPayload
+    deleteSession(handle: String!): SessionPayload
+    sendSessionMessage(messageData: MessageInput!): MessagePayload
+    createAgent(agentData: AgentInput!): AgentPayload
+    updateAgent(agentData: AgentInput!): AgentPayload
+    deleteAgent(handle: String!): AgentPayload
+}
+
+type User {
+    username: String!
+}
+
+type Agent {
+    agentId: String!
+    handle: String!
+    name: String
+    description: String
+    queries: [String!]
+    moreInfoUrl: String
+    published: Boolean
+    owner: User!
+    queryUrl: String
+    funcUrl: String
+    created: String
+    modified: String
+}
+
+type Session {
+    handle: String!
+    name: String
+    description: String
+    frontendAgentId: String
+    messages%(messages_args)s: [Message!]!
+    embeds: [SessionEmbed!]!
+}
+
+type Message {
+    id: ID!
+    text: String!
+    sentBy: Agent
+    type: String!
+    inReplyTo: Message
+    timestamp: String!
+}
+
+type Subscription {
+    sessionMessages(handle: String!, after: ID): Message!
+}
+
+type SessionEmbed {
+    key: String!
+    embed: Embed!
+}
+
+type Embed {
+    id: ID!
+    contentType: String
+    created: String
+    contentHash: String
+    owner: User
+    url: String
+}
+
+input SessionInput {
+    frontendAgentId: String
+}
+
+input MessageInput {
+    session: String!
+    text: String!
+}
+
+input AgentInput {
+    handle: String!
+    newHandle: String
+    name: String
+    description: String
+    queryUrl: String
+    funcUrl: String
+    moreInfoUrl: String
+    published: Boolean
+}
+
+type SessionPayload {
+    session: Session
+}
+
+type MessagePayload {
+    message: Message
+}
+
+type AgentPayload {
+    agent: Agent
+}
+"""
+
+# Produces the (type, text) of the messages an agent sends in reply to a query, the
+# last of which should be its "response".
+Responder = Callable[[str], Iterable[Tuple[str, str]]]
+
+
+def echo_responder(text: str) -> Iterable[Tuple[str, str]]:
+    """Replies to queries with their own text."""
+    yield "thought", f"Thinking about {text!r}"
+    yield "response", f"You said: {text}"
+
+
+class LocalFixieService:
+    """Serves the Fixie GraphQL API on a local port from a background thread.
+
+    Args:
+        host: The address to listen at.
+        port: The port to listen at. By default, a free port is picked.
+        responder: Produces the messages of the agent answering queries.
+        reply_delay: Seconds the agent takes to send each message.
+        incremental_messages: Whether `Session.messages` takes an `after` cursor, as
+            it didn't in older versions of the API.
+        subscriptions: Whether to serve subscriptions.
+        persisted_queries: Whether to take automatic persisted queries, sent by the
+            hash of their text.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        responder: Responder = echo_responder,
+        reply_delay: float = 0.0,
+        incremental_messages: bool = True,
+        subscriptions: bool = True,
+        persisted_queries: bool = True,
+    ):
+        self.responder = responder
+        self.subscriptions = subscriptions
+        self.persisted_queries = persisted_queries
+        self.reply_delay = reply_delay
+        # The operations served, by name, and their variables.
+        self.operations: List[Tuple[Optional[str], Dict[str, Any]]] = []
+        # The number of requests that included the text of their query.
+        self.query_text_count = 0
+        # The IDs of the agents refreshed, in order.
+        self.refreshed: List[str] = []
+        # The ID of the agent of each deployment, and its files by name, in order.
+        self.deployments: List[Tuple[str, Dict[str, bytes]]] = []
+        # The most requests that were being served at once.
+        self.max_concurrent_requests = 0
+        self._concurrent_requests = 0
+        # The text of persisted queries, by their SHA-256 hash.
+        self._persisted: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        # Notified when messages are added to any session.
+        self._new_messages = threading.Condition(self._lock)
+        self._ids = itertools.count(1)
+        self._agents: Dict[str, Dict[str, Any]] = {}
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        messages_args = "(after: ID)" if incremental_messages else ""
+        self._schema = graphql.build_schema(_SCHEMA % {"messages_args": messages_args})
+        assert self._schema.subscription_type is not None
+        field = self._schema.subscription_type.fields["sessionMessages"]
+        field.subscribe = self._subscribe_session_messages
+        field.resolve = lambda message, info, **args: message
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), _make_handler(self)
+        )
+        self._server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        """The URL to pass to FixieClient as `api_url`."""
+        host, port = self._server.server_address[:2]
+        return f"http://{host!s}:{port}"
+
+    def start(self):
+        """Starts serving in a background thread."""
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, args=(0.05,), daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stops serving and closes the listening socket."""
+        self._server.shutdown()
+        self._server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def __enter__(self) -> "LocalFixieService":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Handles a GraphQL request body, and returns the JSON response."""
+        with self._lock:
+            self._concurrent_requests += 1
+            self.max_concurrent_requests = max(
+                self.max_concurrent_requests, self._concurrent_requests
+            )
+        try:
+            return self._handle(request)
+        finally:
+            with self._lock:
+                self._concurrent_requests -= 1
+
+    def handle_agent_update(
+        self, path: str, content_type: str, body: bytes
+    ) -> Optional[Dict[str, Any]]:
+        """Handles a request to the agent refresh or deployment endpoints, and returns
+        the JSON response, or None if `path` isn't one of them."""
+        match = _AGENT_UPDATE_PATH_RE.match(path)
+        if match is None:
+            return None
+        endpoint, agent_id = match.groups()
+        if endpoint == "refresh":
+            with self._lock:
+                self.refreshed.append(agent_id)
+        elif endpoint == "deployments":
+            form = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+            )
+            files: Dict[str, bytes] = {}
+            for part in form.get_payload():
+                name = part.get_param("name", header="content-disposition")
+                files[name] = part.get_payload(decode=True)
+            with self._lock:
+                self.deployments.append((agent_id, files))
+        return {}
+
+    def _handle(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        query = request.get("query")
+        persisted = request.get("extensions", {}).get("persistedQuery")
+        if query is not None:
+            with self._lock:
+                self.query_text_count += 1
+        if persisted is not None and self.persisted_queries:
+            digest = hashlib.sha256((query or "").encode("utf-8")).hexdigest()
+            if query is None:
+                query = self._persisted.get(persisted["sha256Hash"])
+                if query is None:
+                    return {"errors": [{"message": "PersistedQueryNotFound"}]}
+            elif digest != persisted["sha256Hash"]:
+                return {"errors": [{"message": "provided sha does not match query"}]}
+            else:
+                self._persisted[digest] = query
+        elif query is None:
+            if persisted is not None:
+                return {"errors": [{"message": "PersistedQueryNotSupported"}]}
+            return {"errors": [{"message": "Must provide query string."}]}
+        return self.execute(
+            query, request.get("variables"), request.get("operationName")
+        )
+
+    def execute(
+        self,
+        query: str,
+        variables: Optional[Dict[str, Any]] = None,
+        operation_name: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        """Executes a GraphQL request, and returns the JSON response."""
+        with self._lock:
+            self.operations.append(
+                (_operation_name(query, operation_name), variables or {})
+            )
+        result = graphql.graphql_sync(
+            self._schema,
+            query,
+            root_value=_Root(self),
+            variable_values=variables,
+            operation_name=operation_name,
+        )
+        return dict(result.formatted)
+
+    def _next_id(self) -> str:
+        with self._lock:
+            return str(next(self._ids))
+
+    def _add_message(
+        self,
+        session: Dict[str, Any],
+        message_type: str,
+        text: str,
+        sent_by: Optional[Dict[str, Any]] = None,
+        in_reply_to: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        message = {
+            "id": self._next_id(),
+            "text": text,
+            "sentBy": sent_by,
+            "type": message_type,
+            "inReplyTo": in_reply_to,
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        with self._lock:
+            session["_messages"].append(message)
+            self._new_messages.notify_all()
+        return message
+
+    async def _subscribe_session_messages(
+        self, root: Any, info: graphql.GraphQLResolveInfo, handle: str, after=None
+    ) -> AsyncIterator[Dict[str, Any]]:
+        session = self._sessions.get(handle)
+        if session is None:
+            raise ValueError(f"No such session: {handle}")
+        return self._iter_messages(session, after, info.context)
+
+    async def _iter_messages(
+        self, session: Dict[str, Any], after: Optional[str], done: threading.Event
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Yields the messages of `session` after `after` as they're added."""
+        loop = asyncio.get_running_loop()
+        while not done.is_set():
+            messages = await loop.run_in_executor(
+                None, self._wait_for_messages, session, after
+            )
+            for message in messages:
+                yield message
+                after = message["id"]
+
+    def _wait_for_messages(
+        self, session: Dict[str, Any], after: Optional[str]
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            messages = _messages_after(session["_messages"], after)
+            if not messages:
+                self._new_messages.wait(_SUBSCRIPTION_POLL_TIMEOUT)
+                messages = _messages_after(session["_messages"], after)
+        return messages
+
+    def _serve_subscription(
+        self,
+        websocket: "_WebSocket",
+        operation_id: str,
+        payload: Dict[str, Any],
+        done: threading.Event,
+    ):
+        """Sends the results of a subscription over `websocket` until `done`."""
+
+        async def run():
+            try:
+                document = graphql.parse(payload["query"])
+            except graphql.GraphQLError as e:
+                return [e]
+            errors = graphql.validate(self._schema, document)
+            if errors:
+                return errors
+            results = await graphql.subscribe(
+                self._schema,
+                document,
+                context_value=done,
+                variable_values=payload.get("variables"),
+                operation_name=payload.get("operationName"),
+            )
+            if isinstance(results, graphql.ExecutionResult):
+                return results.errors
+            async for result in results:
+                if done.is_set():
+                    break
+                websocket.send_json(
+                    {"type": "data", "id": operation_id, "payload": result.formatted}
+                )
+            return None
+
+        with self._lock:
+            self.operations.append(
+                (
+                    _operation_name(payload["query"], payload.get("operationName")),
+                    payload.get("variables") or {},
+                )
+            )
+        try:
+            errors = asyncio.run(run())
+            if errors:
+                websocket.send_json(
+                    {
+                        "type": "error",
+                        "id": operation_id,
+                        "payload": errors[0].formatted,
+                    }
+                )
+            elif not done.is_set():
+                websocket.send_json({"type": "complete", "id": operation_id})
+        except OSError:
+            pass  # The client disconnected.
+
+
+class _Root:
+    """Resolves the fields of queries and mutations."""
+
+    def __init__(self, service: LocalFixieService):
+        self._service = service
+
+    def allAgents(self, info) -> List[Dict[str, Any]]:
+        return list(self._service._agents.values())
+
+    def agentById(self, info, agentId: str) -> Optional[Dict[str, Any]]:
+        return self._service._agents.get(agentId)
+
+    def agentByHandle(self, info, handle: str) -> Optional[Dict[str, Any]]:
+        return self._service._agents.get(f"{USERNAME}/{handle}")
+
+    def allSessions(self, info) -> List[Dict[str, Any]]:
+        return list(self._service._sessions.values())
+
+    def sessionByHandle(self, info, handle: str) -> Optional[Dict[str, Any]]:
+        return self._service._sessions.get(handle)
+
+    def user(self, info) -> Dict[str, Any]:
+        return {"username": USERNAME}
+
+    def createSession(self, info, sessionData: Dict[str, Any]) -> Dict[str, Any]:
+        handle = f"session-{self._service._next_id()}"
+        messages: List[Dict[str, Any]] = []
+        session: Dict[str, Any] = {
+            "handle": handle,
+            "name": None,
+            "description": None,
+            "frontendAgentId": sessionData.get("frontendAgentId"),
+            "embeds": [],
+            "_messages": messages,
+            "messages": lambda info, after=None: _messages_after(messages, after),
+        }
+        self._service._sessions[handle] = session
+        return {"session": session}
+
+    def deleteSession(self, info, handle: str) -> Dict[str, Any]:
+        return {"session": self._service._sessions.pop(handle, None)}
+
+    def sendSessionMessage(self, info, messageData: Dict[str, Any]) -> Dict[str, Any]:
+        """Adds the query, then waits for the agent to reply, as the platform does."""
+        service = self._service
+        session = service._sessions.get(messageData["session"])
+        if session is None:
+            raise ValueError(f"No such session: {messageData['session']}")
+        query = service._add_message(session, "query", messageData["text"])
+        agent = {"handle": session["frontendAgentId"] or "fixie"}
+        for message_type, text in service.responder(messageData["text"]):
+            time.sleep(service.reply_delay)
+            service._add_message(
+                session, message_type, text, agent, {"id": query["id"]}
+            )
+        return {"message": query}
+
+    def createAgent(self, info, agentData: Dict[str, Any]) -> Dict[str, Any]:
+        agent_id = f"{USERNAME}/{agentData['handle']}"
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        agent = {
+            "agentId": agent_id,
+            "handle": agentData["handle"],
+            "name": agentData.get("name"),
+            "description": agentData.get("description"),
+            "queries": [],
+            "moreInfoUrl": agentData.get("moreInfoUrl"),
+            "published": agentData.get("published"),
+            "owner": {"username": USERNAME},
+            "queryUrl": agentData.get("queryUrl"),
+            "funcUrl": agentData.get("funcUrl"),
+            "created": now,
+            "modified": now,
+        }
+        self._service._agents[agent_id] = agent
+        return {"agent": agent}
+
+    def updateAgent(self, info, agentData: Dict[str, Any]) -> Dict[str, Any]:
+        agent = self._service._agents.pop(f"{USERNAME}/{agentData['handle']}", None)
+        if agent is None:
+            raise ValueError(f"No such agent: {agentData['handle']}")
+        handle = agentData.get("newHandle") or agent["handle"]
+        agent.update(
+            {key: value for key, value in agentData.items() if value is not None},
+            handle=handle,
+            agentId=f"{USERNAME}/{handle}",
+            modified=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        )
+        agent.pop("newHandle", None)
+        self._service._agents[agent["agentId"]] = agent
+        return {"agent": agent}
+
+    def deleteAgent(self, info, handle: str) -> Dict[str, Any]:
+        return {"agent": self._service._agents.pop(f"{USERNAME}/{handle}", None)}
+
+
+def _operation_name(query: str, operation_name: Optional[str]) -> Optional[str]:
+    """Returns the name of the operation that a request executes, if it has one."""
+    try:
+        document = graphql.parse(query)
+    except graphql.GraphQLError:
+        return operation_name
+    operation = graphql.get_operation_ast(document, operation_name)
+    if operation is None or operation.name is None:
+        return operation_name
+    return operation.name.value
+
+
+def _messages_after(
+    messages: List[Dict[str, Any]], after: Optional[str]
+) -> List[Dict[str, Any]]:
+    """Returns the messages following the one with id `after`, or all of them."""
+    messages = list(messages)
+    if after is None:
+        return messages
+    for index, message in enumerate(messages):
+        if message["id"] == after:
+            return messages[index + 1 :]
+    return messages
+
+
+class _WebSocket:
+    """The server end of a websocket, per RFC 6455, sending text frames."""
+
+    def __init__(self, rfile, wfile):
+        self._rfile = rfile
+        self._wfile = wfile
+        self._lock = threading.Lock()
+
+    def receive(self) -> Optional[str]:
+        """Returns the next text message, or None once the connection is closed."""
+        message = b""
+        while True:
+            header = self._rfile.read(2)
+            if len(header) < 2:
+                return None
+            final, opcode = header[0] & 0x80, header[0] & 0x0F
+            length = header[1] & 0x7F
+            if length == 126:
+                (length,) = struct.unpack(">H", self._rfile.read(2))
+            elif length == 127:
+                (length,) = struct.unpack(">Q", self._rfile.read(8))
+            mask = self._rfile.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+            data = bytes(
+                byte ^ mask[i % 4] for i, byte in enumerate(self._rfile.read(length))
+            )
+            if opcode == 0x8:
+                self._send_frame(0x8, data[:2])
+                return None
+            elif opcode == 0x9:
+                self._send_frame(0xA, data)
+            elif opcode in (0x0, 0x1):
+                message += data
+                if final:
+                    return message.decode("utf-8")
+
+    def send_json(self, message: Dict[str, Any]):
+        self._send_frame(0x1, json.dumps(message).encode("utf-8"))
+
+    def _send_frame(self, opcode: int, data: bytes):
+        if len(data) < 126:
+            header = struct.pack(">BB", 0x80 | opcode, len(data))
+        elif len(data) < 1 << 16:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, len(data))
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, len(data))
+        with self._lock:
+            self._wfile.write(header + data)
+
+
+def _serve_graphql_ws(service: LocalFixieService, websocket: _WebSocket):
+    """Serves the graphql-ws protocol until the client disconnects."""
+    operations: Dict[str, threading.Event] = {}
+    try:
+        while True:
+            text = websocket.receive()
+            if text is None:
+                break
+            message = json.loads(text)
+            message_type = message.get("type")
+            if message_type == "connection_init":
+                websocket.send_json({"type": "connection_ack"})
+            elif message_type == "start":
+                done = operations[message["id"]] = threading.Event()
+                threading.Thread(
+                    target=service._serve_subscription,
+                    args=(websocket, message["id"], message["payload"], done),
+                    daemon=True,
+                ).start()
+            elif message_type == "stop":
+                operations.pop(message["id"], threading.Event()).set()
+                websocket.send_json({"type": "complete", "id": message["id"]})
+            elif message_type == "connection_terminate":
+                break
+    finally:
+        for done in operations.values():
+            done.set()
+
+
+def _make_handler(service: LocalFixieService):
+    class _Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            protocols = self.headers.get("Sec-WebSocket-Protocol", "")
+            if (
+                not service.subscriptions
+                or self.headers.get("Upgrade", "").lower() != "websocket"
+                or "graphql-ws" not in [p.strip() for p in protocols.split(",")]
+            ):
+                self._respond(404, {"errors": [{"message": "not found"}]})
+                return
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                self._respond(401, {"errors": [{"message": "unauthorized"}]})
+                return
+            key = self.headers["Sec-WebSocket-Key"] + _WEBSOCKET_GUID
+            accept = base64.b64encode(hashlib.sha1(key.encode()).digest()).decode()
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", accept)
+            self.send_header("Sec-WebSocket-Protocol", "graphql-ws")
+            self.end_headers()
+            self.close_connection = True
+            _serve_graphql_ws(service, _WebSocket(self.rfile, self.wfile))
+
+        def do_POST(self):
+            if not self.headers.get("Authorization", "").startswith("Bearer "):
+                self._respond(401, {"errors": [{"message": "unauthorized"}]})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length)
+            if self.path.startswith("/api/"):
+                response = service.handle_agent_update(
+                    self.path, self.headers.get("Content-Type", ""), body
+                )
+                if response is None:
+                    self._respond(404, {"error": "not found"})
+                else:
+                    self._respond(200, response)
+                return
+            self._respond(200, service.handle(json.loads(body)))
+
+        def _respond(self, status: int, response: Any):
+            content = json.dumps(response).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return _Handler
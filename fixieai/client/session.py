@@ -2,19 +2,178 @@
 
 from __future__ import annotations
 
-import datetime
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
 import threading
 import time
-from typing import TYPE_CHECKING, Any, Dict, Generator, List, Optional
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncGenerator,
+    Dict,
+    Generator,
+    List,
+    Optional,
+    Set,
+)
 
-from gql import gql
+from gql.transport.exceptions import TransportError
+from gql.transport.exceptions import TransportQueryError
+from websockets.exceptions import WebSocketException
+
+from fixieai.client import documents
 
 if TYPE_CHECKING:
     import fixieai.client as fixie_client
 
     FixieClient = fixie_client.FixieClient
+    AsyncFixieClient = fixie_client.AsyncFixieClient
 else:
     FixieClient = Any
+    AsyncFixieClient = Any
+
+# Seconds between the first polls for new messages in `Session.run`. The interval
+# grows by _POLL_BACKOFF while no new messages come in, up to _MAX_POLL_INTERVAL.
+_MIN_POLL_INTERVAL = 0.02
+_MAX_POLL_INTERVAL = 1.0
+_POLL_BACKOFF = 1.5
+# Errors that mean the server can't stream messages, so `Session.stream` polls.
+_SUBSCRIPTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    TransportError,
+    WebSocketException,
+)
+
+_CREATE_SESSION_MUTATION = documents.register(
+    """
+    mutation CreateSession($frontendAgentId: String) {
+        createSession(sessionData: {frontendAgentId: $frontendAgentId}) {
+            session {
+                handle
+                frontendAgentId
+            }
+        }
+    }
+"""
+)
+
+_GET_SESSION_QUERY = documents.register(
+    """
+    query getSession($session_id: String!) {
+        sessionByHandle(handle: $session_id) {
+            handle
+            name
+            description
+            frontendAgentId
+        }
+    }
+"""
+)
+
+_DELETE_SESSION_MUTATION = documents.register(
+    """
+    mutation DeleteSession($handle: String!) {
+        deleteSession(handle: $handle) {
+            session {
+                handle
+            }
+        }
+    }
+"""
+)
+
+_GET_EMBEDS_QUERY = documents.register(
+    """
+    query getEmbeds($handle: String!) {
+        sessionByHandle(handle: $handle) {
+            embeds {
+                key
+                embed {
+                    id
+                    contentType
+                    created
+                    contentHash
+                    owner {
+                        username
+                    }
+                    url
+                }
+            }
+        }
+    }
+"""
+)
+
+_GET_MESSAGES_QUERY = documents.register(
+    """
+    query getMessages($handle: String!) {
+        sessionByHandle(handle: $handle) {
+            messages {
+                id
+                text
+                sentBy {
+                    handle
+                }
+                type
+                inReplyTo { id }
+                timestamp
+            }
+        }
+    }
+"""
+)
+
+_GET_MESSAGES_AFTER_QUERY = documents.register(
+    """
+    query getMessagesAfter($handle: String!, $after: ID) {
+        sessionByHandle(handle: $handle) {
+            messages(after: $after) {
+                id
+                text
+                sentBy {
+                    handle
+                }
+                type
+                inReplyTo { id }
+                timestamp
+            }
+        }
+    }
+"""
+)
+
+_POST_MESSAGE_MUTATION = documents.register(
+    """
+    mutation Post($handle: String!, $text: String!) {
+        sendSessionMessage(messageData: {session: $handle, text: $text}) {
+            message {
+                id
+                text
+            }
+        }
+    }
+"""
+)
+
+_SESSION_MESSAGES_SUBSCRIPTION = documents.register(
+    """
+    subscription sessionMessages($handle: String!, $after: ID) {
+        sessionMessages(handle: $handle, after: $after) {
+            id
+            text
+            sentBy {
+                handle
+            }
+            type
+            inReplyTo { id }
+            timestamp
+        }
+    }
+"""
+)
 
 
 class Session:
@@ -44,7 +203,11 @@ class Session:
         else:
             self._session_id = self._create_session(frontend_agent_id)
         self._frontend_agent_id: Optional[str] = None
-        self._last_message_timestamp: Optional[datetime.datetime] = None
+        self._last_message_id: Optional[str] = None
+        # Whether the server can return only the messages after a given one, if known.
+        self._incremental_messages: Optional[bool] = None
+        # Whether the server can stream new messages, if known.
+        self._subscriptions: Optional[bool] = None
 
     @property
     def session_id(self) -> Optional[str]:
@@ -69,183 +232,447 @@ class Session:
         """Create a new session."""
         assert self._session_id is None
 
-        query = gql(
-            """
-            mutation CreateSession($frontendAgentId: String) {
-                createSession(sessionData: {frontendAgentId: $frontendAgentId}) {
-                    session {
-                        handle
-                        frontendAgentId
-                    }
-                }
-            }
-            """
-        )
-
+        query = _CREATE_SESSION_MUTATION.node
         result = self._gqlclient.execute(
             query, variable_values={"frontendAgentId": frontend_agent_id}
         )
-        if "createSession" not in result or result["createSession"] is None:
-            raise ValueError(f"Failed to create Session")
-        assert isinstance(result["createSession"], dict)
-        assert isinstance(result["createSession"]["session"], dict)
-        self._frontend_agent_id = result["createSession"]["session"]["frontendAgentId"]
-        assert isinstance(result["createSession"]["session"]["handle"], str)
-        return result["createSession"]["session"]["handle"]
+        session = _created_session_from_result(result)
+        self._frontend_agent_id = session["frontendAgentId"]
+        handle: str = session["handle"]
+        return handle
 
     def get_metadata(self) -> Dict[str, Any]:
         """Return metadata about this session."""
 
-        query = gql(
-            """
-            query getSession($session_id: String!) {
-                sessionByHandle(handle: $session_id) {
-                    handle
-                    name
-                    description
-                    frontendAgentId
-                }
-            }
-        """
-        )
+        query = _GET_SESSION_QUERY.node
         result = self._gqlclient.execute(
             query, variable_values={"session_id": self._session_id}
         )
-        assert "sessionByHandle" in result and isinstance(
-            result["sessionByHandle"], dict
-        )
-        self._frontend_agent_id = result["sessionByHandle"]["frontendAgentId"]
-        return result["sessionByHandle"]
+        metadata = _session_metadata_from_result(result)
+        self._frontend_agent_id = metadata["frontendAgentId"]
+        return metadata
 
     def delete_session(self) -> None:
         """Delete the current session."""
-        query = gql(
-            """
-            mutation DeleteSession($handle: String!) {
-                deleteSession(handle: $handle) {
-                    session {
-                        handle
-                    }
-                }
-            }
-        """
-        )
+        query = _DELETE_SESSION_MUTATION.node
         _ = self._gqlclient.execute(query, variable_values={"handle": self._session_id})
 
     def get_embeds(self) -> List[Dict[str, Any]]:
         """Return the Embeds attached to this Session."""
-        query = gql(
-            """
-            query getEmbeds($handle: String!) {
-                sessionByHandle(handle: $handle) {
-                    embeds {
-                        key
-                        embed {
-                            id
-                            contentType
-                            created
-                            contentHash
-                            owner {
-                                username
-                            }
-                            url
-                        }
-                    }
-                }
-            }
-        """
-        )
+        query = _GET_EMBEDS_QUERY.node
         result = self._gqlclient.execute(
             query, variable_values={"handle": self._session_id}
         )
-        assert (
-            "sessionByHandle" in result
-            and isinstance(result["sessionByHandle"], dict)
-            and isinstance(result["sessionByHandle"]["embeds"], list)
-        )
-        return result["sessionByHandle"]["embeds"]
-
-    def get_messages(self) -> List[Dict[str, Any]]:
-        """Return the messages that make up this session."""
-        query = gql(
-            """
-            query getMessages($handle: String!) {
-                sessionByHandle(handle: $handle) {
-                    messages {
-                        id
-                        text
-                        sentBy {
-                            handle
-                        }
-                        type
-                        inReplyTo { id }
-                        timestamp
-                    }
-                }
-            }
+        return _embeds_from_result(result)
+
+    def get_messages(self, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the messages that make up this session.
+
+        Args:
+            after: If set, only the messages following the one with this ID are
+                returned. Not all servers support this.
         """
-        )
+        if after is not None:
+            return self._get_messages_after(after)
+        query = _GET_MESSAGES_QUERY.node
         result = self._gqlclient.execute(
             query, variable_values={"handle": self._session_id}
         )
-        assert (
-            "sessionByHandle" in result
-            and isinstance(result["sessionByHandle"], dict)
-            and isinstance(result["sessionByHandle"]["messages"], list)
+        return _messages_from_result(result)
+
+    def _get_messages_after(self, after: str) -> List[Dict[str, Any]]:
+        query = _GET_MESSAGES_AFTER_QUERY.node
+        result = self._gqlclient.execute(
+            query, variable_values={"handle": self._session_id, "after": after}
         )
-        return result["sessionByHandle"]["messages"]
+        return _messages_from_result(result)
 
     def add_message(self, text: str) -> str:
         """Add a message to this Session. Returns the added message text."""
-        query = gql(
-            """
-            mutation Post($handle: String!, $text: String!) {
-                sendSessionMessage(messageData: {session: $handle, text: $text}) {
-                    message {
-                        text
-                    }
-                }
-            }
-            """
-        )
+        message = self._send_message(text)
+        assert isinstance(message["text"], str)
+        return message["text"]
+
+    def _send_message(self, text: str) -> Dict[str, Any]:
+        """Add a message to this Session, and return its ID and text."""
+        query = _POST_MESSAGE_MUTATION.node
         result = self._gqlclient.execute(
             query, variable_values={"handle": self._session_id, "text": text}
         )
-        assert isinstance(result["sendSessionMessage"]["message"]["text"], str)
-        return result["sendSessionMessage"]["message"]["text"]
+        return _message_from_result(result)
 
     def query(self, text: str) -> str:
         """Run a single query against the Fixie API and return the response."""
-        self.add_message(text)
+        message = self._send_message(text)
         # The reply to the query comes in as the most recent 'response' message in the
-        # session.
-        response = self.get_messages()[-1]
-        assert isinstance(response["text"], str)
-        return response["text"]
+        # session, so only the messages following the query are fetched.
+        replies = self._get_messages_following(str(message["id"]))
+        return _response_text(message, replies)
 
     def run(self, text: str) -> Generator[Dict[str, Any], None, None]:
         """Run a query against the Fixie API, returning a generator that yields
         messages."""
 
         # Run the query in the background, and continue polling for replies.
-        background_client = self.clone()
-        threading.Thread(target=background_client.add_message, args=(text,)).start()
+        yield from self._poll_replies(self._send_in_background(text))
+
+    def stream(self, text: str) -> Generator[Dict[str, Any], None, None]:
+        """Run a query against the Fixie API, returning a generator that yields
+        messages as the server pushes them.
+
+        Messages are received over a GraphQL subscription. If the server doesn't
+        support subscriptions, this polls for messages like `run`.
+        """
+        sending = self._send_in_background(text)
+        if self._subscriptions is not False:
+            try:
+                response_received = yield from self._stream_subscription(sending)
+            except _SUBSCRIPTION_ERRORS as e:
+                # Errors from the server mean it can't serve the subscription, unlike
+                # connection errors once subscriptions are known to work.
+                if isinstance(e, TransportQueryError) or not self._subscriptions:
+                    self._subscriptions = False
+                logging.info(f"Polling for messages, as streaming failed: {e}")
+            else:
+                if response_received:
+                    return
+                if sending.done():
+                    # Raise any error sending the query.
+                    sending.result()
+        yield from self._poll_replies(sending)
+
+    def _send_in_background(self, text: str) -> concurrent.futures.Future:
+        """Add a message to this Session from another thread, as adding it only
+        returns once the agent has replied."""
+        sending: concurrent.futures.Future = concurrent.futures.Future()
 
+        def send():
+            try:
+                sending.set_result(self.clone().add_message(text))
+            except Exception as e:
+                sending.set_exception(e)
+
+        threading.Thread(target=send, daemon=True).start()
+        return sending
+
+    def _poll_replies(
+        self, sending: concurrent.futures.Future
+    ) -> Generator[Dict[str, Any], None, None]:
+        """Yield new messages until the response to the message being sent."""
+        # Poll often at first, to pick up replies quickly, then back off while the
+        # agent is busy.
+        interval = _MIN_POLL_INTERVAL
         response_received = False
         while not response_received:
-            time.sleep(1)
+            time.sleep(interval)
             messages = self.get_messages_since_last_time()
             for message in messages:
                 response_received = message["type"] == "response"
                 yield message
+            error = sending.exception() if sending.done() else None
+            if messages:
+                interval = _MIN_POLL_INTERVAL
+            elif error is not None:
+                raise error
+            else:
+                interval = min(interval * _POLL_BACKOFF, _MAX_POLL_INTERVAL)
+
+    def _stream_subscription(
+        self, sending: concurrent.futures.Future
+    ) -> Generator[Dict[str, Any], None, bool]:
+        """Yield new messages pushed by the server, until the response to the
+        message being sent. Returns whether the response was received, rather than
+        the subscription ending or the message failing to send."""
+        query = _SESSION_MESSAGES_SUBSCRIPTION.node
+        loop = asyncio.new_event_loop()
+        client = self._client.subscription_client()
+        sent = asyncio.wrap_future(sending, loop=loop)
+        results: Optional[AsyncGenerator[Dict[str, Any], None]] = None
+        next_message: Optional[asyncio.Future] = None
+        try:
+            session = loop.run_until_complete(client.connect_async())
+            results = subscription = session.subscribe(
+                query,
+                variable_values={
+                    "handle": self._session_id,
+                    "after": self._last_message_id,
+                },
+            )
+            while True:
+                next_message = pending = asyncio.ensure_future(
+                    subscription.__anext__(), loop=loop
+                )
+                while not pending.done():
+                    if sent.done() and sent.exception() is not None:
+                        return False
+                    waiting: Set[asyncio.Future] = {pending}
+                    if not sent.done():
+                        waiting.add(sent)
+                    loop.run_until_complete(
+                        asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                    )
+                try:
+                    result = pending.result()
+                except StopAsyncIteration:
+                    return False
+                # The server only accepted the subscription once it sends a result.
+                self._subscriptions = True
+                message = result["sessionMessages"]
+                self._last_message_id = str(message["id"])
+                yield message
+                if message["type"] == "response":
+                    return True
+        finally:
+            with contextlib.suppress(Exception, asyncio.CancelledError):
+                if next_message is not None:
+                    next_message.cancel()
+                    loop.run_until_complete(asyncio.wait({next_message}))
+                    if not next_message.cancelled():
+                        # Retrieve how it ended, e.g. with StopAsyncIteration if the
+                        # subscription ended after the message failed to send, so
+                        # that asyncio doesn't log it as never retrieved.
+                        next_message.exception()
+                # Stop the subscription before disconnecting, as the server is
+                # waited on to acknowledge it.
+                if results is not None:
+                    loop.run_until_complete(results.aclose())
+            with contextlib.suppress(Exception):
+                loop.run_until_complete(client.close_async())
+            loop.close()
 
     def get_messages_since_last_time(self) -> List[Dict[str, Any]]:
-        """Return all messages since the given timestamp."""
-        timestamp = self._last_message_timestamp
-        messages_since_last_time = []
-        for message in self.get_messages():
-            message_timestamp = datetime.datetime.fromisoformat(message["timestamp"])
-            if timestamp is None or message_timestamp > timestamp:
-                messages_since_last_time.append(message)
-                self._last_message_timestamp = message_timestamp
-        return messages_since_last_time
+        """Return all messages since the last call."""
+        messages = self._get_messages_following(self._last_message_id)
+        if messages:
+            self._last_message_id = str(messages[-1]["id"])
+        return messages
+
+    def _get_messages_following(
+        self, message_id: Optional[str]
+    ) -> List[Dict[str, Any]]:
+        """Return the messages after the one with `message_id`, or all of them."""
+        if message_id is None or self._incremental_messages is False:
+            return _messages_following(self.get_messages(), message_id)
+        try:
+            messages = self.get_messages(after=message_id)
+            self._incremental_messages = True
+        except TransportQueryError:
+            if self._incremental_messages:
+                raise
+            # The server doesn't take a cursor, so look for new messages in the
+            # whole history instead.
+            messages = _messages_following(self.get_messages(), message_id)
+            self._incremental_messages = False
+        return messages
+
+
+class AsyncSession:
+    """Represents a single session with the Fixie system, for use with asyncio.
+
+    AsyncSessions are returned by AsyncFixieClient.
+
+    Args:
+        client: The AsyncFixieClient instance to use.
+        session_id: The ID of the session to use.
+    """
+
+    def __init__(self, client: AsyncFixieClient, session_id: Optional[str] = None):
+        self._client = client
+        self._session_id = session_id
+        self._frontend_agent_id: Optional[str] = None
+        self._last_message_id: Optional[str] = None
+        # Whether the server can return only the messages after a given one, if known.
+        self._incremental_messages: Optional[bool] = None
+
+    @property
+    def session_id(self) -> Optional[str]:
+        """Return the session ID used by this Fixie client."""
+        return self._session_id
+
+    @property
+    def session_url(self) -> str:
+        """Return the URL of the Fixie session."""
+        return f"{self._client.url}/sessions/{self.session_id}"
+
+    @property
+    def frontend_agent_id(self) -> Optional[str]:
+        """Return the frontend agent ID used by this Fixie client."""
+        return self._frontend_agent_id
+
+    async def _create_session(self, frontend_agent_id: Optional[str] = None) -> str:
+        """Create a new session."""
+        assert self._session_id is None
+        result = await self._client._execute(
+            _CREATE_SESSION_MUTATION.node, {"frontendAgentId": frontend_agent_id}
+        )
+        session = _created_session_from_result(result)
+        self._frontend_agent_id = session["frontendAgentId"]
+        handle: str = session["handle"]
+        self._session_id = handle
+        return handle
+
+    async def get_metadata(self) -> Dict[str, Any]:
+        """Return metadata about this session."""
+        result = await self._client._execute(
+            _GET_SESSION_QUERY.node, {"session_id": self._session_id}
+        )
+        metadata = _session_metadata_from_result(result)
+        self._frontend_agent_id = metadata["frontendAgentId"]
+        return metadata
+
+    async def delete_session(self) -> None:
+        """Delete the current session."""
+        _ = await self._client._execute(
+            _DELETE_SESSION_MUTATION.node, {"handle": self._session_id}
+        )
+
+    async def get_embeds(self) -> List[Dict[str, Any]]:
+        """Return the Embeds attached to this Session."""
+        result = await self._client._execute(
+            _GET_EMBEDS_QUERY.node, {"handle": self._session_id}
+        )
+        return _embeds_from_result(result)
+
+    async def get_messages(self, after: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the messages that make up this session.
+
+        Args:
+            after: If set, only the messages following the one with this ID are
+                returned. Not all servers support this.
+        """
+        if after is not None:
+            result = await self._client._execute(
+                _GET_MESSAGES_AFTER_QUERY.node,
+                {"handle": self._session_id, "after": after},
+            )
+        else:
+            result = await self._client._execute(
+                _GET_MESSAGES_QUERY.node, {"handle": self._session_id}
+            )
+        return _messages_from_result(result)
+
+    async def add_message(self, text: str) -> str:
+        """Add a message to this Session. Returns the added message text."""
+        message = await self._send_message(text)
+        assert isinstance(message["text"], str)
+        return message["text"]
+
+    async def _send_message(self, text: str) -> Dict[str, Any]:
+        """Add a message to this Session, and return its ID and text."""
+        result = await self._client._execute(
+            _POST_MESSAGE_MUTATION.node, {"handle": self._session_id, "text": text}
+        )
+        return _message_from_result(result)
+
+    async def query(self, text: str) -> str:
+        """Run a single query against the Fixie API and return the response."""
+        message = await self._send_message(text)
+        replies = await self._get_messages_following(str(message["id"]))
+        return _response_text(message, replies)
+
+    async def run(self, text: str) -> AsyncGenerator[Dict[str, Any], None]:
+        """Run a query against the Fixie API, returning an async generator that
+        yields messages."""
+
+        # Send the query concurrently, and poll for replies meanwhile.
+        sending = asyncio.ensure_future(self.add_message(text))
+        try:
+            interval = _MIN_POLL_INTERVAL
+            response_received = False
+            while not response_received:
+                await asyncio.sleep(interval)
+                messages = await self.get_messages_since_last_time()
+                for message in messages:
+                    response_received = message["type"] == "response"
+                    yield message
+                error = sending.exception() if sending.done() else None
+                if messages:
+                    interval = _MIN_POLL_INTERVAL
+                elif error is not None:
+                    raise error
+                else:
+                    interval = min(interval * _POLL_BACKOFF, _MAX_POLL_INTERVAL)
+        finally:
+            if not sending.done():
+                sending.cancel()
+
+    async def get_messages_since_last_time(self) -> List[Dict[str, Any]]:
+        """Return all messages since the last call."""
+        messages = await self._get_messages_following(self._last_message_id)
+        if messages:
+            self._last_message_id = str(messages[-1]["id"])
+        return messages
+
+    async def _get_messages_following(
+        self, message_id: Optional[str]
+    ) -> List[Dict[str, Any]]:
+        """Return the messages after the one with `message_id`, or all of them."""
+        if message_id is None or self._incremental_messages is False:
+            return _messages_following(await self.get_messages(), message_id)
+        try:
+            messages = await self.get_messages(after=message_id)
+            self._incremental_messages = True
+        except TransportQueryError:
+            if self._incremental_messages:
+                raise
+            # The server doesn't take a cursor, so look for new messages in the
+            # whole history instead.
+            messages = _messages_following(await self.get_messages(), message_id)
+            self._incremental_messages = False
+        return messages
+
+
+def _created_session_from_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    if "createSession" not in result or result["createSession"] is None:
+        raise ValueError(f"Failed to create Session")
+    assert isinstance(result["createSession"], dict)
+    assert isinstance(result["createSession"]["session"], dict)
+    assert isinstance(result["createSession"]["session"]["handle"], str)
+    return result["createSession"]["session"]
+
+
+def _session_metadata_from_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    assert "sessionByHandle" in result and isinstance(result["sessionByHandle"], dict)
+    return result["sessionByHandle"]
+
+
+def _embeds_from_result(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    assert (
+        "sessionByHandle" in result
+        and isinstance(result["sessionByHandle"], dict)
+        and isinstance(result["sessionByHandle"]["embeds"], list)
+    )
+    return result["sessionByHandle"]["embeds"]
+
+
+def _messages_from_result(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+    assert (
+        "sessionByHandle" in result
+        and isinstance(result["sessionByHandle"], dict)
+        and isinstance(result["sessionByHandle"]["messages"], list)
+    )
+    return result["sessionByHandle"]["messages"]
+
+
+def _message_from_result(result: Dict[str, Any]) -> Dict[str, Any]:
+    assert isinstance(result["sendSessionMessage"]["message"], dict)
+    return result["sendSessionMessage"]["message"]
+
+
+def _response_text(message: Dict[str, Any], replies: List[Dict[str, Any]]) -> str:
+    """Return the response to `message`: the last of the messages following it."""
+    response = replies[-1] if replies else message
+    assert isinstance(response["text"], str)
+    return response["text"]
+
+
+def _messages_following(
+    messages: List[Dict[str, Any]], message_id: Optional[str]
+) -> List[Dict[str, Any]]:
+    if message_id is None:
+        return messages
+    # The message is usually close to the end.
+    for index in range(len(messages) - 1, -1, -1):
+        if str(messages[index]["id"]) == message_id:
+            return messages[index + 1 :]
+    return messages
@@ -0,0 +1,183 @@
+import asyncio
+import gc
+import time
+import types
+from typing import List
+
+import pytest
+
+from fixieai.client import local_service
+from fixieai.client import session as session_module
+from fixieai.client.client import AsyncFixieClient
+from fixieai.client.client import FixieClient
+
+
+@pytest.fixture
+def service():
+    with local_service.LocalFixieService(reply_delay=0.05) as service:
+        yield service
+
+
+def _operation_names(service: local_service.LocalFixieService):
+    return [name for name, _ in service.operations]
+
+
+def test_run_yields_messages(service, monkeypatch):
+    sleeps: List[float] = []
+
+    def sleep(seconds: float):
+        sleeps.append(seconds)
+        time.sleep(seconds)
+
+    monkeypatch.setattr(session_module, "time", types.SimpleNamespace(sleep=sleep))
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    messages = list(session.run("Hello"))
+    # Replies are picked up shortly after they're sent, as polling starts often
+    # rather than once a second.
+    assert sleeps[0] == session_module._MIN_POLL_INTERVAL
+    names = _operation_names(service)
+    assert names.count("getMessages") + names.count("getMessagesAfter") == len(sleeps)
+    assert [(m["type"], m["text"]) for m in messages] == [
+        ("query", "Hello"),
+        ("thought", "Thinking about 'Hello'"),
+        ("response", "You said: Hello"),
+    ]
+
+    messages = list(session.run("Again"))
+    assert [m["text"] for m in messages] == [
+        "Again",
+        "Thinking about 'Again'",
+        "You said: Again",
+    ]
+    # Once a message was seen, only the following ones are fetched.
+    names = _operation_names(service)
+    assert "getMessages" not in names[names.index("getMessagesAfter") :]
+
+
+def test_run_falls_back_to_full_history():
+    with local_service.LocalFixieService(incremental_messages=False) as service:
+        session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+        assert [m["type"] for m in session.run("Hello")] == [
+            "query",
+            "thought",
+            "response",
+        ]
+        assert [m["text"] for m in session.run("Again")][-1] == "You said: Again"
+        # The server's lack of support for cursors is only found out once.
+        assert _operation_names(service).count("getMessagesAfter") == 1
+
+
+def test_get_messages_after(service):
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    session.query("Hello")
+    messages = session.get_messages()
+    assert len(messages) == 3
+    assert session.get_messages(after=messages[0]["id"]) == messages[1:]
+    assert session.get_messages(after=messages[-1]["id"]) == []
+
+
+def test_stream_yields_pushed_messages(service):
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    assert [(m["type"], m["text"]) for m in session.stream("Hello")] == [
+        ("query", "Hello"),
+        ("thought", "Thinking about 'Hello'"),
+        ("response", "You said: Hello"),
+    ]
+    # Only the new messages are pushed the next time.
+    assert [m["text"] for m in session.stream("Again")] == [
+        "Again",
+        "Thinking about 'Again'",
+        "You said: Again",
+    ]
+    assert _operation_names(service).count("sessionMessages") == 2
+    assert "getMessages" not in _operation_names(service)
+    assert "getMessagesAfter" not in _operation_names(service)
+
+
+def test_stream_falls_back_to_polling():
+    with local_service.LocalFixieService(subscriptions=False) as service:
+        session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+        assert [m["type"] for m in session.stream("Hello")] == [
+            "query",
+            "thought",
+            "response",
+        ]
+        assert [m["text"] for m in session.stream("Again")][-1] == "You said: Again"
+        assert "sessionMessages" not in _operation_names(service)
+
+
+def test_stream_falls_back_to_polling_if_subscriptions_fail(service):
+    async def fail(*args, **kwargs):
+        raise ValueError("Subscriptions are broken")
+
+    assert service._schema.subscription_type is not None
+    service._schema.subscription_type.fields["sessionMessages"].subscribe = fail
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    for text in ("Hello", "Again"):
+        assert [m["text"] for m in session.stream(text)][-1] == f"You said: {text}"
+    # Subscriptions aren't tried again once the server rejected one.
+    assert _operation_names(service).count("sessionMessages") == 1
+
+
+def test_stream_raises_send_errors(service, caplog):
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    service.responder = lambda text: 1 / 0
+    with pytest.raises(Exception, match="division by zero"):
+        list(session.stream("Hello"))
+    # The subscription's pending task is cleaned up, rather than logged by asyncio.
+    gc.collect()
+    assert "never retrieved" not in caplog.text
+
+
+def test_query_fetches_only_the_reply(service):
+    session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+    for _ in range(3):
+        session.query("Hello")
+    assert session.query("Again") == "You said: Again"
+    assert session.query("Again") == session.get_messages()[-1]["text"]
+    assert "getMessages" not in _operation_names(service)[:-1]
+
+
+@pytest.mark.parametrize("incremental_messages", [True, False])
+def test_query_without_replies(incremental_messages):
+    with local_service.LocalFixieService(
+        responder=lambda text: [], incremental_messages=incremental_messages
+    ) as service:
+        session = FixieClient(api_key="test-key", api_url=service.url).create_session()
+        # Same as the last message of the session.
+        assert session.query("Hello") == "Hello"
+        service.responder = local_service.echo_responder
+        assert session.query("Again") == "You said: Again"
+
+
+def test_async_run_yields_messages(service):
+    async def run():
+        async with AsyncFixieClient(api_key="test-key", api_url=service.url) as client:
+            session = await client.create_session()
+            first = [m async for m in session.run("Hello")]
+            second = [m async for m in session.run("Again")]
+            return first, second
+
+    first, second = asyncio.run(run())
+    assert [(m["type"], m["text"]) for m in first] == [
+        ("query", "Hello"),
+        ("thought", "Thinking about 'Hello'"),
+        ("response", "You said: Hello"),
+    ]
+    assert [m["text"] for m in second] == [
+        "Again",
+        "Thinking about 'Again'",
+        "You said: Again",
+    ]
+    assert "getMessagesAfter" in _operation_names(service)
+
+
+def test_async_run_raises_send_errors(service):
+    async def run():
+        async with AsyncFixieClient(api_key="test-key", api_url=service.url) as client:
+            session = await client.create_session()
+            return [m async for m in session.run("Hello")]
+
+    service.responder = lambda text: 1 / 0
+    with pytest.raises(Exception, match="division by zero"):
+        asyncio.run(run())